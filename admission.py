@@ -0,0 +1,304 @@
+import asyncio
+import threading
+import time
+
+# Rough token cost of one 512px image in a multimodal prompt, used before the real usage is known
+IMAGE_TOKEN_ESTIMATE = 1000
+
+
+class Overloaded(Exception):
+    # Raised instead of calling upstream; the HTTP layer turns it into 429 + Retry-After
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Upstream call rejected ({reason}), retry after {retry_after:.0f}s")
+        self.reason = reason
+        self.retry_after = max(1.0, retry_after)
+
+
+def estimate_tokens(messages, completion_tokens=1000):
+    # ~1 token per CJK character is a safe upper bound for the Doubao tokenizer
+    total = completion_tokens
+    for message in messages:
+        content = message.get('content')
+        parts = content if isinstance(content, list) else [{'type': 'text', 'text': content or ''}]
+        for part in parts:
+            if part.get('type') == 'image_url':
+                total += IMAGE_TOKEN_ESTIMATE
+            else:
+                total += len(part.get('text', ''))
+    return total
+
+
+def usage_tokens(response):
+    usage = getattr(response, 'usage', None)
+    return getattr(usage, 'total_tokens', None) if usage else None
+
+
+def is_limit_error(e):
+    return "SetLimitExceeded" in str(e)
+
+
+class TokenBucket:
+    # Refills continuously at per_minute / 60 per second up to one minute's worth.
+    # Takes may overdraw the bucket, so an underestimated call delays the next ones.
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        self._refill(now)
+        needed = min(amount, self.capacity)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= amount
+
+    def refund(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class Ticket:
+    # One admitted call; given back to release(). The half-open probe is marked, so only its
+    # outcome decides whether the breaker closes.
+
+    def __init__(self, tokens, probe=False):
+        self.tokens = tokens
+        self.probe = probe
+
+
+class AdmissionController:
+    # Gate in front of every Ark call: at most max_in_flight concurrent calls, optional
+    # requests-per-minute and tokens-per-minute budgets, and at most max_queue callers waiting
+    # (each for up to queue_timeout seconds). Anything beyond that is rejected immediately so the
+    # user gets a 429 instead of a long wait for a call that would be throttled anyway.
+    # A SetLimitExceeded error opens the circuit breaker for breaker_cooldown seconds; after that
+    # a single probe call is let through and closes it again if it succeeds. acquire() returns a
+    # Ticket that the caller passes to release() when the call is done.
+
+    def __init__(self, max_in_flight=64, rpm=0, tpm=0, max_queue=64, queue_timeout=30, breaker_cooldown=300):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.breaker_cooldown = breaker_cooldown
+        self.request_bucket = TokenBucket(rpm) if rpm else None
+        self.token_bucket = TokenBucket(tpm) if tpm else None
+        self._cond = threading.Condition()
+        self._breaker_until = 0.0
+        self._probe = None  # Ticket of the half-open probe in flight
+        self.in_flight = 0
+        self.waiting = 0
+        self.peak_in_flight = 0
+        self.admitted = 0
+        self.queued = 0
+        self.wait_seconds = 0.0
+        self.rejected = {'queue_full': 0, 'queue_timeout': 0, 'rate_limit': 0, 'circuit_open': 0}
+        self.breaker_trips = 0
+
+    def _reject(self, reason, retry_after):
+        self.rejected[reason] += 1
+        return Overloaded(reason, retry_after)
+
+    def _check_breaker(self, now):
+        # Called with the lock held; returns True when this call would be the half-open probe
+        if not self._breaker_until:
+            return False
+        if now < self._breaker_until:
+            raise self._reject('circuit_open', self._breaker_until - now)
+        if self._probe is not None:
+            raise self._reject('circuit_open', 5)
+        return True
+
+    def _try_admit(self, tokens, now):
+        # Called with the lock held; returns (ticket, 0) when admitted, else (None, a hint of
+        # how long to wait)
+        probe = self._check_breaker(now)
+        if probe or self.in_flight < self.max_in_flight:
+            wait = 0.0
+            if self.request_bucket:
+                wait = max(wait, self.request_bucket.wait_time(1, now))
+            if self.token_bucket:
+                wait = max(wait, self.token_bucket.wait_time(tokens, now))
+            if wait == 0.0:
+                if self.request_bucket:
+                    self.request_bucket.take(1)
+                if self.token_bucket:
+                    self.token_bucket.take(tokens)
+                self.in_flight += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+                self.admitted += 1
+                ticket = Ticket(tokens, probe)
+                if probe:
+                    self._probe = ticket
+                return ticket, 0.0
+            return None, wait
+        return None, 0.05
+
+    def _enqueue(self, wait, deadline, now):
+        if self.waiting >= self.max_queue:
+            raise self._reject('queue_full', max(wait, 1))
+        if now + wait > deadline:
+            # The budgets will not allow this call before the caller gives up; say so now
+            raise self._reject('rate_limit', wait)
+        self.waiting += 1
+        self.queued += 1
+
+    def try_acquire(self, tokens):
+        # Admit only if a slot and budget are free right now (used for optional hedged calls);
+        # returns a Ticket or None
+        with self._cond:
+            try:
+                return self._try_admit(tokens, time.monotonic())[0]
+            except Overloaded:
+                return None
+
+    def acquire(self, tokens, timeout=None):
+        # timeout: the caller's own remaining budget, if shorter than the queue timeout
+        start = time.monotonic()
+        deadline = start + min(self.queue_timeout, timeout if timeout is not None else self.queue_timeout)
+        with self._cond:
+            ticket, wait = self._try_admit(tokens, start)
+            if ticket:
+                return ticket
+            self._enqueue(wait, deadline, start)
+            try:
+                while True:
+                    now = time.monotonic()
+                    if now >= deadline:
+                        raise self._reject('queue_timeout', max(wait, 1))
+                    self._cond.wait(min(deadline - now, max(wait, 0.05)))
+                    now = time.monotonic()
+                    ticket, wait = self._try_admit(tokens, now)
+                    if ticket:
+                        self.wait_seconds += now - start
+                        return ticket
+            finally:
+                self.waiting -= 1
+
+    async def aacquire(self, tokens, timeout=None):
+        # Event-loop friendly variant: polls instead of blocking on the condition
+        start = time.monotonic()
+        deadline = start + min(self.queue_timeout, timeout if timeout is not None else self.queue_timeout)
+        with self._cond:
+            ticket, wait = self._try_admit(tokens, start)
+            if ticket:
+                return ticket
+            self._enqueue(wait, deadline, start)
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    with self._cond:
+                        raise self._reject('queue_timeout', max(wait, 1))
+                await asyncio.sleep(min(deadline - now, max(wait, 0.05), 0.25))
+                with self._cond:
+                    now = time.monotonic()
+                    ticket, wait = self._try_admit(tokens, now)
+                    if ticket:
+                        self.wait_seconds += now - start
+                        return ticket
+        finally:
+            with self._cond:
+                self.waiting -= 1
+
+    def release(self, ticket, actual_tokens=None, error=None):
+        tokens = ticket.tokens
+        with self._cond:
+            self.in_flight -= 1
+            if self.token_bucket and actual_tokens is not None:
+                # Settle the estimate against the real usage
+                if actual_tokens < tokens:
+                    self.token_bucket.refund(tokens - actual_tokens)
+                else:
+                    self.token_bucket.take(actual_tokens - tokens)
+            if error is not None and is_limit_error(error):
+                self.breaker_trips += 1
+                print(f"Warning: Ark limit reached, pausing upstream calls for {self.breaker_cooldown}s")
+                self._breaker_until = time.monotonic() + self.breaker_cooldown
+                # A probe still in flight no longer decides anything; the next one comes after the cooldown
+                self._probe = None
+            elif ticket is self._probe:
+                # Calls admitted before the breaker opened may finish meanwhile; only the probe
+                # shows that the limit has lifted
+                if error is None:
+                    self._breaker_until = 0.0
+                self._probe = None
+            self._cond.notify_all()
+
+    def guard_stream(self, stream, ticket):
+        return AdmittedStream(stream, lambda error: self.release(ticket, error=error))
+
+    def guard_async_stream(self, stream, ticket):
+        return AsyncAdmittedStream(stream, lambda error: self.release(ticket, error=error))
+
+    def stats(self):
+        with self._cond:
+            now = time.monotonic()
+            return {
+                'max_in_flight': self.max_in_flight,
+                'in_flight': self.in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'avg_queue_wait': round(self.wait_seconds / self.queued, 3) if self.queued else 0.0,
+                'rejected': dict(self.rejected),
+                'breaker_open': bool(self._breaker_until) and now < self._breaker_until,
+                'breaker_trips': self.breaker_trips,
+                'rpm_available': round(self.request_bucket.tokens, 1) if self.request_bucket else None,
+                'tpm_available': round(self.token_bucket.tokens) if self.token_bucket else None,
+            }
+
+
+class AdmittedStream:
+    # Holds the admission slot until the upstream stream is exhausted, fails or is dropped
+
+    def __init__(self, stream, on_done):
+        self._stream = stream
+        self._on_done = on_done
+
+    def _done(self, error=None):
+        if self._on_done:
+            on_done, self._on_done = self._on_done, None
+            on_done(error)
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                yield chunk
+        except Exception as e:
+            self._done(e)
+            raise
+        finally:
+            self._done()
+
+    def close(self):
+        try:
+            close = getattr(self._stream, 'close', None)
+            if close:
+                close()
+        finally:
+            self._done()
+
+    def __del__(self):
+        self._done()
+
+
+class AsyncAdmittedStream(AdmittedStream):
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        except Exception as e:
+            self._done(e)
+            raise
+        finally:
+            self._done()
@@ -1,13 +1,36 @@
 import os
 import json
-import time
 import base64
 import io
-from PIL import Image
-from flask import Flask, render_template, request, jsonify
-from volcenginesdkarkruntime import Ark
+import math
+import time
+import re
+from flask import Flask, Request, Response, render_template, request, jsonify, stream_with_context
 import concurrent.futures
+import tempfile
+import threading
 from dotenv import load_dotenv
+from PIL import Image
+import metrics
+from admission import AdmissionController, Overloaded
+from bilingual import SpeculativeTranslation
+from ark_clients import ArkClients, load_sdk
+from image_budget import ImageBudget, data_url_tokens
+from image_cache import ImageCache
+from image_features import FeatureHints
+from image_store import ImageStore, valid_hash
+from context_cache import PrefixContextCache
+from image_preprocess import JPEG_QUALITY, MAX_IMAGE_PIXELS, MAX_SIZE, check_uploads, decode_budget, encode_image_cached, encode_images, encode_pool
+import prompt_templates
+from resilience import request_deadline, translation_deadline
+from result_cache import ResultCache, analysis_fingerprint, request_fingerprint, sha256_file
+from singleflight import SingleFlight
+from translation_memory import TranslationMemory, split_segments
+from upload_limits import UploadTooLarge
+from streaming import StreamCleaner, iter_stream_deltas, sse_event
+from jobs import JobQueue
+from near_duplicates import NearDuplicateIndex
+from json_stream import JsonFieldStream, check_prompts, parse_json_prompt, selected_aspects
 
 load_dotenv()
 
@@ -16,108 +39,209 @@ app = Flask(__name__)
 # Configuration
 API_KEY = os.getenv("ARK_API_KEY")
 MODEL_ID = os.getenv("MODEL_ID", "doubao-seed-1-6-flash-250828")
+ARK_BASE_URL = os.getenv("ARK_BASE_URL", "https://ark.cn-beijing.volces.com/api/v3")
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(tempfile.gettempdir(), "prompt-fusion"))
 
-client = None
-if API_KEY:
-    try:
-        client = Ark(
-            api_key=API_KEY,
-            base_url="https://ark.cn-beijing.volces.com/api/v3",
-            timeout=900
-        )
-    except Exception as e:
-        print(f"Warning: Failed to initialize Ark client: {e}")
-else:
+# Result cache: identical image sets + options return the previous prompt without an upstream call.
+# Set RESULT_CACHE_DB to an empty string to keep the cache in memory only.
+result_cache = ResultCache(
+    max_entries=int(os.getenv("RESULT_CACHE_SIZE", "256")),
+    ttl=int(os.getenv("RESULT_CACHE_TTL", "86400")),
+    db_path=os.getenv("RESULT_CACHE_DB", os.path.join(CACHE_DIR, "results.sqlite3")),
+)
+
+# Encoded image cache: finished data URLs keyed by upload hash, bounded by bytes held
+image_cache = ImageCache(max_bytes=int(os.getenv("IMAGE_CACHE_BYTES", str(64 * 1024 * 1024))))
+
+# Image token budget: each image is encoded at the size and quality its selected aspects need,
+# scaled by precision, and the images of one request are kept under IMAGE_TOKEN_BUDGET estimated
+# tokens (0 = no cap). IMAGE_ADAPTIVE_SIZE=false sends every image at MAX_SIZE, as before.
+image_budget = ImageBudget(
+    token_cap=int(os.getenv("IMAGE_TOKEN_BUDGET", "1600")),
+    adaptive=os.getenv("IMAGE_ADAPTIVE_SIZE", "true").lower() == "true",
+)
+
+# Local image features: palette and light statistics computed with NumPy go into the prompt as
+# hints for 画面配色 / 光影描述 (IMAGE_FEATURE_HINTS=false turns them off). Images tagged only with
+# LOCAL_ONLY_ASPECTS (comma-separated, default 画面配色; empty to always send images) are described
+# from the hints without being sent.
+feature_hints = FeatureHints(
+    enabled=os.getenv("IMAGE_FEATURE_HINTS", "true").lower() == "true",
+    local_only=[aspect.strip() for aspect in os.getenv("LOCAL_ONLY_ASPECTS", "画面配色").split(",") if aspect.strip()],
+)
+
+# Near-duplicate lookups (NEAR_DUPLICATE_CACHE=true): uploads that are re-saved, recompressed or
+# resized copies of images seen before get the results cached for those images with the same
+# options. Only images tagged with coarse aspects (palette, light, composition, camera angle)
+# are matched, within a per-aspect distance capped at NEAR_DUPLICATE_DISTANCE.
+NEAR_DUPLICATE_CACHE = os.getenv("NEAR_DUPLICATE_CACHE", "false").lower() == "true"
+near_duplicates = NearDuplicateIndex(
+    max_distance=int(os.getenv("NEAR_DUPLICATE_DISTANCE", "4")),
+    max_entries=int(os.getenv("NEAR_DUPLICATE_INDEX_SIZE", "4096")),
+)
+
+# Upload-once handles: POST /images stores encoded images on disk by content hash so /generate
+# can take image_ids instead of re-uploading the files; LRU by bytes, entries expire after TTL
+image_store = ImageStore(
+    os.getenv("IMAGE_STORE_DIR", os.path.join(CACHE_DIR, "images")),
+    max_bytes=int(os.getenv("IMAGE_STORE_BYTES", str(256 * 1024 * 1024))),
+    ttl=int(os.getenv("IMAGE_STORE_TTL", "86400")),
+    max_size=MAX_SIZE,
+    quality=JPEG_QUALITY,
+)
+
+# Explicit Ark context cache for the static prompt prefix (the implicit prefix cache needs no setup)
+context_cache = None
+if os.getenv("ARK_CONTEXT_CACHE", "false").lower() == "true":
+    context_cache = PrefixContextCache(ttl=int(os.getenv("ARK_CONTEXT_CACHE_TTL", "3600")))
+
+# Translation memory: /translate reuses previous translations per "维度名：" line
+translation_memory = TranslationMemory(
+    MODEL_ID,
+    max_entries=int(os.getenv("TRANSLATION_MEMORY_SIZE", "2048")),
+    db_path=os.getenv("TRANSLATION_MEMORY_DB", os.path.join(CACHE_DIR, "translations.sqlite3")),
+)
+
+# Map-reduce mode: one analysis per image (cached by image + tags + precision), then a text-only merge
+MAPREDUCE_WORKERS = int(os.getenv("MAPREDUCE_WORKERS", "4"))
+analysis_cache = ResultCache(
+    max_entries=int(os.getenv("ANALYSIS_CACHE_SIZE", "1024")),
+    ttl=int(os.getenv("RESULT_CACHE_TTL", "86400")),
+    db_path=os.getenv("ANALYSIS_CACHE_DB", os.path.join(CACHE_DIR, "analyses.sqlite3")),
+)
+analysis_pool = concurrent.futures.ThreadPoolExecutor(max_workers=MAPREDUCE_WORKERS, thread_name_prefix="analyze")
+
+# Bilingual generation: translations of finished lines run here while the answer still streams
+translation_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.getenv("TRANSLATION_WORKERS", "8")), thread_name_prefix="translate"
+)
+
+# Batch jobs: /jobs queues fusion jobs in SQLite and runs them with bounded parallelism
+JOBS_DB = os.getenv("JOBS_DB", os.path.join(CACHE_DIR, "jobs.sqlite3"))
+JOBS_PARALLELISM = int(os.getenv("JOBS_PARALLELISM", "2"))
+JOBS_MAX_BATCH = int(os.getenv("JOBS_MAX_BATCH", "500"))
+
+# Identical concurrent requests (double submits, several tabs) share one upstream call
+singleflight = SingleFlight()
+
+# Upstream connection pool: one shared keep-alive pool per process, sized for the serving threads
+ARK_MAX_CONNECTIONS = int(os.getenv("ARK_MAX_CONNECTIONS", "64"))
+ASGI_MAX_CONNECTIONS = int(os.getenv("ASGI_MAX_CONNECTIONS", "512"))
+ARK_HTTP2 = os.getenv("ARK_HTTP2", "false").lower() == "true"
+# Per-endpoint read timeouts, e.g. ARK_TIMEOUT_FUSION=600, ARK_TIMEOUT_TRANSLATE=60
+ARK_TIMEOUTS = {
+    name: float(os.getenv(f"ARK_TIMEOUT_{name.upper()}"))
+    for name in ('fusion', 'analyze', 'merge', 'translate')
+    if os.getenv(f"ARK_TIMEOUT_{name.upper()}")
+}
+
+# Retries and hedging: transient upstream errors are retried with jittered backoff inside the
+# request's deadline budget (derived from precision and thinking mode, scaled by DEADLINE_SCALE).
+# ARK_HEDGING=true sends a second request for slow non-thinking calls after their p95 latency.
+ARK_MAX_RETRIES = int(os.getenv("ARK_MAX_RETRIES", "2"))
+ARK_HEDGING = os.getenv("ARK_HEDGING", "false").lower() == "true"
+DEADLINE_SCALE = float(os.getenv("DEADLINE_SCALE", "1.0"))
+
+# Uploads: bodies over MAX_UPLOAD_BYTES get a 413 from their Content-Length before they are read
+# (0 = no limit); uploaded files over UPLOAD_SPOOL_BYTES are spooled to a temp file instead of
+# held in memory. Pixel limits and the decode memory budget live in image_preprocess.
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(64 * 1024 * 1024)))
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES", str(1024 * 1024)))
+
+class SpooledRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES, mode='rb+')
+
+app.request_class = SpooledRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES or None
+
+# Admission control in front of every Ark call: concurrency cap, optional RPM/TPM budgets
+# (0 = unlimited), bounded wait queue, and a breaker that pauses calls after SetLimitExceeded
+admission = AdmissionController(
+    max_in_flight=int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "64")),
+    rpm=int(os.getenv("ADMISSION_RPM", "0")),
+    tpm=int(os.getenv("ADMISSION_TPM", "0")),
+    max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", "64")),
+    queue_timeout=float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30")),
+    breaker_cooldown=float(os.getenv("ADMISSION_BREAKER_COOLDOWN", "300")),
+)
+
+ark = ArkClients(
+    API_KEY,
+    ARK_BASE_URL,
+    max_connections=ARK_MAX_CONNECTIONS,
+    async_max_connections=ASGI_MAX_CONNECTIONS,
+    http2=ARK_HTTP2,
+    timeouts=ARK_TIMEOUTS,
+    max_retries=ARK_MAX_RETRIES,
+    admission=admission,
+    hedging=ARK_HEDGING,
+)
+if not API_KEY:
     print("Warning: ARK_API_KEY environment variable is not set. Application will start but generation will fail.")
 
-def encode_image(file_storage):
-    # Resize image to max 1024x1024 to speed up processing
-    img = Image.open(file_storage)
-    
-    # Convert to RGB if necessary (e.g. for PNGs with alpha)
-    if img.mode in ('RGBA', 'P'):
-        img = img.convert('RGB')
-        
-    max_size = 512
-    if img.width > max_size or img.height > max_size:
-        img.thumbnail((max_size, max_size))
+def thinking_options(use_thinking):
+    # extra_body for chat completions: toggles the model's deep thinking mode
+    if use_thinking:
+        return {"thinking": {"type": "enabled"}}
+    return {"thinking": {"type": "disabled"}}
+
+def build_analysis_prompt(selected_aspects, precision_level):
+    # Determine detail level
+    word_count = "200"
+    detail_instruction = "简明扼要"
+    if precision_level == "2":
+        word_count = "400"
+        detail_instruction = "标准详细"
+    elif precision_level == "3":
+        word_count = "1200"
+        detail_instruction = "极度详尽，显微镜级别的细节描述，包括材质纹理、光线微尘、背景微小物体等所有可见元素"
+
+    aspect_prompts = {
+        "风格": "画面整体风格（如：复古胶片、赛博朋克、油画等）。注意：只描述风格，不要描述画面主体内容！",
+        "背景": "环境背景细节（地点、天气、氛围）。",
+        "构图": "镜头角度、构图方式（如：俯视、三分法、特写）。注意：仅描述构图形式，严禁描述画面中具体的物体或人物！",
+        "人物外貌": "人物的性别、种族、年龄、发型、五官特征。必须明确描述性别（如男性/女性）和种族（如亚洲人/白人/黑人等）！注意：如果画面没有人物，请输出'无人物'或'None'。",
+        "人物动作": "人物的具体动作、姿态、表情。注意：如果画面没有人物，请输出'无人物'或'None'。严禁描述服装或外貌！",
+        "穿搭": "服装款式、材质、颜色、配饰。注意：如果画面没有人物，请输出'无人物'或'None'。",
+        "主体物描述": "画面主要物体（非人物）的详细外观。注意：仅描述主体本身，严禁描述背景或环境！",
+        "光影描述": "光线来源、质感、阴影分布。",
+        "画面配色": "主色调、配色方案。允许使用“主体”、“背景”等抽象词汇描述颜色分布（如“主体为绿色”），但严禁提及具体物体名称（如“树是绿色”）！",
+        "摄像机角度": "仅描述拍摄视角和镜头类型（如：俯视、仰视、平视、鱼眼、长焦、微距等）。严禁描述背景、光影或物体外观！",
+        "文字/水印": "识别并转录画面中的所有可见文字、水印、LOGO信息。若无文字，请注明无。注意：如果用户没有选择此标签，绝对不要在其他标签（如背景、主体）中提及文字或水印内容！"
+    }
+
+    # Filter aspects based on user selection
+    selected_instructions = []
     
-    # Save to buffer
-    buffer = io.BytesIO()
-    img.save(buffer, format="JPEG", quality=85)
-    buffer.seek(0)
+    # Sort aspects by weight (High priority first)
+    # Assuming selected_aspects is a list of dicts: [{'id': 'style', 'weight': 1}, ...]
+    # Or if it's legacy format (list of strings), handle that too.
     
-    return "data:image/jpeg;base64," + base64.b64encode(buffer.read()).decode('utf-8')
-
-def analyze_single_image(image_file, selected_aspects, precision_level):
-    try:
-        start_time = time.time()
-        # Create a local client instance for thread safety
-        local_client = Ark(
-            api_key=API_KEY,
-            base_url="https://ark.cn-beijing.volces.com/api/v3",
-            timeout=900
-        )
-        
-        base64_image = encode_image(image_file)
-        encode_time = time.time()
-        image_file.seek(0) # Reset pointer
-
-        # Determine detail level
-        word_count = "200"
-        detail_instruction = "简明扼要"
-        if precision_level == "2":
-            word_count = "400"
-            detail_instruction = "标准详细"
-        elif precision_level == "3":
-            word_count = "1200"
-            detail_instruction = "极度详尽，显微镜级别的细节描述，包括材质纹理、光线微尘、背景微小物体等所有可见元素"
-
-        aspect_prompts = {
-            "风格": "画面整体风格（如：复古胶片、赛博朋克、油画等）。注意：只描述风格，不要描述画面主体内容！",
-            "背景": "环境背景细节（地点、天气、氛围）。",
-            "构图": "镜头角度、构图方式（如：俯视、三分法、特写）。注意：仅描述构图形式，严禁描述画面中具体的物体或人物！",
-            "人物外貌": "人物的性别、种族、年龄、发型、五官特征。必须明确描述性别（如男性/女性）和种族（如亚洲人/白人/黑人等）！注意：如果画面没有人物，请输出'无人物'或'None'。",
-            "人物动作": "人物的具体动作、姿态、表情。注意：如果画面没有人物，请输出'无人物'或'None'。严禁描述服装或外貌！",
-            "穿搭": "服装款式、材质、颜色、配饰。注意：如果画面没有人物，请输出'无人物'或'None'。",
-            "主体物描述": "画面主要物体（非人物）的详细外观。注意：仅描述主体本身，严禁描述背景或环境！",
-            "光影描述": "光线来源、质感、阴影分布。",
-            "画面配色": "主色调、配色方案。允许使用“主体”、“背景”等抽象词汇描述颜色分布（如“主体为绿色”），但严禁提及具体物体名称（如“树是绿色”）！",
-            "摄像机角度": "仅描述拍摄视角和镜头类型（如：俯视、仰视、平视、鱼眼、长焦、微距等）。严禁描述背景、光影或物体外观！",
-            "文字/水印": "识别并转录画面中的所有可见文字、水印、LOGO信息。若无文字，请注明无。注意：如果用户没有选择此标签，绝对不要在其他标签（如背景、主体）中提及文字或水印内容！"
-        }
+    normalized_aspects = []
+    if selected_aspects and isinstance(selected_aspects[0], dict):
+        # Sort: weight 2 first, then 1
+        normalized_aspects = sorted(selected_aspects, key=lambda x: x.get('weight', 1), reverse=True)
+    else:
+        # Legacy string list
+        normalized_aspects = [{'id': a, 'weight': 1} for a in selected_aspects]
 
-        # Filter aspects based on user selection
-        selected_instructions = []
-        
-        # Sort aspects by weight (High priority first)
-        # Assuming selected_aspects is a list of dicts: [{'id': 'style', 'weight': 1}, ...]
-        # Or if it's legacy format (list of strings), handle that too.
+    for item in normalized_aspects:
+        aspect = item['id']
+        weight = item.get('weight', 1)
         
-        normalized_aspects = []
-        if selected_aspects and isinstance(selected_aspects[0], dict):
-            # Sort: weight 2 first, then 1
-            normalized_aspects = sorted(selected_aspects, key=lambda x: x.get('weight', 1), reverse=True)
-        else:
-            # Legacy string list
-            normalized_aspects = [{'id': a, 'weight': 1} for a in selected_aspects]
-
-        for item in normalized_aspects:
-            aspect = item['id']
-            weight = item.get('weight', 1)
-            
-            if aspect in aspect_prompts:
-                instruction = aspect_prompts[aspect]
-                if str(weight) == '2':
-                    # High Priority - STRONGER EMPHASIS
-                    selected_instructions.append(f"- 【!!! 核心绝对指令 (Highest Priority) !!!】{aspect}: {instruction} (注意：此维度拥有最高否决权！AI必须无条件服从本维度的描述。如果检测到其他维度（如人物穿搭、背景等）与本维度冲突，必须强制修改其他维度的描述以匹配本维度！例如：若本维度规定主体为绿色，而识别到人物穿红衣，必须改为穿绿衣！)")
-                else:
-                    # Normal Priority
-                    selected_instructions.append(f"- 【参考维度 (Normal Priority)】{aspect}: {instruction}")
-        
-        aspects_str = "\n".join(selected_instructions)
+        if aspect in aspect_prompts:
+            instruction = aspect_prompts[aspect]
+            if str(weight) == '2':
+                # High Priority - STRONGER EMPHASIS
+                selected_instructions.append(f"- 【!!! 核心绝对指令 (Highest Priority) !!!】{aspect}: {instruction} (注意：此维度拥有最高否决权！AI必须无条件服从本维度的描述。如果检测到其他维度（如人物穿搭、背景等）与本维度冲突，必须强制修改其他维度的描述以匹配本维度！例如：若本维度规定主体为绿色，而识别到人物穿红衣，必须改为穿绿衣！)")
+            else:
+                # Normal Priority
+                selected_instructions.append(f"- 【参考维度 (Normal Priority)】{aspect}: {instruction}")
+    
+    aspects_str = "\n".join(selected_instructions)
 
-        prompt = f"""
+    prompt = f"""
 你是一个专业的AI艺术提示词生成专家。你的任务是分析上传的图片，并根据用户选择的维度生成Stable Diffusion提示词。
 
 用户选择了以下分析维度：
@@ -149,36 +273,51 @@ def analyze_single_image(image_file, selected_aspects, precision_level):
 
 请直接输出分析结果，**不要输出任何思考过程、自我纠正或寒暄语**。
 """
-        
-        response = local_client.chat.completions.create(
+    return prompt
+
+def build_analysis_messages(base64_image, selected_aspects, precision_level):
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": build_analysis_prompt(selected_aspects, precision_level)},
+                {"type": "image_url", "image_url": {"url": base64_image}}
+            ]
+        }
+    ]
+
+def record_image_tokens(endpoint, encoded_images):
+    metrics.record_image_tokens(endpoint, sum(data_url_tokens(data_url) for data_url in encoded_images if data_url))
+
+def encode_for_analysis(image_file, digest, selected_aspects, precision_level):
+    # One image on its own: sized for its aspects, the request cap does not apply
+    max_size, quality = image_budget.plan({'0': selected_aspects}, 1, precision_level)[0]
+    data_url = encode_image_cached(image_file, digest, image_cache, max_size, quality)
+    record_image_tokens('analyze', [data_url])
+    return data_url
+
+def analyze_single_image(image_file, selected_aspects, precision_level, digest=None, deadline=None):
+    try:
+        base64_image = encode_for_analysis(image_file, digest, selected_aspects, precision_level)
+        response = ark.chat_completion(
+            'analyze',
+            deadline=deadline,
             model=MODEL_ID,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {"type": "image_url", "image_url": {"url": base64_image}}
-                    ]
-                }
-            ],
+            messages=build_analysis_messages(base64_image, selected_aspects, precision_level),
             extra_body={
                 "thinking": {"type": "disabled"}
             }
         )
-        end_time = time.time()
-        print(f"DEBUG: API call took {end_time - encode_time:.2f}s for {image_file.filename}")
-        print(f"DEBUG: Total processing time: {end_time - start_time:.2f}s for {image_file.filename}")
         return response.choices[0].message.content
+    except Overloaded:
+        raise
     except Exception as e:
-        print(f"Error analyzing image {image_file.filename}: {e}")
+        print(f"Error analyzing image {getattr(image_file, 'filename', digest)}: {e}")
         import traceback
         traceback.print_exc()
         return f"Error: {str(e)}"
 
-def merge_prompts(analyses, precision_level, use_thinking=True):
-    if not client:
-        return "Error: Ark client is not initialized. Please check ARK_API_KEY."
-
+def build_merge_prompt(analyses, precision_level):
     # If only one analysis, just format it
     combined_analysis = "\n\n---\n\n".join(analyses)
     
@@ -210,367 +349,816 @@ def merge_prompts(analyses, precision_level, use_thinking=True):
 - 如果遇到冲突，请直接默默修正，**不要**告诉用户你做了修正。
 - 最终输出必须纯粹是画面描述，不包含任何元数据或编辑注释。
 """
+    return system_prompt
 
-    extra_body = {}
-    if use_thinking:
-        extra_body["thinking"] = {"type": "enabled"}
-    else:
-        extra_body["thinking"] = {"type": "disabled"}
+def merge_prompts(analyses, precision_level, use_thinking=True, stream=False, deadline=None):
+    if not ark.available:
+        return "Error: Ark client is not initialized. Please check ARK_API_KEY."
 
-    response = client.chat.completions.create(
+    response = ark.chat_completion(
+        'merge',
+        deadline=deadline,
         model=MODEL_ID,
         messages=[
-            {"role": "user", "content": system_prompt}
+            {"role": "user", "content": build_merge_prompt(analyses, precision_level)}
         ],
-        extra_body=extra_body
+        extra_body=thinking_options(use_thinking),
+        stream=stream
     )
+    if stream:
+        return response
     return response.choices[0].message.content
 
-def generate_fused_prompt_directly(images, options_map, precision_level, use_thinking=True, json_output=False):
+def encode_fusion_images(images, options_map, precision_level, image_hashes=None):
+    # Returns (data URL per image, None for images described from local features alone; feature
+    # hint text per image or None). Only the images that are sent share the token budget.
+    aspects = [options_map.get(str(idx), []) for idx in range(len(images))]
+    digests = image_hashes or [None] * len(images)
+    sent = [idx for idx in range(len(images)) if not feature_hints.skip_image(aspects[idx])]
+    plans = image_budget.plan({str(pos): aspects[idx] for pos, idx in enumerate(sent)}, len(sent), precision_level)
+    # Hints for re-encoded images come from the image decoded for encoding, on its encode
+    # thread; the rest (cache hits, passed-through and unsent uploads) are decoded at
+    # FEATURE_SIZE afterwards, a few ms per image since JPEGs are drafted at that size
+    hints = [None] * len(images)
+    wanted = {idx for idx in range(len(images)) if feature_hints.wanted(aspects[idx])}
+
+    def on_decoded(position, img):
+        idx = sent[position]
+        if idx in wanted:
+            with metrics.span('image_features'):
+                hints[idx] = feature_hints.hint(img, aspects[idx])
+
+    encoded = encode_images([images[idx] for idx in sent], digests=[digests[idx] for idx in sent],
+                            cache=image_cache, plans=plans, on_decoded=on_decoded)
+    encoded_images = [None] * len(images)
+    for idx, data_url in zip(sent, encoded):
+        encoded_images[idx] = data_url
+    if len(sent) < len(images):
+        metrics.images_described_locally_total.inc(len(images) - len(sent))
+
+    remaining = sorted(idx for idx in wanted if hints[idx] is None)
+    if remaining:
+        hint = lambda idx: feature_hints.hint(encoded_images[idx] or images[idx], aspects[idx])
+        with metrics.span('image_features'):
+            for idx, text in zip(remaining, encode_pool.map(metrics.propagate(hint), remaining)):
+                hints[idx] = text
+    return encoded_images, hints
+
+def build_fusion_messages(images, options_map, precision_level, json_output=False, image_hashes=None):
+    # Encode all images concurrently at the sizes the budget picks for them; the prompt text
+    # comes from the precompiled templates
+    encoded_images, hints = encode_fusion_images(images, options_map, precision_level, image_hashes)
+    record_image_tokens('fusion', encoded_images)
+    with metrics.span('prompt_assembly'):
+        return prompt_templates.build_fusion_messages(encoded_images, options_map, precision_level, json_output, hints)
+
+def create_fusion_completion(messages, use_thinking=True, stream=False, deadline=None):
+    # messages[0] is the static system prefix; with ARK_CONTEXT_CACHE it is sent once as an explicit context
+    if context_cache:
+        context_id = context_cache.context_id(ark.client, MODEL_ID, messages[:1])
+        if context_id:
+            try:
+                return ark.context_completion(
+                    'fusion',
+                    deadline=deadline,
+                    context_id=context_id,
+                    model=MODEL_ID,
+                    messages=messages[1:],
+                    extra_body=thinking_options(use_thinking),
+                    stream=stream
+                )
+            except Overloaded:
+                raise
+            except Exception as e:
+                print(f"Warning: Context completion failed, retrying without context cache: {e}")
+                context_cache.invalidate(context_cache.key(messages[:1]))
+
+    return ark.chat_completion(
+        'fusion',
+        deadline=deadline,
+        model=MODEL_ID,
+        messages=messages,
+        extra_body=thinking_options(use_thinking),
+        stream=stream
+    )
+
+def generate_fused_prompt_directly(images, options_map, precision_level, use_thinking=True, json_output=False, stream=False, image_hashes=None, deadline=None):
     try:
         if not API_KEY:
              return "Error: ARK_API_KEY environment variable is missing. Please configure it in your deployment settings."
 
-        start_time = time.time()
-        # Create a local client instance for thread safety
-        local_client = Ark(
-            api_key=API_KEY,
-            base_url="https://ark.cn-beijing.volces.com/api/v3",
-            timeout=900
-        )
-        
-        # Determine detail level
-        word_count = "200"
-        detail_instruction = "简明扼要"
-        min_length_instruction = ""
-        
-        if precision_level == "2":
-            word_count = "400"
-            detail_instruction = "标准详细"
-        elif precision_level == "3":
-            word_count = "1000" # Slightly reduced from 1200 to be more realistic for Flash model but still very high
-            detail_instruction = "极度详尽，显微镜级别的细节描述"
-            min_length_instruction = """
-            **【超精细模式强制执行协议】**：
-            1. **拒绝短句**：绝对禁止使用“光线柔和”这种短语！必须扩写为“光线如流动的液态黄金般柔和，在物体表面形成细腻的漫反射...”。
-            2. **细节堆砌**：对于每一个标签，你必须至少写出 3-5 个具体的视觉细节形容词。
-            3. **严禁过度联想**：虽然要求字数多，但必须**严格基于画面中实际存在的元素**进行深入描写！绝对禁止凭空捏造画面中不存在的物体、人物或背景！例如：如果画面只有一只苹果，你可以花1000字描写苹果的纹理、光泽、瑕疵、果梗的细节，但**绝对不能**联想出旁边有一把刀或一个人！
-            """
-
-        # Aspect Definitions (Reused)
-        aspect_prompts = {
-            "风格": "仅提取艺术风格关键词（如：赛博朋克、水墨画、极简主义）。警告：严禁描述画面里的具体事物（如：建筑、街道、人物）！只输出风格流派、笔触、艺术形式！",
-            "场景/环境": "仅提取环境地点、天气、氛围关键词（如：室内、雨天、温馨）。警告：严禁描述前景主体或人物！",
-            "构图": "镜头角度、构图方式（如：俯视、三分法、特写）。注意：仅描述构图形式，严禁描述画面中具体的物体或人物！",
-            "人物外貌": "人物的性别、种族、年龄、发型、五官特征。必须明确描述性别（如男性/女性）和种族（如亚洲人/白人/黑人等）！注意：如果画面没有人物，请输出'无人物'或'None'。",
-            "人物动作": "人物的具体动作、姿态、表情。注意：如果画面没有人物，请输出'无人物'或'None'。严禁描述服装或外貌！严禁描述具体的物体（只能用“物体”、“物品”这类词汇来进行描述！",
-            "穿搭": "服装款式、材质、颜色、配饰。注意：如果画面没有人物，请输出'无人物'或'None'。严禁描述人物的外貌或动作！",
-            "主体物描述": "画面主要物体（非人物）的详细外观。注意：仅描述主体本身，严禁描述背景或环境！",
-            "光影描述": "光线来源、质感、阴影分布。",
-            "画面配色": "主色调、配色方案。允许使用“主体”、“背景”等抽象词汇描述颜色分布（如“主体为绿色”），但严禁提及具体物体名称（如“树是绿色”）！",
-            "摄像机角度": "识别并输出画面的具体拍摄视角（如：平视、俯视、仰视、侧拍、背拍等）。警告：严禁输出“未明确具体视角”！你必须根据画面内容做出判断！严禁描述任何画面内容！",
-            "文字/水印": "识别并转录画面中的所有可见文字、水印、LOGO信息，同时要描述文字在画面中的位置以及字体！。若无文字，则不需要出现相关内容。注意：如果用户没有选择此标签，绝对不要在其他标签（如背景、主体）中提及文字或水印内容！"
-        }
-
-        # Build message content
-        content = []
-        
-        # Determine output format instructions
-        format_instruction = ""
-        if json_output:
-            format_instruction = """
-            **【JSON结构化输出模式开启】**
-            1. **必须严格输出合法的JSON格式**：
-               - 根对象必须是一个包含 `prompts` 键的对象。
-               - `prompts` 的值是一个键值对对象，键是标签名，值是描述内容。
-            2. **格式示例**：
-               ```json
-               {
-                 "prompts": {
-                   "构图": "...",
-                   "风格": "...",
-                   "人物动作": "..."
-                 }
-               }
-               ```
-            3. **严禁**：输出Markdown代码块标记（如 ```json ... ```），直接输出纯JSON字符串！
-            4. **严禁**：输出任何非JSON的内容（如开场白、备注）。
-            """
-        else:
-            format_instruction = """
-            **【自然语言融合模式开启】**
-            1. **输出格式**：
-               [Chinese]
-               (一段完整的、连贯的自然语言描述，不要带标签名！不要分行！)
-            2. **风格示例**：
-               "一个成年亚洲男性，留着黑色长发且略显凌乱，眉毛浓密...写实摄影风格，高清晰度，细腻的皮肤纹理，柔和的光线..."
-            3. **严禁**：
-               - **严禁出现“标签名：”的前缀**（如不要写“人物外貌：...”）。
-               - **严禁分行列表输出**，请融合成通顺的段落，用逗号或句号连接。
-               - 严禁输出JSON格式。
-            """
-
-        intro_text = f"""
-        你是一个专业的AI艺术提示词生成专家。
-        任务：请分析以下 {len(images)} 张图片，结合每张图片的【指定标签】，直接生成一个融合后的、高质量的Stable Diffusion中文提示词。
-        
-        {format_instruction}
-
-        **核心生成逻辑（必须严格遵守）：**
-1. **识别标签**：首先识别每张图片被打上的具体标签（如构图、背景等）。
-2. **生成单图描述**：针对每张图，只生成该图【标签要求描述的内容】。
-   - **特别强调**：对于“构图”、“配色”、“摄像机角度”等抽象标签，**严禁**描述画面中具体的物体、人物或场景内容！必须使用“主体”、“物体”、“前景”、“背景”等抽象代词来代替具体名称。
-   - 例如：如果标签是“配色”，只能说“主体为红色，背景为深色”，绝对不能说“穿着红裙子的女孩站在黑夜里”。
-3. **生成融合提示词**：将上述提取出的、纯净的标签描述内容，融合成一个连贯的画面描述。
-4. **最终核查（Self-Correction）**：在输出前，必须再次检查：
-   - 检查：我描述的背景是来自选了“场景”标签的那张图吗？
-   - 检查：我描述的人物动作是来自选了“动作”标签的那张图吗？
-   - 如果发现描述了未选中标签图片的内容，必须立刻修正！
-5. **风格处理**：
-   - 如果所有图片都没有指定“风格”标签，则由你根据画面内容自动选择最美观的风格。
-   - 举例：如果图片1只选了“构图”，图片2只选了“配色”，那么最终画面应该是“图片1的构图 + 图片2的配色”，风格可以自由发挥或跟随图片2（如果有隐含风格）。
-6. **融合要求**：
-   - 最终输出的提示词是只针对单独一张图的描述，**绝对严禁**出现“图片1”、“图片2”、“图一”、“图二”、“第一张图”等类似的描述！
-   - 所有描述必须自然地融为一体，就像是在描述单独的一幅画。
-   - 错误示范：“图片1的人物穿着...图片2的背景是...”
-   - 正确示范：“人物穿着...背景是...”
-
-**详细要求**：
-- **标签优先与互补**：
-  - 每张图片都有【指定标签】，请**严格且仅**关注这些标签对应的内容！
-  - **白名单机制（White-listing）**：对于每张图，**只能**输出该图【指定标签】对应的描述！如果某张图只选了“摄像机角度”，你的输出里**绝对不能**出现“主体为一位女性”、“身着浅色连衣裙”等内容！只能有一句：“稍低仰拍视角”。
-  - 如果某张图没有选择“风格”标签，说明用户**不希望该图片的风格影响最终结果**。
-  - 如果所有图片都没有指定“风格”标签，则由你根据画面内容自动选择最美观的风格。
-  - **标签绝对权威原则（Universal Tag Authority）**：
-    - 对于任何维度（如构图、人物、背景、配色等），**只有选中了该标签的图片**才拥有定义权！
-    - 如果图片A选了某标签，而图片B没选，那么该维度的描述**必须完全由图片A决定**。图片B在该维度上的特征必须被彻底忽略。
-    - 如果多张图片都选了同一个标签，则对它们的内容进行融合。
-    - 举例：如果图片1选了“人物动作”，图片2没选。即使图片2的人物动作很夸张，也必须忽略，最终画面只能采用图片1的动作！
-  - 举例：如果图片1只选了“构图”，图片2只选了“配色”，那么最终画面应该是“图片1的构图 + 图片2的配色”，风格可以自由发挥或跟随图片2（如果有隐含风格）。
-- **详细程度**：{detail_instruction}（目标约{word_count}字）。
-{min_length_instruction}
-  - **再次强调**：即使字数很多，也**绝对严禁**使用“图片X”作为主语！
-- **输出格式**：
-   请根据上述【模式开启】的指示，严格遵守输出格式。
-   如果是JSON模式，必须输出合法JSON。
-   如果是自然语言模式，必须输出[Chinese]格式。
-
-**严厉约束**：
-- **格式强制**：必须严格遵守指定的格式！
-- 绝对禁止输出任何备注、解释、自我纠正或开场白！
-- 绝对禁止出现括号内有标注和画面不相关的内容。
-- 绝对禁止将推理和思考过程包含在输出中。
-- 绝对禁止输出“注：...”或“因为...”等内容。
-- 绝对禁止出现“(融合所有图片特征的Stable Diffusion中文提示词)”或类似标题。
-- 绝对禁止出现“(图片X环境色)”或类似引用来源的标注。
-- 绝对禁止出现“(注：...)”或任何形式的括号备注。
-- **绝对禁止拒绝生成**：即使图片风格完全不同（如写实 vs 扁平），你也必须发挥想象力进行“强制融合”！例如生成“具有扁平化配色风格的写实摄影”或“二次元与三次元结合的2.5D风格”。
-- 如果标签之间有冲突，请自动选择一个更具美感的方案，或者创造一种新的混合风格，不要输出错误提示。
-"""
-        content.append({"type": "text", "text": intro_text})
-
-        # Add Global Negative Constraint
-        content.append({"type": "text", "text": """
-**最高指令（优先级最高）：**
-1. **抽象化描述原则**：对于非内容类标签（如构图、配色、光影），**必须剥离具体物体**！
-   - 错误示范：“一个拿着水瓶的手（特写镜头）”
-   - 正确示范：“构图：主体局部特写（特写镜头）”
-   - 错误示范：“蓝色的天空和白色的云（蓝白配色）”
-   - 正确示范：“画面配色：背景为蓝色，点缀白色元素（蓝白配色）”
-2. **禁止越界**：如果选了“人物动作”，绝对不能顺便描述“人物穿着”！如果选了“构图”，绝对不能顺便描述“画面内容”！
-3. **禁止废话**：严禁输出“(根据...标签要求...假设为...)”这类思考过程！直接输出结论！
-4. **违规惩罚**：任何一次越界描述（在未选中维度里描述了该维度的内容）或具体化描述（在抽象标签里描述了具体物体），都将被视为严重错误。
-5. **最终一致性检查**：如果图片1选了“背景”但没选“人物”，而你描述了图片1的人物，这就是严重的逻辑错误！必须删除！
-6. **沉默是金**：对于未选中的维度，直接保持沉默！如果用户只选了“摄像机角度”，你就只输出“摄像机角度：低角度仰拍”这几个字，除此之外哪怕一个标点符号都不要多写！
-7. **来源匿名化**：无论如何，都不能在输出中透露信息的来源图片！不能说“图1的...”或“图2的...”！
-8. **禁止幻觉（Hallucination Zero Tolerance）**：即使在“超精细”模式下，也**绝对禁止**凭空捏造画面中不存在的物体！所有细节描述必须是对**已有元素**的深入挖掘（如材质、光泽、纹理），而不是增加新的实体。
-
-**学习示例 (Examples) - 请模仿以下模式：**
----
-【案例1】
-输入标签：[构图]
-正确输出：
-[Chinese]
-构图：特写镜头，中心构图，浅景深虚化背景。
----
-【案例2】
-输入标签：[配色] [风格]
-正确输出：
-[Chinese]
-画面配色：主体为暖色调，背景为冷色调，高饱和度，色彩对比强烈。
-风格：赛博朋克风格，数字艺术，高对比度，霓虹光感，未来主义美学，颗粒质感。
----
-【案例3】
-输入标签：[人物动作]
-正确输出：
-[Chinese]
-人物动作：侧身站立，手持物体，头部微转。
----
-【案例4】
-输入标签：[风格]
-正确输出：
-[Chinese]
-风格：赛博朋克风格，数字艺术，高对比度，霓虹光感，未来主义美学，颗粒质感。
-(错误示范：“赛博朋克风格，街道上有霓虹灯和飞行汽车” -> 错误！不能出现街道和汽车！)
-
-【案例5】
-输入标签：[人物动作]
-正确输出：
-[Chinese]
-人物动作：侧身站立，手持物体，头部微转，微笑表情。
-(错误示范：“侧身站立，手持透明瓶子，头部微转，微笑表情，” -> 错误！不能出现具体的物体（如透明瓶子）！)
----
-**严禁**出现如“图中有个穿着白衣服的人（配色）”这样的错误输出！必须是抽象的“画面配色：主体为白色”。
-"""})
-
-        for idx, image_file in enumerate(images):
-            # Encode image
-            base64_img = encode_image(image_file)
-            image_file.seek(0) # Reset pointer
-            
-            # Get aspects
-            selected_aspects = options_map.get(str(idx), [])
-            
-            # Sort aspects
-            normalized_aspects = []
-            if selected_aspects and isinstance(selected_aspects[0], dict):
-                normalized_aspects = sorted(selected_aspects, key=lambda x: x.get('weight', 1), reverse=True)
-            else:
-                normalized_aspects = [{'id': a, 'weight': 1} for a in selected_aspects]
-                
-            aspects_desc = []
-            for item in normalized_aspects:
-                aspect = item['id']
-                # Removed weight logic as requested by user - all tags are treated equally
-                if aspect in aspect_prompts:
-                    desc = aspect_prompts[aspect]
-                    aspects_desc.append(f"{aspect}: {desc}")
-                else:
-                    # Custom Tag Handling
-                    desc = f"仅提取画面中关于“{aspect}”的视觉信息。警告：严禁描述与“{aspect}”无关的任何内容（如人物、背景、光影）！严禁描述该物体与其他物体的关系（如“被拿着”、“放在桌上”）！只输出{aspect}本身的物理特征（如颜色、形状、材质）！"
-                    aspects_desc.append(f"{aspect}: {desc}")
-            
-            aspects_str = "\n".join(aspects_desc) if aspects_desc else "无特定标签约束，请综合分析画面。"
-
-            content.append({"type": "image_url", "image_url": {"url": base64_img}})
-            content.append({"type": "text", "text": f"\n[图片 {idx+1} 的参考标签]：\n{aspects_str}\n\n警告：对于这张图片，你只能提取上述列出的标签内容！绝对禁止描述图片中未被标签选中的其他元素！如果标签列表为空，则忽略这张图片的所有内容。"})
-        
-        print(f"DEBUG: Image encoding and prompt building took {time.time() - start_time:.2f}s")
-        api_start_time = time.time()
-        
-        content.append({"type": "text", "text": "\n请开始直接生成最终融合后的中文提示词："})
+        messages = build_fusion_messages(images, options_map, precision_level, json_output, image_hashes)
 
         # Call Model
-        extra_body = {}
-        if use_thinking:
-            extra_body["thinking"] = {"type": "enabled"}
-        else:
-            extra_body["thinking"] = {"type": "disabled"}
+        response = create_fusion_completion(messages, use_thinking, stream, deadline)
+        if stream:
+            # Caller consumes the chunks; see iter_stream_deltas
+            return response
 
-        response = client.chat.completions.create(
-            model=MODEL_ID,
-            messages=[
-                {"role": "user", "content": content}
-            ],
-            extra_body=extra_body
-        )
-        
-        print(f"DEBUG: API Call took {time.time() - api_start_time:.2f}s")
         return response.choices[0].message.content
 
+    except Overloaded:
+        raise
     except Exception as e:
         print(f"Error in direct fusion: {e}")
         import traceback
         traceback.print_exc()
         raise e
 
+def analysis_keys(options_map, precision_level, image_hashes):
+    return [
+        analysis_fingerprint(image_hash, options_map.get(str(idx), []), precision_level, MODEL_ID)
+        for idx, image_hash in enumerate(image_hashes)
+    ]
+
+def analyze_images(images, options_map, precision_level, image_hashes, deadline=None):
+    # Map step: only images whose analysis is not cached are sent upstream, concurrently
+    keys = analysis_keys(options_map, precision_level, image_hashes)
+    analyses = [analysis_cache.get(key) for key in keys]
+    missing = [idx for idx, analysis in enumerate(analyses) if analysis is None]
+
+    analyze = lambda idx: analyze_single_image(
+        images[idx], options_map.get(str(idx), []), precision_level, image_hashes[idx], deadline
+    )
+    for idx, analysis in zip(missing, analysis_pool.map(metrics.propagate(analyze), missing)):
+        if analysis.startswith("Error:"):
+            raise RuntimeError(analysis)
+        analysis_cache.set(keys[idx], analysis)
+        analyses[idx] = analysis
+    return analyses, len(images) - len(missing)
+
+def generate_mapreduce(images, options_map, precision_level, use_thinking=True, stream=False, image_hashes=None, deadline=None):
+    # Returns (final prompt or stream, per-image analyses, stage timings)
+    if not ark.available:
+        raise RuntimeError("Ark client is not initialized. Please check ARK_API_KEY.")
+
+    start_time = time.time()
+    analyses, reused = analyze_images(images, options_map, precision_level, image_hashes, deadline)
+    map_time = time.time()
+    timings = {'map_seconds': round(map_time - start_time, 3), 'analyses_reused': reused}
+    metrics.record_stage('mapreduce_map', map_time - start_time, analyses_reused=reused)
+
+    if stream:
+        return merge_prompts(analyses, precision_level, use_thinking, stream=True, deadline=deadline), analyses, timings
+
+    final_prompt_raw = merge_prompts(analyses, precision_level, use_thinking, deadline=deadline)
+    end_time = time.time()
+    timings['reduce_seconds'] = round(end_time - map_time, 3)
+    timings['total_seconds'] = round(end_time - start_time, 3)
+    metrics.record_stage('mapreduce_reduce', end_time - map_time)
+    return final_prompt_raw, analyses, timings
+
+def cached_analyses(params):
+    # Individual analyses for a map-reduce result served from the result cache
+    image_hashes = params['canonical_hashes'] if params['near_duplicate'] else params['image_hashes']
+    keys = analysis_keys(params['options_map'], params['precision'], image_hashes)
+    return [analysis_cache.get(key) or "" for key in keys]
+
+def lookup_result(params):
+    # Cached prompt for the request, or None: the exact uploads first, then the indexed images
+    # they are near-duplicates of, with the same options. New images are indexed on the way.
+    # Sets params['near_key'], the key under which remember_result also stores the result.
+    params.update(near_key=None, canonical_hashes=None, near_duplicate=False)
+    cached_prompt = result_cache.get(params['cache_key'])
+    if cached_prompt is not None or not NEAR_DUPLICATE_CACHE:
+        return cached_prompt
+    with metrics.span('near_duplicate_lookup'):
+        aspects = [params['options_map'].get(str(idx), []) for idx in range(len(params['images']))]
+        canonical_hashes = near_duplicates.canonical(params['images'], params['image_hashes'], aspects)
+    if canonical_hashes is None or canonical_hashes == params['image_hashes']:
+        return None
+    params['canonical_hashes'] = canonical_hashes
+    params['near_key'] = request_fingerprint(
+        canonical_hashes, params['options_map'], params['precision'], params['use_thinking'],
+        params['json_output'], MODEL_ID, params['mode']
+    )
+    cached_prompt = result_cache.get(params['near_key'])
+    params['near_duplicate'] = cached_prompt is not None
+    near_duplicates.record(params['near_duplicate'])
+    metrics.near_duplicate_lookups_total.inc(outcome='hit' if params['near_duplicate'] else 'miss')
+    return cached_prompt
+
+def remember_result(params, final_prompt):
+    result_cache.set(params['cache_key'], final_prompt)
+    if params['near_key']:
+        # Stored under the canonical hashes too, for later copies of the same images
+        result_cache.set(params['near_key'], final_prompt)
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/generate', methods=['POST'])
-def generate():
-    if 'images' not in request.files:
-        return jsonify({'error': 'No images uploaded'}), 400
+def postprocess_prompt(final_prompt_raw, json_output):
+    with metrics.span('postprocess'):
+        return clean_prompt(final_prompt_raw, json_output)
+
+def postprocess_json(final_prompt_raw, options_map):
+    # JSON mode: returns (final_prompt, report). final_prompt is the validated {"prompts": {...}}
+    # object, or the fence-stripped text when no JSON object can be recovered at all.
+    with metrics.span('postprocess'):
+        result, report = parse_json_prompt(final_prompt_raw, selected_aspects(options_map))
+        return (result if result is not None else clean_prompt(final_prompt_raw, True)), report
+
+def cached_json_prompt(cached_prompt, options_map):
+    # Entries cached before JSON mode was parsed server-side are plain strings
+    if isinstance(cached_prompt, str):
+        return postprocess_json(cached_prompt, options_map)
+    return check_prompts(cached_prompt, selected_aspects(options_map))
+
+def clean_prompt(final_prompt_raw, json_output):
+    if json_output:
+        # If JSON mode, try to extract JSON
+        final_prompt = final_prompt_raw.strip()
+        # Remove markdown code blocks if any
+        final_prompt = re.sub(r'^```json\s*', '', final_prompt)
+        final_prompt = re.sub(r'\s*```$', '', final_prompt)
+        return final_prompt.strip()
+
+    # Natural Language Mode Processing
+    final_prompt = final_prompt_raw.replace("[Chinese]", "").strip()
+    
+    # Remove lines starting with (注 or (Note
+    final_prompt = re.sub(r'^\s*[\(（]注.*[\)）]', '', final_prompt, flags=re.MULTILINE)
+    
+    # Remove any bracketed content at the end if it looks like a note
+    final_prompt = re.sub(r'\n\s*[\(（].*?[\)）]\s*$', '', final_prompt, flags=re.DOTALL)
+    
+    # Remove specific headers like (中文) or (Chinese)
+    final_prompt = re.sub(r'^\s*[\(（](中文|Chinese|融合.*)[\)）]\s*', '', final_prompt, flags=re.IGNORECASE)
     
-    images = request.files.getlist('images')
-    options_str = request.form.get('options')
-    precision = request.form.get('precision', '2')
+    # New Rule: If the ENTIRE prompt is wrapped in parentheses, remove them
+    match_wrapped = re.match(r'^\s*[\(（](.*)[\)）]\s*$', final_prompt, flags=re.DOTALL)
+    if match_wrapped:
+        final_prompt = match_wrapped.group(1).strip()
+    
+    return final_prompt.strip()
+
+def format_generation_error(e):
+    error_str = str(e)
+    if "SetLimitExceeded" in error_str:
+        return "【系统提示】您的火山引擎账户余额不足或已达到“安全体验模式”的限额。\n请前往火山引擎控制台(console.volcengine.com)充值或调整模型限额配置。\n(错误代码: SetLimitExceeded)"
+    return f"Error generating prompts: {error_str}"
+
+def validate_mode(mode, json_output, bilingual=False):
+    # direct: all images in one multimodal call; mapreduce: per-image analyses + text merge
+    if mode not in ('direct', 'mapreduce'):
+        return 'Invalid mode (expected "direct" or "mapreduce")'
+    if mode == 'mapreduce' and json_output:
+        return 'JSON output is only available in direct mode'
+    if bilingual and json_output:
+        return 'Bilingual output is not available with JSON output'
+    return None
+
+def load_stored_images(image_ids_str):
+    # image_ids form field: JSON list of hashes returned by POST /images, in image order.
+    # Returns (data URLs, hashes, error); error is (body, status), with 409 listing the
+    # handles that expired or were evicted and have to be uploaded again.
+    try:
+        image_hashes = json.loads(image_ids_str)
+    except ValueError:
+        image_hashes = None
+    if not image_hashes or not isinstance(image_hashes, list) or not all(valid_hash(h) for h in image_hashes):
+        return None, None, ({'error': 'Invalid image_ids (expected a JSON list of image hashes)'}, 400)
+    with metrics.span('image_store'):
+        data_urls, missing = image_store.get_many(image_hashes)
+    if missing:
+        return None, None, ({'error': 'Some images are no longer stored, please upload them again', 'missing': missing}, 409)
+    return data_urls, image_hashes, None
+
+def store_images(files):
+    # POST /images: encodes each upload once and keeps it under its hash; returns (body, status)
+    with metrics.span('upload_check'):
+        check_uploads(files)
+    with metrics.span('upload_hash'):
+        image_hashes = [sha256_file(f) for f in files]
+    try:
+        encoded_images = encode_images(files, digests=image_hashes, cache=image_cache)
+    except UploadTooLarge:
+        raise
+    except Exception as e:
+        return {'error': f'Invalid image: {e}'}, 400
+    with metrics.span('image_store'):
+        stored = [image_store.put(image_hash, data_url) for image_hash, data_url in zip(image_hashes, encoded_images)]
+    return {
+        # stored is false when the store is disabled or full; send that image as a file instead
+        'images': [{'hash': image_hash, 'stored': ok} for image_hash, ok in zip(image_hashes, stored)],
+        'ttl': image_store.ttl,
+    }, 200
+
+def read_generate_form(form, has_images):
+    # Validates the /generate form fields; shared with the ASGI app.
+    # Returns (fields, error) with error as (body, status).
+    if not has_images and not form.get('image_ids'):
+        return None, ({'error': 'No images uploaded'}, 400)
+
+    options_str = form.get('options')
+    precision = form.get('precision', '2')
     # Parse boolean from string "true"/"false"
-    use_thinking = request.form.get('thinking', 'true').lower() == 'true'
+    use_thinking = form.get('thinking', 'true').lower() == 'true'
     # Parse json_output boolean
-    json_output = request.form.get('json_output', 'false').lower() == 'true'
-    
+    json_output = form.get('json_output', 'false').lower() == 'true'
+    # Also return the English prompt, translated while the Chinese one is generated
+    bilingual = form.get('bilingual', 'false').lower() == 'true'
+    mode = form.get('mode', 'direct')
+
     if not options_str:
-        return jsonify({'error': 'No options provided'}), 400
+        return None, ({'error': 'No options provided'}, 400)
+
+    error = validate_mode(mode, json_output, bilingual)
+    if error:
+        return None, ({'error': error}, 400)
 
     try:
         options_map = json.loads(options_str)
-    except:
-        return jsonify({'error': 'Invalid options format'}), 400
+    except ValueError:
+        return None, ({'error': 'Invalid options format'}, 400)
+
+    return {
+        'options_map': options_map,
+        'precision': precision,
+        'use_thinking': use_thinking,
+        'json_output': json_output,
+        'mode': mode,
+        'bilingual': bilingual,
+    }, None
+
+def generate_params(fields, images, image_hashes):
+    # Request params from the validated form fields and the images; shared with the ASGI app.
+    # Repeated submissions of the same images + options are served from the result cache;
+    # handles are the hashes of the uploads, so both forms share cache entries.
+    cache_key = request_fingerprint(
+        image_hashes, fields['options_map'], fields['precision'], fields['use_thinking'],
+        fields['json_output'], MODEL_ID, fields['mode']
+    )
+    return dict(
+        fields,
+        images=images,
+        image_hashes=image_hashes,
+        cache_key=cache_key,
+        # The Chinese prompt is cached either way; only identical requests share a flight
+        flight_key=f"{cache_key}:bilingual" if fields['bilingual'] else cache_key,
+        # Budget shared by every upstream call made for this request
+        deadline=request_deadline(fields['precision'], fields['use_thinking'], DEADLINE_SCALE),
+    )
+
+def parse_generate_request():
+    # Returns (params, error_response); shared by /generate and /generate/stream
+    with metrics.span('upload_parse'):
+        # Werkzeug parses (and spools) the whole multipart body on first access
+        has_files = 'images' in request.files
+    fields, error = read_generate_form(request.form, has_files)
+    if error:
+        return None, (jsonify(error[0]), error[1])
+
+    if has_files:
+        images = request.files.getlist('images')
+        # Oversized images are rejected from their headers (413) before hashing or decoding
+        with metrics.span('upload_check'):
+            check_uploads(images)
+        with metrics.span('upload_hash'):
+            image_hashes = [sha256_file(image_file) for image_file in images]
+    else:
+        # Stored images are passed on as data URLs, which the encoders return unchanged
+        images, image_hashes, error = load_stored_images(request.form['image_ids'])
+        if error:
+            return None, (jsonify(error[0]), error[1])
+
+    return generate_params(fields, images, image_hashes), None
+
+@app.route('/generate', methods=['POST'])
+def generate():
+    params, error_response = parse_generate_request()
+    if error_response:
+        return error_response
+    images = params['images']
+    mapreduce = params['mode'] == 'mapreduce'
 
-    # Parallel processing replaced by Direct Fusion
+    # Direct fusion skips per-image analysis; map-reduce returns the analyses it merged
     individual_prompts = ["(Direct Fusion Mode - Individual analysis skipped)"] * len(images)
-    
+
+    cached_prompt = lookup_result(params)
+    if cached_prompt is not None:
+        body = {
+            'final_prompt': cached_prompt,
+            'individual_prompts': cached_analyses(params) if mapreduce else individual_prompts,
+            'cached': True,
+            'mode': params['mode']
+        }
+        if params['near_duplicate']:
+            body['near_duplicate'] = True
+        if params['json_output']:
+            body['final_prompt'], body['json_report'] = cached_json_prompt(cached_prompt, params['options_map'])
+        if params['bilingual']:
+            body.update(translation_fields(lambda: translate_prompt(cached_prompt)))
+        return jsonify(body)
+
+    # Duplicates arriving while this generation runs wait for it and get the same body
+    body = singleflight.do('generate', params['flight_key'], lambda: run_generation(params, individual_prompts))
+    return jsonify(body)
+
+def translate_batch(text):
+    # Speculative batches start at different times, so each call gets its own deadline
+    return translate_text(text, translation_deadline(DEADLINE_SCALE))
+
+def translate_prompt(text):
+    return translation_memory.translate(text, translate_batch)
+
+def speculative_translation():
+    return SpeculativeTranslation(translation_memory, translate_batch, translation_pool)
+
+def translation_fields(translate_fn):
+    # Bilingual responses: a failed translation leaves the Chinese prompt intact
+    try:
+        return {'translated_text': translate_fn()}
+    except Exception as e:
+        print(f"Warning: Translation of the generated prompt failed: {e}")
+        return {'translation_error': str(e)}
+
+def read_translating(upstream, translation):
+    # Reads a fusion stream to the end, feeding its cleaned text to the speculative translation
+    cleaner = StreamCleaner()
+    parts = []
+    for kind, text in iter_stream_deltas(upstream):
+        if kind == 'delta':
+            parts.append(text)
+            translation.feed(cleaner.feed(text))
+    translation.feed(cleaner.finish())
+    return "".join(parts)
+
+def run_generation(params, individual_prompts):
+    images = params['images']
+    mapreduce = params['mode'] == 'mapreduce'
+    # Bilingual: the answer is read as a stream, so its lines are translated while it is generated
+    translation = speculative_translation() if params['bilingual'] else None
+    streamed = translation is not None
+    start_time = time.time()
+    timings = {}
+    json_report = None
+    translated = {}
     try:
-        final_prompt_raw = generate_fused_prompt_directly(images, options_map, precision, use_thinking, json_output)
+        if mapreduce:
+            final_prompt_raw, individual_prompts, timings = generate_mapreduce(
+                images, params['options_map'], params['precision'], params['use_thinking'],
+                stream=streamed, image_hashes=params['image_hashes'], deadline=params['deadline']
+            )
+        else:
+            final_prompt_raw = generate_fused_prompt_directly(
+                images, params['options_map'], params['precision'], params['use_thinking'], params['json_output'],
+                stream=streamed, image_hashes=params['image_hashes'], deadline=params['deadline']
+            )
+        if streamed and not isinstance(final_prompt_raw, str):
+            final_prompt_raw = read_translating(final_prompt_raw, translation)
+        if not mapreduce or streamed:
+            timings['total_seconds'] = round(time.time() - start_time, 3)
         
+        timings['image_tokens'] = metrics.image_tokens_sent()
+
         # Post-processing
-        if json_output:
-            # If JSON mode, try to extract JSON
-            import re
-            final_prompt = final_prompt_raw.strip()
-            # Remove markdown code blocks if any
-            final_prompt = re.sub(r'^```json\s*', '', final_prompt)
-            final_prompt = re.sub(r'\s*```$', '', final_prompt)
-            final_prompt = final_prompt.strip()
+        if params['json_output']:
+            final_prompt, json_report = postprocess_json(final_prompt_raw, params['options_map'])
         else:
-            # Natural Language Mode Processing
-            import re
-            final_prompt = final_prompt_raw.replace("[Chinese]", "").strip()
-            
-            # Remove lines starting with (注 or (Note
-            final_prompt = re.sub(r'^\s*[\(（]注.*[\)）]', '', final_prompt, flags=re.MULTILINE)
-            
-            # Remove any bracketed content at the end if it looks like a note
-            final_prompt = re.sub(r'\n\s*[\(（].*?[\)）]\s*$', '', final_prompt, flags=re.DOTALL)
-            
-            # Remove specific headers like (中文) or (Chinese)
-            final_prompt = re.sub(r'^\s*[\(（](中文|Chinese|融合.*)[\)）]\s*', '', final_prompt, flags=re.IGNORECASE)
-            
-            # New Rule: If the ENTIRE prompt is wrapped in parentheses, remove them
-            match_wrapped = re.match(r'^\s*[\(（](.*)[\)）]\s*$', final_prompt, flags=re.DOTALL)
-            if match_wrapped:
-                final_prompt = match_wrapped.group(1).strip()
-            
-            final_prompt = final_prompt.strip()
+            final_prompt = postprocess_prompt(final_prompt_raw, False)
+
+        # Output with no recoverable JSON object is not cached, so a retry generates again
+        if not final_prompt_raw.startswith("Error:") and not (json_report and isinstance(final_prompt, str)):
+            remember_result(params, final_prompt)
+
+        if translation is not None and not final_prompt_raw.startswith("Error:"):
+            chinese_done = time.time()
+            translated = translation_fields(lambda: translation.finish(final_prompt))
+            # How long the English prompt took once the Chinese one was complete
+            timings['translation_lag_seconds'] = round(time.time() - chinese_done, 3)
         
+    except Overloaded:
+        raise
     except Exception as e:
-        error_str = str(e)
-        if "SetLimitExceeded" in error_str:
-            final_prompt = "【系统提示】您的火山引擎账户余额不足或已达到“安全体验模式”的限额。\n请前往火山引擎控制台(console.volcengine.com)充值或调整模型限额配置。\n(错误代码: SetLimitExceeded)"
+        final_prompt = format_generation_error(e)
+
+    body = {
+        'final_prompt': final_prompt,
+        'individual_prompts': individual_prompts,
+        'cached': False,
+        'mode': params['mode'],
+        'timings': timings
+    }
+    if json_report:
+        body['json_report'] = json_report
+    body.update(translated)
+    return body
+
+def sse_response(events):
+    return Response(
+        stream_with_context(events),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/generate/stream', methods=['POST'])
+def generate_stream():
+    params, error_response = parse_generate_request()
+    if error_response:
+        return error_response
+
+    cached_prompt = lookup_result(params)
+    if cached_prompt is not None:
+        done = {'final_prompt': cached_prompt, 'cached': True}
+        if params['near_duplicate']:
+            done['near_duplicate'] = True
+        if params['json_output']:
+            done['final_prompt'], done['json_report'] = cached_json_prompt(cached_prompt, params['options_map'])
+        if params['bilingual']:
+            done.update(translation_fields(lambda: translate_prompt(cached_prompt)))
+        return sse_response(iter([sse_event('done', done)]))
+
+    if not ark.available:
+        return jsonify({'error': 'Ark client is not initialized. Please check ARK_API_KEY.'}), 500
+
+    # A duplicate of a generation already streaming replays its events instead of calling Ark
+    flight, leader = singleflight.join_stream('generate_stream', params['flight_key'])
+    if not leader:
+        return sse_response(flight.follow())
+
+    json_output = params['json_output']
+    request_start_time = time.time()
+    timings = {}
+    try:
+        # Encoding (and the map step) happens here, before the response starts, so errors are still plain JSON
+        if params['mode'] == 'mapreduce':
+            upstream, _, timings = generate_mapreduce(
+                params['images'], params['options_map'], params['precision'], params['use_thinking'],
+                stream=True, image_hashes=params['image_hashes'], deadline=params['deadline']
+            )
         else:
-            final_prompt = f"Error generating prompts: {error_str}"
+            upstream = generate_fused_prompt_directly(
+                params['images'], params['options_map'], params['precision'], params['use_thinking'], json_output,
+                stream=True, image_hashes=params['image_hashes'], deadline=params['deadline']
+            )
+    except Overloaded as e:
+        singleflight.end_stream('generate_stream', params['flight_key'], flight, sse_event('error', overloaded_response(e)[0]))
+        raise
+    except Exception as e:
+        error = format_generation_error(e)
+        singleflight.end_stream('generate_stream', params['flight_key'], flight, sse_event('error', {'error': error}))
+        return jsonify({'error': error}), 500
+
+    def events():
+        start_time = time.time()
+        raw_parts = []
+        cleaner = None if json_output else StreamCleaner()
+        # JSON mode: each dimension is sent as a 'field' event as soon as its value is closed
+        fields = JsonFieldStream() if json_output else None
+        aspects = selected_aspects(params['options_map'])
+        # Bilingual: finished lines are translated meanwhile and sent as 'translation' events
+        translation = speculative_translation() if params['bilingual'] else None
+        try:
+            for kind, text in iter_stream_deltas(upstream):
+                if kind == 'reasoning':
+                    yield sse_event('reasoning', {'text': text})
+                    continue
+                raw_parts.append(text)
+                visible = cleaner.feed(text) if cleaner else text
+                if visible:
+                    yield sse_event('delta', {'text': visible})
+                if fields:
+                    for key, value in fields.feed(text):
+                        if key in aspects and value is not None:
+                            yield sse_event('field', {'key': key, 'value': value})
+                if translation:
+                    translation.feed(visible)
+                    for translated in translation.ready():
+                        yield sse_event('translation', {'text': translated})
+            if cleaner:
+                tail = cleaner.finish()
+                if tail:
+                    yield sse_event('delta', {'text': tail})
+                    if translation:
+                        translation.feed(tail)
+
+            # The final pass applies the rules that need the whole text
+            done = {'cached': False}
+            if fields:
+                with metrics.span('postprocess'):
+                    final_prompt, done['json_report'] = fields.result(aspects)
+                    if final_prompt is None:
+                        final_prompt = clean_prompt("".join(raw_parts), True)
+                if not isinstance(final_prompt, str):
+                    remember_result(params, final_prompt)
+            else:
+                final_prompt = postprocess_prompt("".join(raw_parts), False)
+                remember_result(params, final_prompt)
+            end_time = time.time()
+            if params['mode'] == 'mapreduce':
+                timings['reduce_seconds'] = round(end_time - start_time, 3)
+            timings['total_seconds'] = round(end_time - request_start_time, 3)
+            timings['image_tokens'] = metrics.image_tokens_sent()
+            if translation:
+                done.update(translation_fields(lambda: translation.finish(final_prompt)))
+                timings['translation_lag_seconds'] = round(time.time() - end_time, 3)
+            done.update(final_prompt=final_prompt, timings=timings)
+            yield sse_event('done', done)
+        except Exception as e:
+            print(f"Error in streamed fusion: {e}")
+            yield sse_event('error', {'error': format_generation_error(e)})
+
+    singleflight.start_stream('generate_stream', params['flight_key'], flight, events())
+    return sse_response(flight.follow())
+
+def upload_settings():
+    # Target the web UI resizes to before upload; uploads matching it skip server-side re-encoding
+    return {
+        'max_size': MAX_SIZE,
+        'quality': JPEG_QUALITY / 100,
+        'types': ['image/webp', 'image/jpeg'],
+        'max_upload_bytes': MAX_UPLOAD_BYTES,
+        'max_image_pixels': MAX_IMAGE_PIXELS,
+    }
+
+@app.route('/images', methods=['POST'])
+def upload_images():
+    with metrics.span('upload_parse'):
+        files = request.files.getlist('images')
+    if not files:
+        return jsonify({'error': 'No images uploaded'}), 400
+    body, status = store_images(files)
+    return jsonify(body), status
+
+@app.route('/upload/config', methods=['GET'])
+def upload_config():
+    return jsonify(upload_settings())
 
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
     return jsonify({
-        'final_prompt': final_prompt,
-        'individual_prompts': individual_prompts
+        'result_cache': result_cache.stats(),
+        'image_cache': image_cache.stats(),
+        'image_store': image_store.stats(),
+        'translation_memory': translation_memory.stats(),
+        'analysis_cache': analysis_cache.stats(),
+        'near_duplicates': near_duplicates.stats(),
+        'context_cache': context_cache.stats() if context_cache else None,
+        'ark_pool': ark.stats(),
+        'decode_budget': decode_budget.stats(),
+        'singleflight': singleflight.stats()
     })
 
-@app.route('/translate', methods=['POST'])
-def translate():
-    data = request.json
-    text = data.get('text')
-    
-    if not text:
-        return jsonify({'error': 'No text provided'}), 400
+def decode_job_image(value):
+    # Accepts plain base64 or a data URL
+    if value.startswith('data:'):
+        value = value.split(',', 1)[-1]
+    return io.BytesIO(base64.b64decode(value, validate=True))
 
-    if not client:
-        return jsonify({'error': 'Ark client is not initialized. Please check ARK_API_KEY.'}), 500
+def prepare_job_payload(job):
+    # Validates one submitted job and encodes its images up front, so queued payloads stay small
+    # and bad uploads are rejected at submit time. Raises ValueError with a user-facing message.
+    if not isinstance(job, dict):
+        raise ValueError('Each job must be an object')
+    images = job.get('images')
+    if not images or not isinstance(images, list):
+        raise ValueError('Each job needs a non-empty "images" list')
+    options_map = job.get('options')
+    if not isinstance(options_map, dict):
+        raise ValueError('Each job needs an "options" object')
+    precision = str(job.get('precision', '2'))
+    use_thinking = bool(job.get('thinking', True))
+    json_output = bool(job.get('json_output', False))
 
     try:
-        # Create a new translation prompt
-        prompt = f"""
+        files = [decode_job_image(value) for value in images]
+    except (TypeError, ValueError):
+        raise ValueError('Images must be base64 strings or data URLs')
+    image_hashes = [sha256_file(f) for f in files]
+    try:
+        encoded_images, hints = encode_fusion_images(files, options_map, precision, image_hashes)
+    except Exception as e:
+        raise ValueError(f'Invalid image: {e}')
+
+    return {
+        'encoded_images': encoded_images,
+        'hints': hints,
+        'options_map': options_map,
+        'precision': precision,
+        'use_thinking': use_thinking,
+        'json_output': json_output,
+        'cache_key': request_fingerprint(image_hashes, options_map, precision, use_thinking, json_output, MODEL_ID),
+    }
+
+def run_fusion_job(payload):
+    # Runs on a job worker thread; exceptions mark the job as failed
+    cached_prompt = result_cache.get(payload['cache_key'])
+    if cached_prompt is not None:
+        result = {'final_prompt': cached_prompt, 'cached': True}
+        if payload['json_output']:
+            result['final_prompt'], result['json_report'] = cached_json_prompt(cached_prompt, payload['options_map'])
+        return result
+    if not ark.available:
+        raise RuntimeError('Ark client is not initialized. Please check ARK_API_KEY.')
+
+    with metrics.span('prompt_assembly'):
+        messages = prompt_templates.build_fusion_messages(
+            payload['encoded_images'], payload['options_map'], payload['precision'], payload['json_output'],
+            payload.get('hints')
+        )
+    record_image_tokens('fusion', payload['encoded_images'])
+    try:
+        deadline = request_deadline(payload['precision'], payload['use_thinking'], DEADLINE_SCALE)
+        response = create_fusion_completion(messages, payload['use_thinking'], deadline=deadline)
+    except Overloaded:
+        raise
+    except Exception as e:
+        raise RuntimeError(format_generation_error(e))
+    content = response.choices[0].message.content
+    if payload['json_output']:
+        final_prompt, json_report = postprocess_json(content, payload['options_map'])
+        if not isinstance(final_prompt, str):
+            result_cache.set(payload['cache_key'], final_prompt)
+        return {'final_prompt': final_prompt, 'json_report': json_report, 'cached': False}
+    final_prompt = postprocess_prompt(content, False)
+    result_cache.set(payload['cache_key'], final_prompt)
+    return {'final_prompt': final_prompt, 'cached': False}
+
+# Jobs rejected by admission control go back to the queue instead of failing
+job_queue = JobQueue(JOBS_DB, run_fusion_job, workers=JOBS_PARALLELISM, retry_on=(Overloaded,))
+
+def start_process():
+    # Per-process background work. gunicorn.conf.py imports the app once in the master
+    # (preload_app) and calls this in every worker after fork, since threads do not survive
+    # a fork; under any other server it runs at import.
+    job_queue.start()
+
+def preload_modules():
+    # Imports otherwise left for the first request: the Ark SDK (and httpcore) and Pillow's
+    # format plugins. Done in the gunicorn master with preload_app, and by the ASGI app at startup.
+    load_sdk()
+    Image.init()
+
+def warm_up(connections):
+    # Imports the Ark SDK and opens upstream connections in the background, so the worker
+    # serves immediately and the first generation skips the SDK import and TLS handshakes
+    thread = threading.Thread(target=ark.warm_up, args=(connections,), name="ark-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+if os.getenv("DEFER_PROCESS_START", "false").lower() != "true":
+    start_process()
+
+def submit_jobs(data):
+    # Shared by the Flask and ASGI front ends; returns (body, status)
+    jobs = data.get('jobs') if isinstance(data, dict) else None
+    if not jobs or not isinstance(jobs, list):
+        return {'error': 'No jobs provided'}, 400
+    if len(jobs) > JOBS_MAX_BATCH:
+        return {'error': f'Too many jobs in one batch (max {JOBS_MAX_BATCH})'}, 400
+
+    payloads = []
+    for index, job in enumerate(jobs):
+        try:
+            payloads.append(prepare_job_payload(job))
+        except ValueError as e:
+            return {'error': f'Job {index}: {e}'}, 400
+
+    batch_id, job_ids = job_queue.submit(payloads)
+    return {'batch_id': batch_id, 'job_ids': job_ids}, 202
+
+def ndjson_lines(jobs):
+    for job in jobs:
+        yield json.dumps(job, ensure_ascii=False) + "\n"
+
+@app.route('/jobs', methods=['POST'])
+def create_jobs():
+    body, status = submit_jobs(request.get_json(silent=True))
+    return jsonify(body), status
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/jobs/batches/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    jobs = job_queue.batch(batch_id)
+    if not jobs:
+        return jsonify({'error': 'Batch not found'}), 404
+    return jsonify({'batch_id': batch_id, 'jobs': jobs})
+
+@app.route('/jobs/batches/<batch_id>/stream', methods=['GET'])
+def stream_batch(batch_id):
+    # One JSON line per job as it finishes; the response ends when the whole batch is done
+    if not job_queue.batch(batch_id):
+        return jsonify({'error': 'Batch not found'}), 404
+    return Response(
+        stream_with_context(ndjson_lines(job_queue.follow(batch_id))),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/jobs/stats', methods=['GET'])
+def job_stats():
+    return jsonify(job_queue.stats())
+
+def build_translation_prompt(text):
+    return f"""
 你是一个专业的AI翻译助手。请将以下中文提示词翻译成英文提示词（Stable Diffusion/Midjourney格式）。
 
 中文内容：
@@ -580,24 +1168,204 @@ def translate():
 1. **严格直译**：逐字逐句翻译，严禁添加任何额外的修饰词、风格描述或细节！
 2. **格式**：使用英文逗号分隔的单词或短语。
 3. **一致性**：英文内容必须与中文内容完全对应，不能多也不能少。
+4. **保持行数**：中文内容有几行，英文就输出几行，逐行对应，不要合并或拆分行。
 
 请直接输出英文翻译结果，不要有任何其他文字。
 """
-        response = client.chat.completions.create(
+
+def translate_text(text, deadline=None):
+    response = ark.chat_completion(
+        'translate',
+        deadline=deadline,
+        model=MODEL_ID,
+        messages=[
+            {"role": "user", "content": build_translation_prompt(text)}
+        ],
+        extra_body={
+            "thinking": {"type": "disabled"}
+        }
+    )
+    return response.choices[0].message.content.strip()
+
+def read_translate_text(data):
+    # Returns (text, error) for a /translate body, error as (body, status); shared with the ASGI app
+    text = data.get('text') if isinstance(data, dict) else None
+    if not text:
+        return None, ({'error': 'No text provided'}, 400)
+    return text, None
+
+def remembered_translation(text):
+    # (segments, translation) with the translation only when every segment is in the translation
+    # memory; blocking (SQLite), shared with the ASGI app
+    segments = split_segments(text)
+    cached = translation_memory.lookup(segments)
+    if segments and all(value is not None for value in cached):
+        translation_memory.record_request(0)
+        return segments, "\n".join(cached)
+    return segments, None
+
+@app.route('/translate', methods=['POST'])
+def translate():
+    text, error = read_translate_text(request.json)
+    if error:
+        return jsonify(error[0]), error[1]
+
+    if not ark.available:
+        return jsonify({'error': 'Ark client is not initialized. Please check ARK_API_KEY.'}), 500
+
+    try:
+        deadline = translation_deadline(DEADLINE_SCALE)
+        translated_text = singleflight.do(
+            'translate', text, lambda: translation_memory.translate(text, lambda chunk: translate_text(chunk, deadline))
+        )
+        return jsonify({'translated_text': translated_text})
+
+    except Overloaded:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/translate/stream', methods=['POST'])
+def translate_stream():
+    text, error = read_translate_text(request.json)
+    if error:
+        return jsonify(error[0]), error[1]
+
+    # Fully remembered texts are answered from the translation memory without streaming
+    segments, cached = remembered_translation(text)
+    if cached is not None:
+        return sse_response(iter([sse_event('done', {'translated_text': cached, 'cached': True})]))
+
+    if not ark.available:
+        return jsonify({'error': 'Ark client is not initialized. Please check ARK_API_KEY.'}), 500
+
+    flight, leader = singleflight.join_stream('translate_stream', text)
+    if not leader:
+        return sse_response(flight.follow())
+
+    # Admission happens before the response starts so a rejection is still a plain 429
+    try:
+        upstream = ark.chat_completion(
+            'translate',
+            deadline=translation_deadline(DEADLINE_SCALE),
             model=MODEL_ID,
             messages=[
-                {"role": "user", "content": prompt}
+                {"role": "user", "content": build_translation_prompt(text)}
             ],
             extra_body={
                 "thinking": {"type": "disabled"}
-            }
+            },
+            stream=True
         )
-        translated_text = response.choices[0].message.content.strip()
-        return jsonify({'translated_text': translated_text})
-
+    except Overloaded as e:
+        singleflight.end_stream('translate_stream', text, flight, sse_event('error', overloaded_response(e)[0]))
+        raise
     except Exception as e:
+        singleflight.end_stream('translate_stream', text, flight, sse_event('error', {'error': str(e)}))
         return jsonify({'error': str(e)}), 500
 
+    def events():
+        parts = []
+        try:
+            for kind, delta in iter_stream_deltas(upstream):
+                if kind == 'delta':
+                    parts.append(delta)
+                    yield sse_event('delta', {'text': delta})
+            translated_text = "".join(parts).strip()
+            translation_memory.learn(segments, translated_text)
+            yield sse_event('done', {'translated_text': translated_text, 'cached': False})
+        except Exception as e:
+            yield sse_event('error', {'error': str(e)})
+
+    singleflight.start_stream('translate_stream', text, flight, events())
+    return sse_response(flight.follow())
+
+def overloaded_response(e):
+    # (body, headers) for a rejection from admission control; shared with the ASGI app
+    if e.reason == 'circuit_open':
+        message = format_generation_error(Exception("SetLimitExceeded"))
+    else:
+        message = f"【系统提示】当前请求较多，请 {math.ceil(e.retry_after)} 秒后重试。"
+    retry_after = math.ceil(e.retry_after)
+    return {'error': message, 'reason': e.reason, 'retry_after': retry_after}, {'Retry-After': str(retry_after)}
+
+@app.errorhandler(Overloaded)
+def handle_overloaded(e):
+    # Fast rejection: clients should retry after the given delay
+    body, headers = overloaded_response(e)
+    return jsonify(body), 429, headers
+
+def upload_too_large_body(reason, message=None):
+    # Shared with the ASGI app
+    metrics.uploads_rejected_total.inc(reason=reason)
+    if reason == 'body_size':
+        message = f"上传内容过大，单次请求最多 {MAX_UPLOAD_BYTES // (1024 * 1024)} MB，请压缩图片或分批上传。"
+    return {'error': message, 'reason': reason}
+
+@app.errorhandler(413)
+def handle_request_too_large(e):
+    return jsonify(upload_too_large_body('body_size')), 413
+
+@app.errorhandler(UploadTooLarge)
+def handle_upload_too_large(e):
+    return jsonify(upload_too_large_body(e.reason, str(e))), 413
+
+@app.route('/admission/stats', methods=['GET'])
+def admission_stats():
+    return jsonify(admission.stats())
+
+# Metrics owned by other components, read when /metrics is scraped
+metrics.registry.callback('prompt_fusion_admission_in_flight', 'Ark calls currently admitted.',
+                          lambda: admission.stats()['in_flight'])
+metrics.registry.callback('prompt_fusion_admission_waiting', 'Callers queued for admission.',
+                          lambda: admission.stats()['waiting'])
+metrics.registry.callback('prompt_fusion_admission_rejected_total', 'Calls rejected by admission control.',
+                          lambda: admission.stats()['rejected'], ('reason',), kind='counter')
+metrics.registry.callback('prompt_fusion_upstream_calls_total', 'Retries, hedges and deadline expiries of Ark calls.',
+                          lambda: ark.counters.stats(), ('event',), kind='counter')
+metrics.registry.callback('prompt_fusion_upstream_connections_opened_total', 'Connections opened by the Ark pools.',
+                          lambda: {'sync': ark.metrics.connections_opened, 'async': ark.async_metrics.connections_opened},
+                          ('pool',), kind='counter')
+metrics.registry.callback('prompt_fusion_cache_lookups_total', 'Cache lookups by cache and result.', lambda: {
+    (name, result): cache.stats()[result]
+    for name, cache in (('result', result_cache), ('analysis', analysis_cache), ('image', image_cache),
+                        ('image_store', image_store))
+    for result in ('hits', 'misses')
+}, ('cache', 'result'), kind='counter')
+metrics.registry.callback('prompt_fusion_decode_memory_bytes', 'Decode memory budget reserved by image decodes.',
+                          lambda: decode_budget.stats()['in_use'])
+metrics.registry.callback('prompt_fusion_decode_waiting', 'Image decodes waiting for the decode memory budget.',
+                          lambda: decode_budget.stats()['waiting'])
+metrics.registry.callback('prompt_fusion_jobs', 'Batch jobs by status.', lambda: {
+    status: count for status, count in job_queue.stats().items() if status in ('queued', 'running', 'done', 'error')
+}, ('status',))
+
+def request_route():
+    # The URL rule keeps label cardinality bounded (/jobs/<job_id>, not every job ID)
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+@app.before_request
+def start_request_trace():
+    if request.path == '/metrics':
+        metrics.clear_trace()
+    else:
+        metrics.start_trace(request.method, request.path, request.headers.get(metrics.REQUEST_ID_HEADER))
+
+@app.after_request
+def finish_request_trace(response):
+    trace = metrics.current_trace()
+    if trace is None or trace.finished:
+        return response
+    response.headers[metrics.REQUEST_ID_HEADER] = trace.request_id
+    # Streamed bodies are still being generated here; log once the server has sent them
+    route = request_route()
+    response.call_on_close(lambda: metrics.finish_trace(trace, response.status_code, route))
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5001))
     app.run(debug=True, host='0.0.0.0', port=port)
@@ -0,0 +1,526 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+import weakref
+
+import httpx
+
+import metrics
+from admission import Overloaded, estimate_tokens, usage_tokens
+from resilience import CallCounters, Deadline, DeadlineExceeded, DeadlineStream, LatencyTracker, backoff_delay, is_retryable
+
+# Read timeouts per kind of call (seconds between bytes from upstream, not total duration; the
+# request deadline bounds that, streams included).
+# Multi-image fusion with thinking is the slowest; translation is short text in, short text out.
+DEFAULT_TIMEOUTS = {
+    'fusion': 600,
+    'analyze': 180,
+    'merge': 300,
+    'translate': 60,
+}
+
+# Expected completion size per kind of call, for admission control before the real usage is known
+COMPLETION_TOKEN_ESTIMATES = {
+    'fusion': 1500,
+    'analyze': 1200,
+    'merge': 1500,
+    'translate': 800,
+}
+
+
+class PoolMetrics:
+    # Counts upstream HTTP requests and how many connections the pool had to open for them.
+    # A request stays in flight until its response body is closed, so streams count until done.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seen_connections = weakref.WeakSet()
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.errors = 0
+        self.connections_opened = 0
+        self.headers_seconds = 0.0
+
+    def started(self):
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def responded(self, pool, elapsed):
+        with self._lock:
+            self.headers_seconds += elapsed
+            for connection in pool.connections:
+                if connection not in self._seen_connections:
+                    self._seen_connections.add(connection)
+                    self.connections_opened += 1
+
+    def finished(self, failed=False):
+        with self._lock:
+            self.in_flight -= 1
+            if failed:
+                self.errors += 1
+
+    def stats(self, pool=None):
+        connections = list(pool.connections) if pool is not None else []
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'in_flight': self.in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                'errors': self.errors,
+                'connections_open': len(connections),
+                'connections_idle': sum(1 for c in connections if c.is_idle()),
+                'connections_opened': self.connections_opened,
+                # Requests served on an already open connection (no TCP/TLS handshake)
+                'connection_reuse_ratio': round(1 - self.connections_opened / self.requests, 4) if self.requests else 0.0,
+                'avg_time_to_headers': round(self.headers_seconds / self.requests, 4) if self.requests else 0.0,
+            }
+
+
+class _MeteredStream(httpx.SyncByteStream):
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            if self._on_close:
+                self._on_close()
+                self._on_close = None
+
+
+class _AsyncMeteredStream(httpx.AsyncByteStream):
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._on_close:
+                self._on_close()
+                self._on_close = None
+
+
+class MeteredTransport(httpx.HTTPTransport):
+    def __init__(self, metrics, **kwargs):
+        super().__init__(**kwargs)
+        self.metrics = metrics
+
+    def handle_request(self, request):
+        self.metrics.started()
+        start_time = time.perf_counter()
+        try:
+            response = super().handle_request(request)
+        except Exception:
+            self.metrics.finished(failed=True)
+            raise
+        self.metrics.responded(self._pool, time.perf_counter() - start_time)
+        response.stream = _MeteredStream(response.stream, lambda: self.metrics.finished(response.status_code >= 400))
+        return response
+
+
+class AsyncMeteredTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, metrics, **kwargs):
+        super().__init__(**kwargs)
+        self.metrics = metrics
+
+    async def handle_async_request(self, request):
+        self.metrics.started()
+        start_time = time.perf_counter()
+        try:
+            response = await super().handle_async_request(request)
+        except Exception:
+            self.metrics.finished(failed=True)
+            raise
+        self.metrics.responded(self._pool, time.perf_counter() - start_time)
+        response.stream = _AsyncMeteredStream(response.stream, lambda: self.metrics.finished(response.status_code >= 400))
+        return response
+
+
+def load_sdk():
+    # The Ark SDK (with the pydantic models under it) is most of the app's import time, so it is
+    # imported when the first client is built; gunicorn.conf.py imports it in the master instead.
+    # httpx imports its transport (httpcore) only when the first one is created, so that too.
+    import httpcore  # noqa: F401
+    from volcenginesdkarkruntime import Ark, AsyncArk
+    return Ark, AsyncArk
+
+
+def http2_available():
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class ArkClients:
+    # One lazily built Ark client (and one AsyncArk for the ASGI app) per process, each over an
+    # explicitly sized keep-alive pool. httpx clients are thread safe, so every request thread
+    # shares the same connections and TLS sessions instead of handshaking per call.
+    # All upstream calls go through chat_completion/context_completion so timeouts, admission
+    # control (see admission.py), retries and hedging live in one place.
+    # Each call takes an optional Deadline shared by the whole user request: attempts are cut to
+    # the remaining budget and transient failures are retried with jittered backoff while it lasts.
+    # With hedging on, a non-streaming call without thinking (translation, per-image analysis) that
+    # is still running after the endpoint's p95 latency gets a second identical request, and the
+    # first answer wins.
+
+    def __init__(self, api_key, base_url, max_connections=64, max_keepalive=None, keepalive_expiry=60,
+                 async_max_connections=None, http2=False, connect_timeout=10, timeouts=None, max_retries=2,
+                 admission=None, hedging=False):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive if max_keepalive is not None else max_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        # The asyncio app keeps far more calls in flight than the thread pool can
+        async_max_connections = async_max_connections or max_connections
+        self.async_limits = httpx.Limits(
+            max_connections=async_max_connections,
+            max_keepalive_connections=async_max_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        if http2 and not http2_available():
+            print("Warning: ARK_HTTP2 requested but the 'h2' package is not installed, using HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+        self.connect_timeout = connect_timeout
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+        self.max_retries = max_retries
+        self.admission = admission
+        self.hedging = hedging
+        self.latency = LatencyTracker()
+        self.counters = CallCounters()
+        self._hedge_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="ark-call")
+        self.metrics = PoolMetrics()
+        self.async_metrics = PoolMetrics()
+        self._lock = threading.Lock()
+        self._client = None
+        self._async_client = None
+        self._transport = None
+        self._async_transport = None
+        self._http_client = None
+        self._async_http_client = None
+
+    @property
+    def available(self):
+        return bool(self.api_key) and self.client is not None
+
+    def timeout(self, endpoint):
+        return httpx.Timeout(self.timeouts.get(endpoint, self.timeouts['fusion']), connect=self.connect_timeout)
+
+    @property
+    def client(self):
+        if self._client is None and self.api_key:
+            with self._lock:
+                if self._client is None:
+                    try:
+                        Ark, _ = load_sdk()
+                        self._transport = MeteredTransport(self.metrics, limits=self.limits, http2=self.http2)
+                        self._http_client = httpx.Client(transport=self._transport, timeout=self.timeout('fusion'))
+                        self._client = Ark(
+                            api_key=self.api_key,
+                            base_url=self.base_url,
+                            timeout=self.timeout('fusion'),
+                            max_retries=0,  # retries are done here, within the request deadline
+                            http_client=self._http_client,
+                        )
+                    except Exception as e:
+                        print(f"Warning: Failed to initialize Ark client: {e}")
+        return self._client
+
+    @property
+    def async_client(self):
+        # Must first be used from inside the serving event loop
+        if self._async_client is None and self.api_key:
+            with self._lock:
+                if self._async_client is None:
+                    try:
+                        _, AsyncArk = load_sdk()
+                        self._async_transport = AsyncMeteredTransport(self.async_metrics, limits=self.async_limits, http2=self.http2)
+                        self._async_http_client = httpx.AsyncClient(transport=self._async_transport, timeout=self.timeout('fusion'))
+                        self._async_client = AsyncArk(
+                            api_key=self.api_key,
+                            base_url=self.base_url,
+                            timeout=self.timeout('fusion'),
+                            max_retries=0,  # retries are done here, within the request deadline
+                            http_client=self._async_http_client,
+                        )
+                    except Exception as e:
+                        print(f"Warning: Failed to initialize async Ark client: {e}")
+        return self._async_client
+
+    def warm_up(self, connections):
+        # Builds the client and opens `connections` pooled keep-alive connections (TCP + TLS) with
+        # concurrent HEAD requests, so the first generations do not pay for the handshakes.
+        # Any HTTP status will do; returns the number of connections that answered.
+        if connections <= 0 or self.client is None:
+            return 0
+        ping = lambda _: self._http_client.head(self.base_url, timeout=self.connect_timeout)
+        opened = 0
+        futures = [self._hedge_pool.submit(ping, i) for i in range(connections)]
+        for future in futures:
+            try:
+                future.result()
+                opened += 1
+            except httpx.HTTPError as e:
+                print(f"Warning: Upstream warm-up request failed: {e}")
+        return opened
+
+    async def awarm_up(self, connections):
+        # warm_up for the AsyncArk pool; must run inside the serving event loop
+        if connections <= 0 or self.async_client is None:
+            return 0
+        results = await asyncio.gather(*(
+            self._async_http_client.head(self.base_url, timeout=self.connect_timeout) for _ in range(connections)
+        ), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Warning: Upstream warm-up request failed: {result}")
+        return sum(1 for result in results if not isinstance(result, Exception))
+
+    def _estimate(self, endpoint, kwargs):
+        return estimate_tokens(kwargs.get('messages', []), COMPLETION_TOKEN_ESTIMATES.get(endpoint, 1000))
+
+    def _attempt_timeout(self, endpoint, deadline):
+        remaining = deadline.remaining()
+        if remaining <= 0:
+            self.counters.add('deadline_exceeded')
+            raise DeadlineExceeded(deadline.seconds)
+        return httpx.Timeout(min(self.timeouts.get(endpoint, self.timeouts['fusion']), remaining),
+                             connect=min(self.connect_timeout, remaining))
+
+    def _should_hedge(self, endpoint, kwargs):
+        if not self.hedging or kwargs.get('stream'):
+            return False
+        thinking = (kwargs.get('extra_body') or {}).get('thinking', {}).get('type')
+        return endpoint == 'translate' or thinking == 'disabled'
+
+    def _retry_delay(self, e, attempt, deadline):
+        # Seconds to sleep before the next attempt, or None to give up
+        if not is_retryable(e) or attempt >= self.max_retries:
+            return None
+        delay = backoff_delay(attempt)
+        if deadline.remaining() < delay + 1:
+            return None
+        self.counters.add('retries')
+        print(f"Warning: Retrying upstream call in {delay:.2f}s after: {e}")
+        return delay
+
+    def _attempt(self, endpoint, create, kwargs, deadline, queue=True):
+        timeout = self._attempt_timeout(endpoint, deadline)
+        tokens = self._estimate(endpoint, kwargs)
+        ticket = None
+        if self.admission:
+            if queue:
+                ticket = self.admission.acquire(tokens, timeout=deadline.remaining())
+            else:
+                ticket = self.admission.try_acquire(tokens)
+                if ticket is None:
+                    raise Overloaded('no_slot', 1)
+
+        metrics.record_image_bytes(endpoint, kwargs.get('messages', []))
+        start_time = time.perf_counter()
+        try:
+            response = create(timeout=timeout, **kwargs)
+        except Exception as e:
+            metrics.record_upstream(endpoint, None, time.perf_counter() - start_time, 'error')
+            if self.admission:
+                self.admission.release(ticket, error=e)
+            raise
+        if kwargs.get('stream'):
+            # The slot is held until the caller has consumed the stream, which ends at the deadline
+            response = DeadlineStream(response, deadline, lambda: self.counters.add('deadline_exceeded'))
+            response = metrics.TimedStream(response, endpoint, start_time)
+            return self.admission.guard_stream(response, ticket) if self.admission else response
+        self._record(endpoint, response, time.perf_counter() - start_time)
+        if self.admission:
+            self.admission.release(ticket, usage_tokens(response))
+        return response
+
+    def _record(self, endpoint, response, seconds):
+        # Non-streaming responses arrive in one piece, so time to first byte is the whole call
+        self.latency.record(endpoint, seconds)
+        metrics.record_upstream(endpoint, seconds, seconds)
+        metrics.record_usage(endpoint, getattr(response, 'usage', None))
+
+    def _hedged(self, endpoint, create, kwargs, deadline):
+        delay = self.latency.p95(endpoint)
+        if delay is None or delay >= deadline.remaining():
+            return self._attempt(endpoint, create, kwargs, deadline)
+
+        attempt = metrics.propagate(self._attempt)
+        primary = self._hedge_pool.submit(attempt, endpoint, create, kwargs, deadline)
+        try:
+            return primary.result(timeout=delay)
+        except concurrent.futures.TimeoutError:
+            pass
+
+        # The hedge never queues for admission; without a free slot we keep waiting on the primary
+        hedge = self._hedge_pool.submit(attempt, endpoint, create, kwargs, deadline, False)
+        self.counters.add('hedges')
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, timeout=deadline.remaining() + 1, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self.counters.add('hedge_wins')
+                    # The loser cannot be cancelled mid-request; it finishes in the background
+                    self.counters.add('wasted_calls', len(pending))
+                    return future.result()
+                if future is primary or not isinstance(future.exception(), Overloaded):
+                    error = future.exception()
+        raise error or DeadlineExceeded(deadline.seconds)
+
+    def _call(self, endpoint, create, kwargs, deadline):
+        deadline = deadline or Deadline(self.timeouts.get(endpoint, self.timeouts['fusion']))
+        if kwargs.get('stream'):
+            # Ask for a final usage chunk so streamed calls report tokens too
+            kwargs.setdefault('stream_options', {'include_usage': True})
+        attempt = 0
+        while True:
+            try:
+                if self._should_hedge(endpoint, kwargs):
+                    return self._hedged(endpoint, create, kwargs, deadline)
+                return self._attempt(endpoint, create, kwargs, deadline)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    raise
+            attempt += 1
+            time.sleep(delay)
+
+    async def _aattempt(self, endpoint, create, kwargs, deadline, queue=True):
+        timeout = self._attempt_timeout(endpoint, deadline)
+        tokens = self._estimate(endpoint, kwargs)
+        ticket = None
+        if self.admission:
+            if queue:
+                ticket = await self.admission.aacquire(tokens, timeout=deadline.remaining())
+            else:
+                ticket = self.admission.try_acquire(tokens)
+                if ticket is None:
+                    raise Overloaded('no_slot', 1)
+
+        metrics.record_image_bytes(endpoint, kwargs.get('messages', []))
+        start_time = time.perf_counter()
+        try:
+            response = await create(timeout=timeout, **kwargs)
+        except BaseException as e:
+            # Includes cancellation of a losing hedge
+            metrics.record_upstream(endpoint, None, time.perf_counter() - start_time,
+                                    'error' if isinstance(e, Exception) else 'cancelled')
+            if self.admission:
+                self.admission.release(ticket, error=e if isinstance(e, Exception) else None)
+            raise
+        if kwargs.get('stream'):
+            response = DeadlineStream(response, deadline, lambda: self.counters.add('deadline_exceeded'))
+            response = metrics.TimedStream(response, endpoint, start_time)
+            return self.admission.guard_async_stream(response, ticket) if self.admission else response
+        self._record(endpoint, response, time.perf_counter() - start_time)
+        if self.admission:
+            self.admission.release(ticket, usage_tokens(response))
+        return response
+
+    async def _ahedged(self, endpoint, create, kwargs, deadline):
+        delay = self.latency.p95(endpoint)
+        if delay is None or delay >= deadline.remaining():
+            return await self._aattempt(endpoint, create, kwargs, deadline)
+
+        primary = asyncio.ensure_future(self._aattempt(endpoint, create, kwargs, deadline))
+        try:
+            return await asyncio.wait_for(asyncio.shield(primary), delay)
+        except asyncio.TimeoutError:
+            pass
+
+        hedge = asyncio.ensure_future(self._aattempt(endpoint, create, kwargs, deadline, False))
+        self.counters.add('hedges')
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=deadline.remaining() + 1, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    break
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.counters.add('hedge_wins')
+                        self.counters.add('wasted_calls', len(pending))
+                        return task.result()
+                    if task is primary or not isinstance(task.exception(), Overloaded):
+                        error = task.exception()
+            raise error or DeadlineExceeded(deadline.seconds)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _acall(self, endpoint, create, kwargs, deadline):
+        deadline = deadline or Deadline(self.timeouts.get(endpoint, self.timeouts['fusion']))
+        if kwargs.get('stream'):
+            # Ask for a final usage chunk so streamed calls report tokens too
+            kwargs.setdefault('stream_options', {'include_usage': True})
+        attempt = 0
+        while True:
+            try:
+                if self._should_hedge(endpoint, kwargs):
+                    return await self._ahedged(endpoint, create, kwargs, deadline)
+                return await self._aattempt(endpoint, create, kwargs, deadline)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    raise
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def chat_completion(self, endpoint, deadline=None, **kwargs):
+        return self._call(endpoint, self.client.chat.completions.create, kwargs, deadline)
+
+    def context_completion(self, endpoint, deadline=None, **kwargs):
+        return self._call(endpoint, self.client.context.completions.create, kwargs, deadline)
+
+    async def achat_completion(self, endpoint, deadline=None, **kwargs):
+        return await self._acall(endpoint, self.async_client.chat.completions.create, kwargs, deadline)
+
+    async def acontext_completion(self, endpoint, deadline=None, **kwargs):
+        return await self._acall(endpoint, self.async_client.context.completions.create, kwargs, deadline)
+
+    def stats(self):
+        return {
+            'max_connections': self.limits.max_connections,
+            'max_keepalive_connections': self.limits.max_keepalive_connections,
+            'async_max_connections': self.async_limits.max_connections,
+            'http2': self.http2,
+            'timeouts': self.timeouts,
+            'max_retries': self.max_retries,
+            'hedging': self.hedging,
+            'calls': self.counters.stats(),
+            'latency': self.latency.stats(),
+            'sync': self.metrics.stats(self._transport._pool if self._transport else None),
+            'async': self.async_metrics.stats(self._async_transport._pool if self._async_transport else None),
+        }
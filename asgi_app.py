@@ -0,0 +1,683 @@
+# Asyncio serving mode: `uvicorn asgi_app:app` (or SERVE_MODE=asgi in Docker).
+# Upstream calls go through the SDK's AsyncArk client, so one worker can keep hundreds of
+# generations in flight instead of one per gunicorn thread. Image hashing/encoding runs in a
+# thread pool. Prompt building, caches and post-processing are shared with the Flask app.
+import asyncio
+import concurrent.futures
+import contextlib
+import os
+import time
+
+from starlette.applications import Starlette
+from starlette.formparsers import MultiPartParser
+from starlette.middleware import Middleware
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import app as flask_app
+import metrics
+from admission import Overloaded
+from bilingual import AsyncSpeculativeTranslation
+from image_preprocess import check_uploads
+from resilience import translation_deadline
+from result_cache import sha256_file
+from singleflight import AsyncStreamFlight
+from json_stream import JsonFieldStream, selected_aspects
+from streaming import StreamCleaner, aiter_stream_deltas, sse_event
+from upload_limits import UploadTooLarge
+
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", str(min(8, (os.cpu_count() or 1) * 2))))
+
+encode_pool = concurrent.futures.ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="encode")
+
+# Same spool threshold as the Flask app (Starlette's default is 1 MB)
+MultiPartParser.spool_max_size = flask_app.UPLOAD_SPOOL_BYTES
+
+# AsyncArk over its own keep-alive pool (ASGI_MAX_CONNECTIONS), built on first use inside the event loop
+ark = flask_app.ark
+singleflight = flask_app.singleflight
+
+CLIENT_MISSING_ERROR = {'error': 'Ark client is not initialized. Please check ARK_API_KEY.'}
+
+
+async def run_blocking(fn, *args):
+    # run_in_executor does not carry context variables over; propagate keeps spans on the request trace
+    return await asyncio.get_running_loop().run_in_executor(encode_pool, metrics.propagate(fn), *args)
+
+
+async def parse_generate_request(request):
+    # Mirrors app.parse_generate_request, with the same form validation; returns (params, error_response)
+    with metrics.span('upload_parse'):
+        form = await request.form()
+    uploads = [item for item in form.getlist('images') if hasattr(item, 'file')]
+    fields, error = flask_app.read_generate_form(form, bool(uploads))
+    if error:
+        return None, JSONResponse(error[0], status_code=error[1])
+
+    if uploads:
+        files = [upload.file for upload in uploads]
+        with metrics.span('upload_check'):
+            await run_blocking(check_uploads, files)
+        with metrics.span('upload_hash'):
+            image_hashes = await run_blocking(lambda: [sha256_file(f) for f in files])
+    else:
+        files, image_hashes, error = await run_blocking(flask_app.load_stored_images, form['image_ids'])
+        if error:
+            return None, JSONResponse(error[0], status_code=error[1])
+
+    return flask_app.generate_params(fields, files, image_hashes), None
+
+
+async def create_fusion_completion(params, stream=False):
+    messages = await run_blocking(
+        flask_app.build_fusion_messages,
+        params['images'], params['options_map'], params['precision'], params['json_output'],
+        params['image_hashes'],
+    )
+    extra_body = flask_app.thinking_options(params['use_thinking'])
+
+    context_cache = flask_app.context_cache
+    if context_cache:
+        context_id = await context_cache.acontext_id(ark.async_client, flask_app.MODEL_ID, messages[:1])
+        if context_id:
+            try:
+                return await ark.acontext_completion(
+                    'fusion',
+                    deadline=params['deadline'],
+                    context_id=context_id,
+                    model=flask_app.MODEL_ID,
+                    messages=messages[1:],
+                    extra_body=extra_body,
+                    stream=stream,
+                )
+            except Overloaded:
+                raise
+            except Exception as e:
+                print(f"Warning: Context completion failed, retrying without context cache: {e}")
+                context_cache.invalidate(context_cache.key(messages[:1]))
+
+    return await ark.achat_completion(
+        'fusion',
+        deadline=params['deadline'],
+        model=flask_app.MODEL_ID,
+        messages=messages,
+        extra_body=extra_body,
+        stream=stream,
+    )
+
+
+async def analyze_image(file, selected_aspects, precision_level, digest, deadline=None):
+    base64_image = await run_blocking(flask_app.encode_for_analysis, file, digest, selected_aspects, precision_level)
+    response = await ark.achat_completion(
+        'analyze',
+        deadline=deadline,
+        model=flask_app.MODEL_ID,
+        messages=flask_app.build_analysis_messages(base64_image, selected_aspects, precision_level),
+        extra_body=flask_app.thinking_options(False),
+    )
+    return response.choices[0].message.content
+
+
+def analysis_slots():
+    # At most MAPREDUCE_WORKERS analyses in flight across requests, like the Flask app's
+    # analysis_pool. Created per event loop: a semaphore is bound to the loop it first waits on.
+    global _analysis_slots
+    loop = asyncio.get_running_loop()
+    if _analysis_slots is None or _analysis_slots[0] is not loop:
+        _analysis_slots = (loop, asyncio.Semaphore(flask_app.MAPREDUCE_WORKERS))
+    return _analysis_slots[1]
+
+_analysis_slots = None
+
+
+async def analyze_missing(params, idx):
+    async with analysis_slots():
+        return await analyze_image(
+            params['images'][idx], params['options_map'].get(str(idx), []), params['precision'],
+            params['image_hashes'][idx], params['deadline']
+        )
+
+
+async def generate_mapreduce(params, stream=False):
+    # Mirrors app.generate_mapreduce; the map step fans out on the event loop, MAPREDUCE_WORKERS
+    # analyses at a time
+    start_time = time.time()
+    options_map, precision = params['options_map'], params['precision']
+    keys = flask_app.analysis_keys(options_map, precision, params['image_hashes'])
+    analyses = await run_blocking(lambda: [flask_app.analysis_cache.get(key) for key in keys])
+    missing = [idx for idx, analysis in enumerate(analyses) if analysis is None]
+
+    results = await asyncio.gather(*(analyze_missing(params, idx) for idx in missing))
+    for idx, analysis in zip(missing, results):
+        analyses[idx] = analysis
+    await run_blocking(lambda: [flask_app.analysis_cache.set(keys[idx], analyses[idx]) for idx in missing])
+    map_time = time.time()
+    timings = {'map_seconds': round(map_time - start_time, 3), 'analyses_reused': len(analyses) - len(missing)}
+    metrics.record_stage('mapreduce_map', map_time - start_time, analyses_reused=timings['analyses_reused'])
+
+    response = await ark.achat_completion(
+        'merge',
+        deadline=params['deadline'],
+        model=flask_app.MODEL_ID,
+        messages=[{"role": "user", "content": flask_app.build_merge_prompt(analyses, precision)}],
+        extra_body=flask_app.thinking_options(params['use_thinking']),
+        stream=stream,
+    )
+    if not stream:
+        end_time = time.time()
+        timings['reduce_seconds'] = round(end_time - map_time, 3)
+        timings['total_seconds'] = round(end_time - start_time, 3)
+        metrics.record_stage('mapreduce_reduce', end_time - map_time)
+    return response, analyses, timings
+
+
+async def translate_text(text, deadline=None):
+    response = await ark.achat_completion(
+        'translate',
+        deadline=deadline,
+        model=flask_app.MODEL_ID,
+        messages=[
+            {"role": "user", "content": flask_app.build_translation_prompt(text)}
+        ],
+        extra_body=flask_app.thinking_options(False),
+    )
+    return response.choices[0].message.content.strip()
+
+
+async def translate_batch(text):
+    return await translate_text(text, translation_deadline(flask_app.DEADLINE_SCALE))
+
+
+async def translation_fields(translate):
+    # Mirrors app.translation_fields; translate is an awaitable
+    try:
+        return {'translated_text': await translate}
+    except Exception as e:
+        print(f"Warning: Translation of the generated prompt failed: {e}")
+        return {'translation_error': str(e)}
+
+
+def speculative_translation():
+    return AsyncSpeculativeTranslation(flask_app.translation_memory, translate_batch)
+
+
+async def read_translating(upstream, translation):
+    # Mirrors app.read_translating
+    cleaner = StreamCleaner()
+    parts = []
+    async for kind, text in aiter_stream_deltas(upstream):
+        if kind == 'delta':
+            parts.append(text)
+            translation.feed(cleaner.feed(text))
+    translation.feed(cleaner.finish())
+    return "".join(parts)
+
+
+def sse_response(events):
+    return StreamingResponse(
+        events,
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+async def single_event(event, data):
+    yield sse_event(event, data)
+
+
+async def index(request):
+    return FileResponse(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'index.html'))
+
+
+async def generate(request):
+    params, error_response = await parse_generate_request(request)
+    if error_response:
+        return error_response
+
+    mapreduce = params['mode'] == 'mapreduce'
+    individual_prompts = ["(Direct Fusion Mode - Individual analysis skipped)"] * len(params['images'])
+
+    cached_prompt = await run_blocking(flask_app.lookup_result, params)
+    if cached_prompt is not None:
+        if mapreduce:
+            individual_prompts = await run_blocking(flask_app.cached_analyses, params)
+        body = {
+            'final_prompt': cached_prompt, 'individual_prompts': individual_prompts, 'cached': True, 'mode': params['mode'],
+        }
+        if params['near_duplicate']:
+            body['near_duplicate'] = True
+        if params['json_output']:
+            body['final_prompt'], body['json_report'] = flask_app.cached_json_prompt(cached_prompt, params['options_map'])
+        if params['bilingual']:
+            body.update(await translation_fields(flask_app.translation_memory.atranslate(cached_prompt, translate_batch)))
+        return JSONResponse(body)
+
+    if not ark.async_client:
+        return JSONResponse(CLIENT_MISSING_ERROR, status_code=500)
+
+    body = await singleflight.ado('generate', params['flight_key'], lambda: run_generation(params, individual_prompts))
+    return JSONResponse(body)
+
+
+async def run_generation(params, individual_prompts):
+    mapreduce = params['mode'] == 'mapreduce'
+    translation = speculative_translation() if params['bilingual'] else None
+    streamed = translation is not None
+    start_time = time.time()
+    timings = {}
+    json_report = None
+    translated = {}
+    try:
+        if mapreduce:
+            response, individual_prompts, timings = await generate_mapreduce(params, stream=streamed)
+        else:
+            response = await create_fusion_completion(params, stream=streamed)
+        if streamed:
+            content = await read_translating(response, translation)
+        else:
+            content = response.choices[0].message.content
+        if not mapreduce or streamed:
+            timings['total_seconds'] = round(time.time() - start_time, 3)
+        timings['image_tokens'] = metrics.image_tokens_sent()
+        if params['json_output']:
+            final_prompt, json_report = flask_app.postprocess_json(content, params['options_map'])
+        else:
+            final_prompt = flask_app.postprocess_prompt(content, False)
+        if not (json_report and isinstance(final_prompt, str)):
+            await run_blocking(flask_app.remember_result, params, final_prompt)
+        if translation is not None:
+            chinese_done = time.time()
+            translated = await translation_fields(translation.finish(final_prompt))
+            timings['translation_lag_seconds'] = round(time.time() - chinese_done, 3)
+    except Overloaded:
+        raise
+    except Exception as e:
+        print(f"Error in {params['mode']} fusion: {e}")
+        final_prompt = flask_app.format_generation_error(e)
+
+    body = {
+        'final_prompt': final_prompt, 'individual_prompts': individual_prompts, 'cached': False,
+        'mode': params['mode'], 'timings': timings,
+    }
+    if json_report:
+        body['json_report'] = json_report
+    body.update(translated)
+    return body
+
+
+async def generate_stream(request):
+    params, error_response = await parse_generate_request(request)
+    if error_response:
+        return error_response
+
+    cached_prompt = await run_blocking(flask_app.lookup_result, params)
+    if cached_prompt is not None:
+        done = {'final_prompt': cached_prompt, 'cached': True}
+        if params['near_duplicate']:
+            done['near_duplicate'] = True
+        if params['json_output']:
+            done['final_prompt'], done['json_report'] = flask_app.cached_json_prompt(cached_prompt, params['options_map'])
+        if params['bilingual']:
+            done.update(await translation_fields(flask_app.translation_memory.atranslate(cached_prompt, translate_batch)))
+        return sse_response(single_event('done', done))
+
+    if not ark.async_client:
+        return JSONResponse(CLIENT_MISSING_ERROR, status_code=500)
+
+    flight, leader = singleflight.join_stream('generate_stream', params['flight_key'], AsyncStreamFlight)
+    if not leader:
+        return sse_response(flight.follow())
+
+    json_output = params['json_output']
+    request_start_time = time.time()
+    timings = {}
+    try:
+        if params['mode'] == 'mapreduce':
+            upstream, _, timings = await generate_mapreduce(params, stream=True)
+        else:
+            upstream = await create_fusion_completion(params, stream=True)
+    except Overloaded as e:
+        singleflight.end_stream('generate_stream', params['flight_key'], flight,
+                                sse_event('error', flask_app.overloaded_response(e)[0]))
+        raise
+    except Exception as e:
+        error = flask_app.format_generation_error(e)
+        singleflight.end_stream('generate_stream', params['flight_key'], flight, sse_event('error', {'error': error}))
+        return JSONResponse({'error': error}, status_code=500)
+
+    async def events():
+        start_time = time.time()
+        raw_parts = []
+        cleaner = None if json_output else StreamCleaner()
+        fields = JsonFieldStream() if json_output else None
+        aspects = selected_aspects(params['options_map'])
+        translation = speculative_translation() if params['bilingual'] else None
+        try:
+            async for kind, text in aiter_stream_deltas(upstream):
+                if kind == 'reasoning':
+                    yield sse_event('reasoning', {'text': text})
+                    continue
+                raw_parts.append(text)
+                visible = cleaner.feed(text) if cleaner else text
+                if visible:
+                    yield sse_event('delta', {'text': visible})
+                if fields:
+                    for key, value in fields.feed(text):
+                        if key in aspects and value is not None:
+                            yield sse_event('field', {'key': key, 'value': value})
+                if translation:
+                    translation.feed(visible)
+                    for translated in translation.ready():
+                        yield sse_event('translation', {'text': translated})
+            if cleaner:
+                tail = cleaner.finish()
+                if tail:
+                    yield sse_event('delta', {'text': tail})
+                    if translation:
+                        translation.feed(tail)
+
+            done = {'cached': False}
+            if fields:
+                with metrics.span('postprocess'):
+                    final_prompt, done['json_report'] = fields.result(aspects)
+                    if final_prompt is None:
+                        final_prompt = flask_app.clean_prompt("".join(raw_parts), True)
+                if not isinstance(final_prompt, str):
+                    await run_blocking(flask_app.remember_result, params, final_prompt)
+            else:
+                final_prompt = flask_app.postprocess_prompt("".join(raw_parts), False)
+                await run_blocking(flask_app.remember_result, params, final_prompt)
+            end_time = time.time()
+            if params['mode'] == 'mapreduce':
+                timings['reduce_seconds'] = round(end_time - start_time, 3)
+            timings['total_seconds'] = round(end_time - request_start_time, 3)
+            timings['image_tokens'] = metrics.image_tokens_sent()
+            if translation:
+                done.update(await translation_fields(translation.finish(final_prompt)))
+                timings['translation_lag_seconds'] = round(time.time() - end_time, 3)
+            done.update(final_prompt=final_prompt, timings=timings)
+            yield sse_event('done', done)
+        except Exception as e:
+            print(f"Error in streamed fusion: {e}")
+            yield sse_event('error', {'error': flask_app.format_generation_error(e)})
+
+    singleflight.astart_stream('generate_stream', params['flight_key'], flight, events())
+    return sse_response(flight.follow())
+
+
+async def read_translate_text(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    return flask_app.read_translate_text(data)
+
+
+async def translate(request):
+    text, error = await read_translate_text(request)
+    if error:
+        return JSONResponse(error[0], status_code=error[1])
+
+    if not ark.async_client:
+        return JSONResponse(CLIENT_MISSING_ERROR, status_code=500)
+
+    try:
+        deadline = translation_deadline(flask_app.DEADLINE_SCALE)
+        translated_text = await singleflight.ado(
+            'translate', text, lambda: flask_app.translation_memory.atranslate(text, lambda chunk: translate_text(chunk, deadline))
+        )
+        return JSONResponse({'translated_text': translated_text})
+    except Overloaded:
+        raise
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+async def translate_stream(request):
+    text, error = await read_translate_text(request)
+    if error:
+        return JSONResponse(error[0], status_code=error[1])
+
+    # The translation memory is SQLite-backed; its reads and writes stay off the event loop
+    memory = flask_app.translation_memory
+    segments, cached = await run_blocking(flask_app.remembered_translation, text)
+    if cached is not None:
+        return sse_response(single_event('done', {'translated_text': cached, 'cached': True}))
+
+    if not ark.async_client:
+        return JSONResponse(CLIENT_MISSING_ERROR, status_code=500)
+
+    flight, leader = singleflight.join_stream('translate_stream', text, AsyncStreamFlight)
+    if not leader:
+        return sse_response(flight.follow())
+
+    try:
+        upstream = await ark.achat_completion(
+            'translate',
+            deadline=translation_deadline(flask_app.DEADLINE_SCALE),
+            model=flask_app.MODEL_ID,
+            messages=[
+                {"role": "user", "content": flask_app.build_translation_prompt(text)}
+            ],
+            extra_body=flask_app.thinking_options(False),
+            stream=True,
+        )
+    except Overloaded as e:
+        singleflight.end_stream('translate_stream', text, flight, sse_event('error', flask_app.overloaded_response(e)[0]))
+        raise
+    except Exception as e:
+        singleflight.end_stream('translate_stream', text, flight, sse_event('error', {'error': str(e)}))
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+    async def events():
+        parts = []
+        try:
+            async for kind, delta in aiter_stream_deltas(upstream):
+                if kind == 'delta':
+                    parts.append(delta)
+                    yield sse_event('delta', {'text': delta})
+            translated_text = "".join(parts).strip()
+            await run_blocking(memory.learn, segments, translated_text)
+            yield sse_event('done', {'translated_text': translated_text, 'cached': False})
+        except Exception as e:
+            yield sse_event('error', {'error': str(e)})
+
+    singleflight.astart_stream('translate_stream', text, flight, events())
+    return sse_response(flight.follow())
+
+
+async def create_jobs(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    body, status = await run_blocking(flask_app.submit_jobs, data)
+    return JSONResponse(body, status_code=status)
+
+
+async def get_job(request):
+    job = await run_blocking(flask_app.job_queue.get, request.path_params['job_id'])
+    if job is None:
+        return JSONResponse({'error': 'Job not found'}, status_code=404)
+    return JSONResponse(job)
+
+
+async def get_batch(request):
+    batch_id = request.path_params['batch_id']
+    jobs = await run_blocking(flask_app.job_queue.batch, batch_id)
+    if not jobs:
+        return JSONResponse({'error': 'Batch not found'}, status_code=404)
+    return JSONResponse({'batch_id': batch_id, 'jobs': jobs})
+
+
+async def stream_batch(request):
+    batch_id = request.path_params['batch_id']
+    if not await run_blocking(flask_app.job_queue.batch, batch_id):
+        return JSONResponse({'error': 'Batch not found'}, status_code=404)
+    # Starlette iterates the blocking generator in its thread pool
+    return StreamingResponse(
+        flask_app.ndjson_lines(flask_app.job_queue.follow(batch_id)),
+        media_type='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+async def job_stats(request):
+    return JSONResponse(await run_blocking(flask_app.job_queue.stats))
+
+
+async def admission_stats(request):
+    return JSONResponse(flask_app.admission.stats())
+
+
+async def handle_overloaded(request, exc):
+    body, headers = flask_app.overloaded_response(exc)
+    return JSONResponse(body, status_code=429, headers=headers)
+
+
+async def handle_upload_too_large(request, exc):
+    return JSONResponse(flask_app.upload_too_large_body(exc.reason, str(exc)), status_code=413)
+
+
+async def prometheus_metrics(request):
+    return Response(metrics.registry.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+async def upload_images(request):
+    with metrics.span('upload_parse'):
+        form = await request.form()
+    files = [item.file for item in form.getlist('images') if hasattr(item, 'file')]
+    if not files:
+        return JSONResponse({'error': 'No images uploaded'}, status_code=400)
+    body, status = await run_blocking(flask_app.store_images, files)
+    return JSONResponse(body, status_code=status)
+
+
+async def upload_config(request):
+    return JSONResponse(flask_app.upload_settings())
+
+
+def collect_cache_stats():
+    return {
+        'result_cache': flask_app.result_cache.stats(),
+        'image_cache': flask_app.image_cache.stats(),
+        'image_store': flask_app.image_store.stats(),
+        'translation_memory': flask_app.translation_memory.stats(),
+        'analysis_cache': flask_app.analysis_cache.stats(),
+        'near_duplicates': flask_app.near_duplicates.stats(),
+        'context_cache': flask_app.context_cache.stats() if flask_app.context_cache else None,
+        'ark_pool': ark.stats(),
+        'decode_budget': flask_app.decode_budget.stats(),
+        'singleflight': singleflight.stats(),
+    }
+
+
+async def cache_stats(request):
+    # The cache stats wait on the locks held during SQLite writes
+    return JSONResponse(await run_blocking(collect_cache_stats))
+
+
+class RequestTraceMiddleware:
+    # Mirrors the Flask request hooks: X-Request-ID header, per-request spans and one JSON log
+    # line once the response (including a streamed body) has been sent
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] == '/metrics':
+            await self.app(scope, receive, send)
+            return
+
+        incoming = dict(scope['headers']).get(metrics.REQUEST_ID_HEADER.lower().encode(), b'').decode('latin-1')
+        trace = metrics.start_trace(scope['method'], scope['path'], incoming)
+        status = 500
+
+        async def send_traced(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                message['headers'] = list(message.get('headers', [])) + [
+                    (metrics.REQUEST_ID_HEADER.lower().encode(), trace.request_id.encode())
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_traced)
+        finally:
+            # The router stores the matched endpoint in the scope; label by its path pattern
+            metrics.finish_trace(trace, status, ROUTE_PATHS.get(scope.get('endpoint'), 'unmatched'))
+
+
+class UploadLimitMiddleware:
+    # MAX_UPLOAD_BYTES for the ASGI app: a Content-Length over the limit is answered with 413
+    # before the body is read; bodies without one are counted as they arrive
+
+    def __init__(self, app, max_bytes):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self.max_bytes:
+            await self.app(scope, receive, send)
+            return
+
+        length = dict(scope['headers']).get(b'content-length', b'')
+        if length.isdigit() and int(length) > self.max_bytes:
+            response = JSONResponse(flask_app.upload_too_large_body('body_size'), status_code=413)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def receive_limited():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > self.max_bytes:
+                    raise UploadTooLarge('Request body too large', 'body_size')
+            return message
+
+        await self.app(scope, receive_limited, send)
+
+
+routes = [
+    Route('/', index),
+    Route('/generate', generate, methods=['POST']),
+    Route('/generate/stream', generate_stream, methods=['POST']),
+    Route('/translate', translate, methods=['POST']),
+    Route('/translate/stream', translate_stream, methods=['POST']),
+    Route('/jobs', create_jobs, methods=['POST']),
+    Route('/jobs/stats', job_stats),
+    Route('/jobs/batches/{batch_id}', get_batch),
+    Route('/jobs/batches/{batch_id}/stream', stream_batch),
+    Route('/jobs/{job_id}', get_job),
+    Route('/images', upload_images, methods=['POST']),
+    Route('/upload/config', upload_config),
+    Route('/cache/stats', cache_stats),
+    Route('/admission/stats', admission_stats),
+    Route('/metrics', prometheus_metrics),
+]
+ROUTE_PATHS = {route.endpoint: route.path for route in routes}
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Imports left for first use are done before the server accepts requests (in a thread, as the
+    # SDK import takes a few hundred ms), so the first requests do not wait for them. The async
+    # pool lives on the serving loop, so its connections are warmed here in the background.
+    await asyncio.get_running_loop().run_in_executor(None, flask_app.preload_modules)
+    connections = int(os.getenv("ARK_WARMUP_CONNECTIONS", "2"))
+    task = asyncio.ensure_future(ark.awarm_up(connections)) if connections > 0 else None
+    yield
+    if task is not None and not task.done():
+        task.cancel()
+
+
+app = Starlette(
+    routes=routes,
+    lifespan=lifespan,
+    middleware=[Middleware(RequestTraceMiddleware), Middleware(UploadLimitMiddleware, max_bytes=flask_app.MAX_UPLOAD_BYTES)],
+    exception_handlers={Overloaded: handle_overloaded, UploadTooLarge: handle_upload_too_large},
+)
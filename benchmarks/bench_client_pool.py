@@ -0,0 +1,104 @@
+"""Client benchmark: a new Ark client per call (the old behaviour) vs the shared ArkClients pool.
+
+    python benchmarks/bench_client_pool.py --calls 200 --threads 8 --latency 0.05
+
+Starts benchmarks/mock_ark.py and issues the same chat completions both ways from a thread
+pool, reporting per-call latency, throughput and how many TCP connections were opened.
+Against a local plain-HTTP mock the saving is only the TCP connect and client setup; against
+ark.cn-beijing.volces.com every new connection also pays DNS and a TLS handshake.
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+from volcenginesdkarkruntime import Ark
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ark_clients import ArkClients  # noqa: E402
+
+MESSAGES = [{"role": "user", "content": "ping"}]
+
+
+def wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+
+def run(call, calls, threads):
+    def timed(_):
+        start = time.perf_counter()
+        call()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        latencies = sorted(pool.map(timed, range(calls)))
+    wall = time.perf_counter() - start
+    return {
+        'wall_seconds': round(wall, 3),
+        'calls_per_second': round(calls / wall, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p95_ms': round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.05, help='mock seconds per completion')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--output', help='write results as JSON to this path')
+    args = parser.parse_args()
+
+    base_url = f"http://127.0.0.1:{args.port}/api/v3"
+    mock = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'benchmarks', 'mock_ark.py'), '--port', str(args.port), '--latency', str(args.latency)]
+    )
+    try:
+        wait_for(f"http://127.0.0.1:{args.port}/stats")
+
+        def per_call_client():
+            # What analyze_single_image and generate_fused_prompt_directly used to do
+            client = Ark(api_key='bench', base_url=base_url, timeout=900)
+            client.chat.completions.create(model='mock', messages=MESSAGES)
+
+        ark = ArkClients('bench', base_url, max_connections=args.threads)
+
+        def shared_client():
+            ark.chat_completion('fusion', model='mock', messages=MESSAGES)
+
+        results = {}
+        for name, call in (('client_per_call', per_call_client), ('shared_pool', shared_client)):
+            call()  # warm-up (imports, first connection)
+            results[name] = run(call, args.calls, args.threads)
+            print(f"{name:16s} {json.dumps(results[name])}")
+
+        results['shared_pool']['pool'] = ark.stats()['sync']
+        print(f"shared pool: {json.dumps(results['shared_pool']['pool'])}")
+        print(f"client_per_call opens one connection per call ({args.calls + 1} total)")
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+    finally:
+        mock.terminate()
+        mock.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Micro-benchmark: image_preprocess.encode_images vs the previous serial encode_image.
+
+    python benchmarks/bench_encode.py --images 4 --megapixels 12 --repeat 3
+
+Synthetic phone-sized photos (JPEG) and alpha PNGs are generated in memory. Reports the
+best wall time per request for each implementation, and the best time of a single
+image_preprocess.encode_image call (decode, resize and JPEG/base64 encode of one upload).
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import sys
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_preprocess import encode_image, encode_images  # noqa: E402
+
+
+def legacy_encode_image(file_storage):
+    # encode_image as it was in app.py before image_preprocess existed
+    img = Image.open(file_storage)
+    if img.mode in ('RGBA', 'P'):
+        img = img.convert('RGB')
+    max_size = 512
+    if img.width > max_size or img.height > max_size:
+        img.thumbnail((max_size, max_size))
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=85)
+    buffer.seek(0)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.read()).decode('utf-8')
+
+
+def legacy_encode_images(files):
+    results = []
+    for f in files:
+        results.append(legacy_encode_image(f))
+        f.seek(0)
+    return results
+
+
+# (label, format, mode); the legacy function drops alpha instead of flattening it, so
+# semi-transparent PNGs do more work now in exchange for correct output
+CASES = [('jpeg', 'JPEG', 'RGB'), ('png-opaque', 'PNG', 'RGB'), ('png-alpha', 'PNG', 'RGBA')]
+
+
+def make_photo(megapixels, fmt, seed, mode='RGB'):
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    noise = Image.effect_noise((width // 8, height // 8), 40 + seed).resize((width, height))
+    gradient = Image.linear_gradient('L').resize((width, height))
+    if mode == 'RGBA':
+        img = Image.merge('RGBA', (noise, gradient, noise, gradient))
+    else:
+        img = Image.merge('RGB', (noise, gradient, Image.eval(noise, lambda v: 255 - v)))
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt, quality=92) if fmt == 'JPEG' else img.save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def best_time(fn, payloads, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        files = [io.BytesIO(data) for data in payloads]
+        start = time.perf_counter()
+        fn(files)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', type=int, default=4)
+    parser.add_argument('--megapixels', type=float, default=12)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    results = []
+    for label, fmt, mode in CASES:
+        payloads = [make_photo(args.megapixels, fmt, i, mode) for i in range(args.images)]
+        legacy = best_time(legacy_encode_images, payloads, args.repeat)
+        current = best_time(encode_images, payloads, args.repeat)
+        single = best_time(lambda files: encode_image(files[0]), payloads[:1], args.repeat)
+        results.append({
+            'case': label,
+            'images': args.images,
+            'megapixels': args.megapixels,
+            'upload_bytes': sum(len(p) for p in payloads),
+            'legacy_seconds': round(legacy, 4),
+            'encode_images_seconds': round(current, 4),
+            'speedup': round(legacy / current, 2),
+            'encode_image_ms': round(single * 1000, 2),
+        })
+        print(json.dumps(results[-1]))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Image token budget report: tokens and bytes sent per request with and without image_budget.
+
+    python benchmarks/bench_image_budget.py --megapixels 12 --token-cap 1600 --output results/budget.json
+
+For typical tag selections (palette only, style + composition, people, six images...) at each
+precision level, encodes synthetic photos the way /generate does, once at the fixed
+MAX_SIZE / JPEG_QUALITY and once with the per-image plan, and reports the estimated image
+tokens, the data URL bytes and the encode time of both. The tokens are what the prompt prefill
+(and so the time to first token) scales with; image_tokens in each response's timings and
+prompt_fusion_image_tokens_sent_total in /metrics give the same figure for real traffic.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_encode import make_photo  # noqa: E402
+from image_budget import ImageBudget, data_url_tokens  # noqa: E402
+from image_preprocess import encode_images  # noqa: E402
+
+# (label, aspects per image)
+SCENARIOS = [
+    ('palette', [['画面配色']]),
+    ('style+composition', [['风格'], ['构图']]),
+    ('person', [['人物外貌', '穿搭']]),
+    ('mixed-4', [['人物外貌'], ['画面配色'], ['风格'], ['场景/环境', '光影描述']]),
+    ('people-6', [['人物外貌']] * 6),
+    ('palette-6', [['画面配色']] * 6),
+    ('custom-tag', [['猫的品种']]),
+]
+
+
+def encode(payloads, plans):
+    files = [io.BytesIO(data) for data in payloads]
+    start = time.perf_counter()
+    encoded = encode_images(files, plans=plans)
+    return {
+        'image_tokens': sum(data_url_tokens(data_url) for data_url in encoded),
+        'image_bytes': sum(len(data_url) for data_url in encoded),
+        'encode_ms': round((time.perf_counter() - start) * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--megapixels', type=float, default=12)
+    parser.add_argument('--token-cap', type=int, default=1600)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    fixed = ImageBudget(adaptive=False)
+    budget = ImageBudget(token_cap=args.token_cap)
+    photos = [make_photo(args.megapixels, 'JPEG', seed) for seed in range(6)]
+
+    results = []
+    for label, aspects in SCENARIOS:
+        options_map = {str(idx): items for idx, items in enumerate(aspects)}
+        payloads = photos[:len(aspects)]
+        for precision in ('1', '2', '3'):
+            before = encode(payloads, fixed.plan(options_map, len(payloads), precision))
+            plan = budget.plan(options_map, len(payloads), precision)
+            after = encode(payloads, plan)
+            results.append({
+                'case': f"{label}/p{precision}",
+                'sizes': [size for size, _ in plan],
+                'fixed': before,
+                'budget': after,
+                'tokens_saved': round(1 - after['image_tokens'] / before['image_tokens'], 3),
+            })
+            print(json.dumps(results[-1], ensure_ascii=False))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'token_cap': args.token_cap, 'results': results}, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Local image feature report: extraction time and the image tokens no longer sent.
+
+    python benchmarks/bench_image_features.py --megapixels 12 --repeat 5 --output results/features.json
+
+Times the NumPy feature extraction (palette k-means, saturation / brightness / contrast
+statistics, warm / cool ratio) on uploads in each format and on the encoded data URLs the
+fusion prompt is built from, then encodes typical tag selections the way /generate does, with
+and without LOCAL_ONLY_ASPECTS, and reports the image tokens sent and the time spent on images
+(encoding plus features) for each. An image tagged only 画面配色 costs a small decode and the
+statistics instead of its tokens and the prefill they take upstream.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_encode import make_photo  # noqa: E402
+from image_budget import ImageBudget, data_url_tokens  # noqa: E402
+from image_features import FeatureHints, extract_features, load_feature_image  # noqa: E402
+from image_preprocess import encode_image, encode_images  # noqa: E402
+
+# (label, aspects per image)
+SCENARIOS = [
+    ('palette', [['画面配色']]),
+    ('palette+light', [['画面配色', '光影描述']]),
+    ('person+palette', [['人物外貌'], ['画面配色']]),
+    ('mixed-4', [['人物外貌'], ['画面配色'], ['风格'], ['场景/环境', '光影描述']]),
+    ('palette-6', [['画面配色']] * 6),
+]
+
+
+def best_ms(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return round(best * 1000, 2)
+
+
+def prepare(payloads, options_map, hints, budget):
+    # The work app.encode_fusion_images does for one request, without the caches
+    aspects = [options_map[str(idx)] for idx in range(len(payloads))]
+    sent = [idx for idx in range(len(payloads)) if not hints.skip_image(aspects[idx])]
+    plans = budget.plan({str(pos): aspects[idx] for pos, idx in enumerate(sent)}, len(sent), '2')
+    encoded = encode_images([io.BytesIO(payloads[idx]) for idx in sent], plans=plans)
+    sources = dict(zip(sent, encoded))
+    texts = [hints.hint(sources.get(idx) or io.BytesIO(payloads[idx]), aspects[idx]) for idx in range(len(payloads))]
+    return encoded, texts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--megapixels', type=float, default=12)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    results = {'extraction': [], 'scenarios': []}
+    for fmt in ('JPEG', 'PNG'):
+        payload = make_photo(args.megapixels, fmt, 0)
+        data_url = encode_image(io.BytesIO(payload))
+        img = load_feature_image(data_url)
+        results['extraction'].append({
+            'case': fmt,
+            'decode_upload_ms': best_ms(lambda: load_feature_image(io.BytesIO(payload)), args.repeat),
+            'decode_data_url_ms': best_ms(lambda: load_feature_image(data_url), args.repeat),
+            'features_ms': best_ms(lambda: extract_features(img), args.repeat),
+        })
+        print(json.dumps(results['extraction'][-1]))
+
+    budget = ImageBudget(token_cap=1600)
+    setups = {'send_all': FeatureHints(local_only=()), 'local_only': FeatureHints()}
+    photos = [make_photo(args.megapixels, 'JPEG', seed) for seed in range(6)]
+    for label, aspects in SCENARIOS:
+        options_map = {str(idx): items for idx, items in enumerate(aspects)}
+        payloads = photos[:len(aspects)]
+        row = {'case': label}
+        for name, hints in setups.items():
+            encoded, _ = prepare(payloads, options_map, hints, budget)
+            row[name] = {
+                'images_sent': len(encoded),
+                'image_tokens': sum(data_url_tokens(data_url) for data_url in encoded),
+                'prepare_ms': best_ms(lambda: prepare(payloads, options_map, hints, budget), args.repeat),
+            }
+        results['scenarios'].append(row)
+        print(json.dumps(row, ensure_ascii=False))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
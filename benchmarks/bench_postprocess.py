@@ -0,0 +1,105 @@
+"""Micro-benchmark: the regex post-processing applied to every generated prompt.
+
+    python benchmarks/bench_postprocess.py --repeat 5 --output results/postprocess.json
+
+Times app.clean_prompt (the rules generate() applies to the model output), the same call
+through app.postprocess_prompt (which adds the metrics span), and StreamCleaner fed in
+8-character chunks, as /generate/stream does. Inputs are typical outputs at each precision
+level plus JSON mode, where app.postprocess_json (parse, repair and validate) and
+JsonFieldStream fed in 8-character chunks are timed as well. Reports the best microseconds
+per call.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Importing app builds its caches and job queue; keep them out of the way
+os.environ.setdefault('ARK_API_KEY', 'bench')
+os.environ.setdefault('CACHE_DIR', tempfile.mkdtemp(prefix='prompt-fusion-bench-'))
+os.environ.setdefault('JOBS_PARALLELISM', '0')
+
+import app  # noqa: E402
+from json_stream import JsonFieldStream  # noqa: E402
+from streaming import StreamCleaner  # noqa: E402
+
+LINES = [
+    "风格：赛博朋克风格，数字艺术，高对比度，霓虹色调与金属质感交织。",
+    "构图：低角度仰视，三分法构图，主体位于画面右侧，前景留白。",
+    "光影描述：侧逆光，轮廓光勾勒主体边缘，暗部保留丰富细节，空气中有细微尘埃。",
+    "画面配色：主体为青绿色，背景为暖橙色渐变，局部点缀洋红色高光。",
+    "背景：雨夜城市街道，湿润路面反射霓虹灯光，远处有模糊的车流光轨。",
+]
+
+
+def natural_output(repeat):
+    body = "\n".join(LINES[i % len(LINES)] for i in range(repeat))
+    return f"[Chinese]\n（中文）\n{body}\n（注：已根据核心维度调整配色描述）"
+
+
+JSON_OPTIONS = {'0': [{'id': line.split("：")[0], 'weight': 1} for line in LINES]}
+
+CASES = {
+    'precision_1': natural_output(3),
+    'precision_2': natural_output(8),
+    'precision_3': natural_output(40),
+    'wrapped': "（" + natural_output(8).replace("[Chinese]\n", "") + "）",
+    'json': "```json\n" + json.dumps({'prompts': {line.split("：")[0]: line.split("：")[1] for line in LINES}}, ensure_ascii=False) + "\n```",
+}
+
+
+def stream_clean(text):
+    cleaner = StreamCleaner()
+    for i in range(0, len(text), 8):
+        cleaner.feed(text[i:i + 8])
+    cleaner.finish()
+
+
+def stream_json(text):
+    fields = JsonFieldStream()
+    for i in range(0, len(text), 8):
+        fields.feed(text[i:i + 8])
+    fields.finish()
+
+
+def best_microseconds(fn, repeat, number):
+    return min(timeit.repeat(fn, repeat=repeat, number=number)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=2000, help='calls per timing run')
+    parser.add_argument('--output', help='write results as JSON to this path')
+    args = parser.parse_args()
+
+    results = []
+    for case, text in CASES.items():
+        json_output = case == 'json'
+        result = {
+            'case': case,
+            'chars': len(text),
+            'clean_prompt_us': round(best_microseconds(lambda: app.clean_prompt(text, json_output), args.repeat, args.number), 2),
+            'postprocess_prompt_us': round(best_microseconds(lambda: app.postprocess_prompt(text, json_output), args.repeat, args.number), 2),
+        }
+        if json_output:
+            result['postprocess_json_us'] = round(best_microseconds(lambda: app.postprocess_json(text, JSON_OPTIONS), args.repeat, args.number), 2)
+            result['json_field_stream_us'] = round(best_microseconds(lambda: stream_json(text), args.repeat, max(1, args.number // 10)), 2)
+        else:
+            result['stream_cleaner_us'] = round(best_microseconds(lambda: stream_clean(text), args.repeat, max(1, args.number // 10)), 2)
+        results.append(result)
+        print(json.dumps(result))
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""Cold start benchmark: import time of the app modules and time to first generation per serving setup.
+
+    python benchmarks/bench_startup.py --repeat 5 --workers 2 --modes wsgi,wsgi-preload,asgi
+
+Imports app.py (and asgi_app.py) in fresh interpreters, reporting the best wall time and the
+slowest imports from `python -X importtime`. Then starts benchmarks/mock_ark.py and each server
+setup, and measures the time until it answers, the first and a later /generate (distinct
+images, so no cache hits), and the proportional memory (PSS) of the whole process tree, which
+counts pages shared copy-on-write between preloaded workers once (Linux only).
+"""
+import argparse
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from PIL import Image
+
+from bench_upload_memory import process_tree
+from load_concurrency import ROOT, SERVERS, wait_for
+
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)')
+
+COMMANDS = {
+    # An empty config file, or gunicorn would pick up ./gunicorn.conf.py
+    'wsgi': ['gunicorn', '-c', '{empty_config}', '--bind', '127.0.0.1:{port}', '--workers', '{workers}', '--threads', '8', '--timeout', '0', 'app:app'],
+    # gunicorn.conf.py: preload_app, SDK imported in the master, per-worker warm-up after fork
+    'wsgi-preload': ['gunicorn', '-c', 'gunicorn.conf.py', '--bind', '127.0.0.1:{port}', '--workers', '{workers}', 'app:app'],
+    'asgi': SERVERS['asgi'],
+}
+
+
+def base_env(args):
+    return dict(os.environ,
+                ARK_API_KEY='mock',
+                ARK_BASE_URL=f"http://127.0.0.1:{args.mock_port}/api/v3",
+                CACHE_DIR=tempfile.mkdtemp(prefix='prompt-fusion-bench-'),
+                JOBS_PARALLELISM='0')
+
+
+def import_seconds(module, env):
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(module, env, top, max_depth=2):
+    # (name, cumulative ms, self ms) of the slowest imports within max_depth levels of the module
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+                            cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    rows = []
+    for line in output.stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match and len(match.group(3)) // 2 <= max_depth:
+            rows.append({
+                'case': match.group(4),
+                'cumulative_ms': round(int(match.group(2)) / 1000, 1),
+                'self_ms': round(int(match.group(1)) / 1000, 1),
+            })
+    return sorted(rows, key=lambda row: row['cumulative_ms'], reverse=True)[:top]
+
+
+def pss_bytes(pid):
+    total = 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith('Pss:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+def make_image(seed):
+    # Colors far enough apart that no two images encode to the same bytes (a result cache hit)
+    buffer = io.BytesIO()
+    Image.new('RGB', (640, 480), ((seed * 37) % 256, 64, 128)).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def generate_ms(http, port, image):
+    # The image is built and the client connected beforehand, so only the server's work is timed
+    start = time.perf_counter()
+    response = http.post(
+        f"http://127.0.0.1:{port}/generate",
+        files={'images': ('upload.jpg', image, 'image/jpeg')},
+        data={'options': json.dumps({'0': [{'id': '构图', 'weight': 1}]}), 'precision': '1', 'thinking': 'false'},
+    )
+    response.raise_for_status()
+    return round((time.perf_counter() - start) * 1000, 1)
+
+
+def serve(mode, args):
+    empty_config = os.path.join(tempfile.mkdtemp(prefix='prompt-fusion-bench-'), 'empty.conf.py')
+    open(empty_config, 'w').close()
+    command = [part.format(port=args.port, workers=args.workers, empty_config=empty_config) for part in COMMANDS[mode]]
+    images = [make_image(seed) for seed in range(1 + args.workers * 2)]
+    http = httpx.Client(timeout=120)
+    start = time.perf_counter()
+    server = subprocess.Popen(command, cwd=ROOT, env=base_env(args), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for(f"http://127.0.0.1:{args.port}/upload/config", timeout=60)
+        ready = time.perf_counter() - start
+        http.get(f"http://127.0.0.1:{args.port}/upload/config")
+        first = generate_ms(http, args.port, images[0])
+        later = [generate_ms(http, args.port, image) for image in images[1:]]
+        pss = pss_bytes(server.pid)
+    finally:
+        http.close()
+        server.terminate()
+        server.wait()
+    return {
+        'mode': mode,
+        'workers': args.workers if mode != 'asgi' else 1,
+        'ready_seconds': round(ready, 3),
+        'first_generate_ms': first,
+        'later_generate_ms': round(sum(later) / len(later), 1),
+        'pss_mb': round(pss / 2 ** 20, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15, help='slowest imports to list')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.05, help='mock upstream seconds per call')
+    parser.add_argument('--port', type=int, default=18090)
+    parser.add_argument('--mock-port', type=int, default=18080)
+    parser.add_argument('--modes', default='wsgi,wsgi-preload,asgi')
+    parser.add_argument('--output', help='write results as JSON to this path')
+    args = parser.parse_args()
+
+    results = {'imports': [], 'serving': []}
+    for module in ('app', 'asgi_app'):
+        env = base_env(args)
+        best = min(import_seconds(module, env) for _ in range(args.repeat))
+        results['imports'].append({
+            'case': module,
+            'import_seconds': round(best, 4),
+            'slowest': slowest_imports(module, env, args.top),
+        })
+        print(json.dumps(results['imports'][-1], ensure_ascii=False))
+
+    mock = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'mock_ark.py'),
+                             '--port', str(args.mock_port), '--latency', str(args.latency)])
+    try:
+        wait_for(f"http://127.0.0.1:{args.mock_port}/stats")
+        for mode in args.modes.split(','):
+            results['serving'].append(serve(mode, args))
+            print(json.dumps(results['serving'][-1]))
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
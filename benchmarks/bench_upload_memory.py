@@ -0,0 +1,194 @@
+"""Memory benchmark: server RSS under concurrent large PNG uploads, with and without the decode budget.
+
+    python benchmarks/bench_upload_memory.py --concurrency 8 --megapixels 24 --modes wsgi,asgi
+
+Starts benchmarks/mock_ark.py and the app (gunicorn or uvicorn, as in load_concurrency.py)
+once per decode budget in --budgets (bytes, 0 = unlimited), posts --concurrency distinct
+RGBA PNGs of --megapixels at the same time, and samples the RSS of the server process tree
+from /proc every 20 ms (Linux only). Reports the idle and peak RSS, then times the 413
+answers for a body over MAX_UPLOAD_BYTES and an image over MAX_IMAGE_PIXELS. With the
+budget, peak RSS should stay roughly flat as --concurrency grows; without it, it grows with
+every concurrent decode.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+from PIL import Image
+
+from load_concurrency import ROOT, SERVERS, wait_for
+
+PAGE_KB = 4
+
+
+def process_tree(pid):
+    pids = [pid]
+    for child_pid in pids:
+        try:
+            with open(f"/proc/{child_pid}/task/{child_pid}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def rss_bytes(pid):
+    total = 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/statm") as f:
+                total += int(f.read().split()[1]) * PAGE_KB * 1024
+        except OSError:
+            pass
+    return total
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, interval=0.02):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, rss_bytes(self.pid))
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.peak
+
+
+def make_png(megapixels):
+    # Noise compresses poorly, so the file is large, and RGBA makes the decoded image 4 bytes/pixel
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    noise = Image.effect_noise((width, height), 60)
+    img = Image.merge('RGBA', (noise, noise.transpose(Image.Transpose.FLIP_LEFT_RIGHT), noise, Image.new('L', (width, height), 200)))
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG', compress_level=1)
+    return buffer.getvalue()
+
+
+async def post(http, port, data):
+    start = time.perf_counter()
+    response = await http.post(
+        f"http://127.0.0.1:{port}/generate",
+        files={'images': ('upload.png', data, 'image/png')},
+        data={'options': json.dumps({'0': [{'id': '构图', 'weight': 1}]}), 'precision': '1', 'thinking': 'false'},
+    )
+    return response.status_code, time.perf_counter() - start
+
+
+async def probe_oversized_body(port, size):
+    # Sends only the headers of an upload declaring `size` bytes; the server should answer 413
+    # without waiting for a body (a full client would still be uploading when it is reset)
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write((
+        f"POST /generate HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n"
+        f"Content-Type: multipart/form-data; boundary=bench\r\nContent-Length: {size}\r\n\r\n"
+    ).encode())
+    await writer.drain()
+    status_line = await reader.readline()
+    writer.close()
+    return int(status_line.split()[1]), time.perf_counter() - start
+
+
+async def fire(port, payloads):
+    async with httpx.AsyncClient(timeout=600, limits=httpx.Limits(max_connections=len(payloads))) as http:
+        return await asyncio.gather(*(post(http, port, data) for data in payloads))
+
+
+def run(mode, budget, png, args):
+    env = dict(os.environ,
+               ARK_API_KEY='mock',
+               ARK_BASE_URL=f"http://127.0.0.1:{args.mock_port}/api/v3",
+               CACHE_DIR=tempfile.mkdtemp(prefix='prompt-fusion-bench-'),
+               JOBS_PARALLELISM='0',
+               DECODE_MEMORY_BYTES=str(budget),
+               MAX_UPLOAD_BYTES=str(args.max_upload_mb * 1024 * 1024),
+               MAX_IMAGE_PIXELS=str(int(args.megapixels * 1_100_000)))
+    command = [part.format(port=args.port) for part in SERVERS[mode]]
+    server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+    try:
+        wait_for(f"http://127.0.0.1:{args.port}/cache/stats")
+        idle = rss_bytes(server.pid)
+        # Trailing bytes after IEND keep every upload distinct, so the image cache never hits
+        payloads = [png + f"#{mode}-{budget}-{i}".encode() for i in range(args.concurrency)]
+        sampler = RssSampler(server.pid)
+        sampler.start()
+        start = time.perf_counter()
+        results = asyncio.run(fire(args.port, payloads))
+        wall = time.perf_counter() - start
+        peak = sampler.stop()
+
+        oversized_pixels = make_png(args.megapixels * 1.5)
+        body_status, body_seconds = asyncio.run(probe_oversized_body(args.port, args.max_upload_mb * 1024 * 1024 + 1))
+        pixels_status, pixels_seconds = asyncio.run(fire(args.port, [oversized_pixels]))[0]
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {
+        'mode': mode,
+        'decode_memory_bytes': budget,
+        'concurrency': args.concurrency,
+        'upload_bytes': len(png),
+        'ok': sum(1 for status, _ in results if status == 200),
+        'wall_seconds': round(wall, 2),
+        'idle_rss_mb': round(idle / 2 ** 20, 1),
+        'peak_rss_mb': round(peak / 2 ** 20, 1),
+        'rss_growth_mb': round((peak - idle) / 2 ** 20, 1),
+        'body_413_status': body_status,
+        'body_413_ms': round(body_seconds * 1000, 1),
+        'pixels_413_status': pixels_status,
+        'pixels_413_ms': round(pixels_seconds * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--megapixels', type=float, default=24)
+    parser.add_argument('--budgets', default=f"0,{256 * 1024 * 1024}", help='comma-separated DECODE_MEMORY_BYTES values')
+    parser.add_argument('--max-upload-mb', type=int, default=256, help='MAX_UPLOAD_BYTES for the server, in MB')
+    parser.add_argument('--latency', type=float, default=0.2, help='mock upstream seconds per call')
+    parser.add_argument('--port', type=int, default=18090)
+    parser.add_argument('--mock-port', type=int, default=18080)
+    parser.add_argument('--modes', default='wsgi')
+    parser.add_argument('--output', help='write results as JSON to this path')
+    args = parser.parse_args()
+
+    png = make_png(args.megapixels)
+    mock = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'mock_ark.py'),
+                             '--port', str(args.mock_port), '--latency', str(args.latency)])
+    try:
+        wait_for(f"http://127.0.0.1:{args.mock_port}/stats")
+        results = []
+        for mode in args.modes.split(','):
+            for budget in args.budgets.split(','):
+                results.append(run(mode, int(budget), png, args))
+                print(json.dumps(results[-1]))
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
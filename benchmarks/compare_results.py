@@ -0,0 +1,71 @@
+"""Compare two benchmark result files written with --output and flag regressions.
+
+    python benchmarks/compare_results.py results/baseline.json results/load.json --threshold 10
+
+Works with the JSON of every script in benchmarks/. Numbers are matched by their path in the
+document (list entries by their "case" or "mode" field). Times (seconds, _ms, _us) are worse
+when they grow; throughput and speedups are worse when they shrink. Exits with status 1 if
+any metric got worse by more than --threshold percent, so it can gate a CI job.
+"""
+import argparse
+import json
+import sys
+
+LOWER_IS_BETTER = ('seconds', '_ms', '_us')
+HIGHER_IS_BETTER = ('per_second', 'speedup', 'reuse_ratio')
+
+
+def flatten(value, path=''):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key != 'settings':
+                yield from flatten(item, f"{path}.{key}" if path else key)
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            label = item.get('case') or item.get('mode') if isinstance(item, dict) else None
+            yield from flatten(item, f"{path}[{label if label is not None else index}]")
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield path, value
+
+
+def direction(path):
+    # 1 when a larger value is worse, -1 when a smaller one is, None for counts and sizes
+    name = path.rsplit('.', 1)[-1]
+    if any(name.endswith(suffix) or suffix in name for suffix in HIGHER_IS_BETTER):
+        return -1
+    if any(name.endswith(suffix) for suffix in LOWER_IS_BETTER):
+        return 1
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=10.0, help='percent change treated as a regression')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = dict(flatten(json.load(f)))
+    with open(args.current) as f:
+        current = dict(flatten(json.load(f)))
+
+    regressions = 0
+    for path in sorted(set(baseline) & set(current)):
+        sign = direction(path)
+        before, after = baseline[path], current[path]
+        if sign is None or not before:
+            continue
+        change = (after - before) / abs(before) * 100
+        worse = change * sign > args.threshold
+        better = change * sign < -args.threshold
+        regressions += worse
+        marker = 'REGRESSION' if worse else 'improved' if better else ''
+        print(f"{path:60s} {before:>12g} -> {after:<12g} {change:+7.1f}%  {marker}")
+
+    print(f"{regressions} regression(s) beyond {args.threshold:g}%")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
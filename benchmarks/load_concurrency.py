@@ -0,0 +1,131 @@
+"""Concurrency load test: sync (gunicorn threads) vs async (uvicorn) serving against the mock upstream.
+
+    python benchmarks/load_concurrency.py --concurrency 200 --latency 2
+
+Starts benchmarks/mock_ark.py and the app under test as subprocesses, fires N simultaneous
+/generate requests with distinct images (so the result cache never hits) and reports wall
+time, throughput and the peak number of upstream calls the mock saw in flight at once.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    # An empty config file, or gunicorn would pick up ./gunicorn.conf.py
+    'wsgi': ['gunicorn', '-c', '{empty_config}', '--bind', '127.0.0.1:{port}', '--workers', '1', '--threads', '8', '--timeout', '0', 'app:app'],
+    'asgi': ['uvicorn', 'asgi_app:app', '--host', '127.0.0.1', '--port', '{port}', '--log-level', 'warning'],
+}
+
+
+def wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+
+def make_image(seed):
+    # A different pattern per seed: flat images a few levels apart would be near-duplicates
+    # (near_duplicates.py) and be served from the result cache
+    rng = random.Random(seed)
+    pattern = Image.frombytes('L', (16, 12), bytes(rng.randrange(256) for _ in range(16 * 12))).resize((640, 480))
+    buffer = io.BytesIO()
+    Image.merge('RGB', (pattern, Image.new('L', (640, 480), seed % 256), Image.new('L', (640, 480), 128))).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+async def fire(port, concurrency):
+    options = json.dumps({'0': [{'id': '构图', 'weight': 1}]})
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(timeout=600, limits=limits) as http:
+        async def one(i):
+            start = time.perf_counter()
+            response = await http.post(
+                f"http://127.0.0.1:{port}/generate",
+                files={'images': (f'{i}.jpg', make_image(i), 'image/jpeg')},
+                data={'options': options, 'precision': '1', 'thinking': 'false'},
+            )
+            return response.status_code, time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(one(i) for i in range(concurrency)))
+        return time.perf_counter() - start, results
+
+
+def run(mode, args):
+    env = dict(os.environ,
+               ARK_API_KEY='mock',
+               ARK_BASE_URL=f"http://127.0.0.1:{args.mock_port}/api/v3",
+               CACHE_DIR=tempfile.mkdtemp(prefix='prompt-fusion-bench-'))
+    empty_config = os.path.join(tempfile.mkdtemp(prefix='prompt-fusion-bench-'), 'empty.conf.py')
+    open(empty_config, 'w').close()
+    command = [part.format(port=args.port, empty_config=empty_config) for part in SERVERS[mode]]
+    server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+    try:
+        wait_for(f"http://127.0.0.1:{args.port}/cache/stats")
+        httpx.post(f"http://127.0.0.1:{args.mock_port}/reset")
+        wall, results = asyncio.run(fire(args.port, args.concurrency))
+        peak = httpx.get(f"http://127.0.0.1:{args.mock_port}/stats").json()['peak_in_flight']
+    finally:
+        server.terminate()
+        server.wait()
+
+    ok = sum(1 for status, _ in results if status == 200)
+    latencies = sorted(latency for _, latency in results)
+    return {
+        'mode': mode,
+        'requests': len(results),
+        'ok': ok,
+        'wall_seconds': round(wall, 2),
+        'requests_per_second': round(len(results) / wall, 2),
+        'p50_seconds': round(latencies[len(latencies) // 2], 2),
+        'max_seconds': round(latencies[-1], 2),
+        'peak_upstream_in_flight': peak,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=2.0, help='mock upstream seconds per call')
+    parser.add_argument('--port', type=int, default=18090)
+    parser.add_argument('--mock-port', type=int, default=18080)
+    parser.add_argument('--modes', default='wsgi,asgi')
+    parser.add_argument('--output', help='write results as JSON to this path')
+    args = parser.parse_args()
+
+    mock = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'mock_ark.py'),
+                             '--port', str(args.mock_port), '--latency', str(args.latency)])
+    try:
+        wait_for(f"http://127.0.0.1:{args.mock_port}/stats")
+        results = []
+        for mode in args.modes.split(','):
+            results.append(run(mode, args))
+            print(json.dumps(results[-1]))
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""Load generator: realistic /generate and /translate traffic against the mock upstream.
+
+    python benchmarks/load_generate.py --requests 300 --concurrency 16 --output results/load.json
+    python benchmarks/load_generate.py --server asgi --mix generate:6,generate_stream:2,translate:2 \\
+        --latency 0.8 --latency-dist lognormal --spread 0.5 --tokens-per-second 80 --error-429 0.02
+
+Starts benchmarks/mock_ark.py and the app (gunicorn or uvicorn, as in load_concurrency.py)
+as subprocesses. All requests are built before the run starts. Each /generate request gets
+1-4 JPEGs of mixed sizes and a random precision level, so the requests differ the way real
+uploads do. Images are made unique with a few trailing bytes after the JPEG end marker;
+decoders ignore these bytes, so every request still pays the full decode. --cache-hit-ratio
+replays earlier payloads to exercise the result cache.
+
+The report gives requests/s and the p50/p95/p99 latency per request kind (time to the first
+event too for streams), status counts, the app's upstream retry/hedge counters and the mock's
+view. --output writes it as JSON together with the settings used, for comparison with
+benchmarks/compare_results.py.
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from PIL import Image
+
+from load_concurrency import ROOT, SERVERS, wait_for
+
+ASPECTS = ['风格', '背景', '构图', '人物外貌', '人物动作', '穿搭', '主体物描述', '光影描述', '画面配色', '摄像机角度']
+TRANSLATE_LINES = [
+    '构图：特写镜头，中心构图，浅景深虚化背景',
+    '风格：赛博朋克风格，数字艺术，高对比度',
+    '光影描述：侧逆光，轮廓光勾勒主体边缘，暗部保留细节',
+    '画面配色：主体为青绿色，背景为暖橙色渐变',
+    '背景：雨夜城市街道，霓虹灯倒影',
+]
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+def summarize(samples, wall):
+    latencies = sorted(sample['seconds'] for sample in samples)
+    statuses = {}
+    for sample in samples:
+        statuses[str(sample['status'])] = statuses.get(str(sample['status']), 0) + 1
+    summary = {
+        'requests': len(samples),
+        'ok': statuses.get('200', 0),
+        'statuses': statuses,
+        'requests_per_second': round(len(samples) / wall, 2) if wall else None,
+        'mean_seconds': round(sum(latencies) / len(latencies), 4) if latencies else None,
+    }
+    for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        value = percentile(latencies, fraction)
+        summary[f'{name}_seconds'] = round(value, 4) if value is not None else None
+    first_events = sorted(sample['first_event'] for sample in samples if sample.get('first_event') is not None)
+    if first_events:
+        summary['p50_first_event_seconds'] = round(percentile(first_events, 0.5), 4)
+        summary['p95_first_event_seconds'] = round(percentile(first_events, 0.95), 4)
+    return summary
+
+
+def make_jpeg(width, height, seed):
+    noise = Image.effect_noise((max(1, width // 8), max(1, height // 8)), 30 + seed % 40).resize((width, height))
+    gradient = Image.linear_gradient('L').resize((width, height))
+    img = Image.merge('RGB', (noise, gradient, Image.eval(noise, lambda v: 255 - v)))
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        kind, _, weight = part.partition(':')
+        if kind not in ('generate', 'generate_stream', 'translate'):
+            raise argparse.ArgumentTypeError(f"unknown request kind: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def parse_range(value):
+    low, _, high = value.partition('-')
+    return int(low), int(high or low)
+
+
+def build_requests(args, rng):
+    sizes = [tuple(int(v) for v in size.split('x')) for size in args.sizes.split(',')]
+    # A few base photos per size; uniqueness comes from the trailing bytes
+    base_images = {size: [make_jpeg(*size, seed) for seed in range(3)] for size in sizes}
+    precisions = args.precisions.split(',')
+    kinds, weights = zip(*args.mix.items())
+    min_images, max_images = args.images
+
+    requests = []
+    previous = []
+    for index in range(args.requests):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == 'translate':
+            lines = rng.sample(TRANSLATE_LINES, rng.randint(2, len(TRANSLATE_LINES)))
+            # The request index keeps the translation memory from answering
+            requests.append({'kind': kind, 'json': {'text': "\n".join(f"{line}，编号{index}" for line in lines)}})
+            continue
+
+        if previous and rng.random() < args.cache_hit_ratio:
+            requests.append(dict(rng.choice(previous), kind=kind))
+            continue
+        count = rng.randint(min_images, max_images)
+        images = []
+        for position in range(count):
+            size = rng.choice(sizes)
+            # Joined with the base photo only when sent, so large runs do not hold every upload in memory
+            tail = index.to_bytes(4, 'big') + position.to_bytes(2, 'big')
+            images.append((f'{index}-{position}.jpg', rng.choice(base_images[size]), tail))
+        options = {
+            str(position): [{'id': aspect, 'weight': rng.choice([1, 1, 2])} for aspect in rng.sample(ASPECTS, 3)]
+            for position in range(count)
+        }
+        request = {
+            'kind': kind,
+            'images': images,
+            'data': {'options': json.dumps(options, ensure_ascii=False), 'precision': rng.choice(precisions),
+                     'thinking': 'false'},
+        }
+        previous.append(request)
+        requests.append(request)
+    return requests
+
+
+def multipart_files(request):
+    return [('images', (name, base + tail, 'image/jpeg')) for name, base, tail in request['images']]
+
+
+async def send(http, base_url, request):
+    kind = request['kind']
+    files = multipart_files(request) if kind != 'translate' else None
+    start = time.perf_counter()
+    first_event = None
+    try:
+        if kind == 'translate':
+            response = await http.post(f"{base_url}/translate", json=request['json'])
+        elif kind == 'generate':
+            response = await http.post(f"{base_url}/generate", files=files, data=request['data'])
+        else:
+            async with http.stream('POST', f"{base_url}/generate/stream", files=files,
+                                   data=request['data']) as response:
+                async for _ in response.aiter_bytes():
+                    if first_event is None:
+                        first_event = time.perf_counter() - start
+        status = response.status_code
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+    return {'kind': kind, 'status': status, 'seconds': time.perf_counter() - start, 'first_event': first_event}
+
+
+async def drive(base_url, requests, concurrency):
+    # Closed loop: `concurrency` clients, each sending its next request when the previous finished
+    queue = asyncio.Queue()
+    for request in requests:
+        queue.put_nowait(request)
+    samples = []
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(timeout=900, limits=limits) as http:
+        async def client():
+            while not queue.empty():
+                samples.append(await send(http, base_url, queue.get_nowait()))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        return samples, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', choices=sorted(SERVERS), default='wsgi')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('generate:7,translate:3'),
+                        help='request kinds and weights: generate, generate_stream, translate')
+    parser.add_argument('--images', type=parse_range, default=(1, 4), help='images per request, e.g. 1-4')
+    parser.add_argument('--sizes', default='640x480,1920x1080,4032x3024', help='image sizes to draw from')
+    parser.add_argument('--precisions', default='1,2,3')
+    parser.add_argument('--cache-hit-ratio', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--port', type=int, default=18090)
+    parser.add_argument('--mock-port', type=int, default=18080)
+    parser.add_argument('--latency', type=float, default=1.0, help='mock seconds to first token')
+    parser.add_argument('--latency-dist', default='fixed')
+    parser.add_argument('--spread', type=float, default=0.0)
+    parser.add_argument('--tokens-per-second', type=float, default=0.0)
+    parser.add_argument('--error-429', type=float, default=0.0)
+    parser.add_argument('--error-5xx', type=float, default=0.0)
+    parser.add_argument('--output', help='write results as JSON to this path')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    build_start = time.perf_counter()
+    requests = build_requests(args, rng)
+    print(f"built {len(requests)} requests in {time.perf_counter() - build_start:.1f}s")
+
+    mock = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, 'benchmarks', 'mock_ark.py'), '--port', str(args.mock_port),
+        '--latency', str(args.latency), '--latency-dist', args.latency_dist, '--spread', str(args.spread),
+        '--tokens-per-second', str(args.tokens_per_second), '--error-429', str(args.error_429),
+        '--error-5xx', str(args.error_5xx), '--seed', str(args.seed),
+    ])
+    env = dict(os.environ,
+               ARK_API_KEY='mock',
+               ARK_BASE_URL=f"http://127.0.0.1:{args.mock_port}/api/v3",
+               CACHE_DIR=tempfile.mkdtemp(prefix='prompt-fusion-bench-'))
+    command = [part.format(port=args.port) for part in SERVERS[args.server]]
+    server = None
+    try:
+        wait_for(f"http://127.0.0.1:{args.mock_port}/stats")
+        server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+        base_url = f"http://127.0.0.1:{args.port}"
+        wait_for(f"{base_url}/cache/stats")
+
+        samples, wall = asyncio.run(drive(base_url, requests, args.concurrency))
+        app_stats = httpx.get(f"{base_url}/cache/stats").json()
+        mock_stats = httpx.get(f"http://127.0.0.1:{args.mock_port}/stats").json()
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        mock.terminate()
+        mock.wait()
+
+    results = {
+        'settings': {key: value for key, value in vars(args).items() if key != 'output'},
+        'wall_seconds': round(wall, 3),
+        'overall': summarize(samples, wall),
+        'by_kind': {kind: summarize([s for s in samples if s['kind'] == kind], wall) for kind in args.mix},
+        'upstream_calls': app_stats['ark_pool']['calls'],
+        'result_cache_hits': app_stats['result_cache']['hits'],
+        'mock': {key: mock_stats[key] for key in ('requests', 'peak_in_flight', 'errors_429', 'errors_5xx')},
+    }
+    print(json.dumps({key: results[key] for key in ('overall', 'by_kind')}, indent=2))
+    print(json.dumps({key: results[key] for key in ('upstream_calls', 'mock')}))
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+"""Local mock of the Ark (OpenAI-compatible) chat completions API.
+
+    python benchmarks/mock_ark.py --port 18080 --latency 1.0
+    python benchmarks/mock_ark.py --latency 0.8 --latency-dist lognormal --spread 0.5 \\
+        --tokens-per-second 60 --error-429 0.02 --error-5xx 0.01 --seed 1
+
+Point the app at it with ARK_BASE_URL=http://127.0.0.1:18080/api/v3 and any ARK_API_KEY.
+
+--latency is the time to first token, drawn per call from --latency-dist (fixed, uniform
+within +/- spread, or lognormal with sigma=spread and the given median). With
+--tokens-per-second the reply is then generated at that rate (one token per character), so
+long replies and streams take realistically long; without it a stream spreads --latency
+over its chunks. --error-429 / --error-5xx are the probabilities of answering with an
+Ark-style rate limit or internal error instead. Streams end with a usage chunk when the
+request asks for stream_options.include_usage. Translation prompts get one line back per
+line sent, so the app's translation memory accepts the answers.
+
+GET /stats reports requests served, injected errors and the peak number of concurrent
+in-flight calls; POST /reset clears the counters; POST /config changes any setting
+({"latency": 2, "error_429": 0.1, ...}) without restarting.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+REPLY = "[Chinese]\n构图：特写镜头，中心构图，浅景深虚化背景。\n风格：赛博朋克风格，数字艺术，高对比度。"
+# app.build_translation_prompt wraps the text between these markers; the mock answers line by line
+TRANSLATION_START = "中文内容：\n"
+TRANSLATION_END = "\n\n要求"
+# Rough prompt cost of one image, reported in usage like the real service
+IMAGE_TOKENS = 800
+CHUNK_CHARS = 8
+
+config = {
+    'latency': 1.0,
+    'latency_dist': 'fixed',
+    'spread': 0.0,
+    'tokens_per_second': 0.0,
+    'reply_chars': len(REPLY),
+    'error_429': 0.0,
+    'error_5xx': 0.0,
+}
+state = {'in_flight': 0, 'peak_in_flight': 0, 'requests': 0, 'errors_429': 0, 'errors_5xx': 0, 'streams': 0}
+rng = random.Random()
+
+
+def sample_latency():
+    latency, spread = config['latency'], config['spread']
+    if config['latency_dist'] == 'uniform':
+        return max(0.0, rng.uniform(latency * (1 - spread), latency * (1 + spread)))
+    if config['latency_dist'] == 'lognormal':
+        return latency * rng.lognormvariate(0, spread)
+    return latency
+
+
+def reply_text():
+    # REPLY repeated (line by line) up to reply_chars
+    if config['reply_chars'] <= len(REPLY):
+        return REPLY[:config['reply_chars']]
+    lines = REPLY.split("\n")[1:]
+    parts = [REPLY]
+    size = len(REPLY)
+    index = 0
+    while size < config['reply_chars']:
+        line = lines[index % len(lines)]
+        parts.append(line)
+        size += len(line) + 1
+        index += 1
+    return "\n".join(parts)
+
+
+def translation_reply(messages):
+    text = messages[-1].get('content') if messages else None
+    if not isinstance(text, str) or TRANSLATION_START not in text:
+        return None
+    source = text.split(TRANSLATION_START, 1)[1].split(TRANSLATION_END, 1)[0]
+    return "\n".join(f"translated ({len(line)} chars), mock" for line in source.strip().split("\n"))
+
+
+def prompt_tokens(messages):
+    total = 0
+    for message in messages:
+        content = message.get('content')
+        for part in (content if isinstance(content, list) else [{'type': 'text', 'text': content or ''}]):
+            total += IMAGE_TOKENS if part.get('type') == 'image_url' else len(part.get('text', ''))
+    return total
+
+
+def usage_body(prompt, completion):
+    return {'prompt_tokens': prompt, 'completion_tokens': completion, 'total_tokens': prompt + completion}
+
+
+def completion_body(content, prompt):
+    return {
+        'id': f"mock-{uuid.uuid4().hex}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': 'mock',
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+        'usage': usage_body(prompt, len(content)),
+    }
+
+
+def chunk_body(content, usage=None):
+    body = {
+        'id': 'mock-stream',
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': 'mock',
+        'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': content}, 'finish_reason': None}],
+    }
+    if usage:
+        body['choices'] = []
+        body['usage'] = usage
+    return body
+
+
+def injected_error():
+    # Same shapes as Ark's error responses, so the SDK raises the matching exception types
+    roll = rng.random()
+    if roll < config['error_429']:
+        state['errors_429'] += 1
+        return JSONResponse({'error': {
+            'code': 'RateLimitExceeded.EndpointRPMExceeded', 'type': 'TooManyRequests',
+            'message': 'The request has exceeded the rate limit (mock).',
+        }}, status_code=429)
+    if roll < config['error_429'] + config['error_5xx']:
+        state['errors_5xx'] += 1
+        return JSONResponse({'error': {
+            'code': 'InternalServiceError', 'type': 'InternalServerError',
+            'message': 'The service encountered an unexpected internal error (mock).',
+        }}, status_code=500)
+    return None
+
+
+async def chat_completions(request):
+    body = await request.json()
+    state['requests'] += 1
+    error = injected_error()
+    if error:
+        return error
+
+    state['in_flight'] += 1
+    state['peak_in_flight'] = max(state['peak_in_flight'], state['in_flight'])
+    first_token = sample_latency()
+    content = translation_reply(body.get('messages', [])) or reply_text()
+    rate = config['tokens_per_second']
+    prompt = prompt_tokens(body.get('messages', []))
+
+    if body.get('stream'):
+        state['streams'] += 1
+        include_usage = (body.get('stream_options') or {}).get('include_usage')
+
+        async def events():
+            try:
+                pieces = [content[i:i + CHUNK_CHARS] for i in range(0, len(content), CHUNK_CHARS)]
+                if rate:
+                    await asyncio.sleep(first_token)
+                for piece in pieces:
+                    await asyncio.sleep(len(piece) / rate if rate else first_token / len(pieces))
+                    yield f"data: {json.dumps(chunk_body(piece), ensure_ascii=False)}\n\n"
+                if include_usage:
+                    yield f"data: {json.dumps(chunk_body('', usage_body(prompt, len(content))))}\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                state['in_flight'] -= 1
+        return StreamingResponse(events(), media_type='text/event-stream')
+
+    try:
+        await asyncio.sleep(first_token + (len(content) / rate if rate else 0))
+        return JSONResponse(completion_body(content, prompt))
+    finally:
+        state['in_flight'] -= 1
+
+
+async def stats(request):
+    return JSONResponse(dict(state, config=config))
+
+
+async def reset(request):
+    state.update(in_flight=0, peak_in_flight=0, requests=0, errors_429=0, errors_5xx=0, streams=0)
+    return JSONResponse(state)
+
+
+async def update_config(request):
+    changes = await request.json()
+    unknown = sorted(set(changes) - set(config))
+    if unknown:
+        return JSONResponse({'error': f"Unknown settings: {', '.join(unknown)}"}, status_code=400)
+    config.update(changes)
+    return JSONResponse(config)
+
+
+app = Starlette(routes=[
+    Route('/api/v3/chat/completions', chat_completions, methods=['POST']),
+    Route('/stats', stats),
+    Route('/reset', reset, methods=['POST']),
+    Route('/config', update_config, methods=['POST']),
+])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--latency', type=float, default=1.0, help='seconds to first token (median for lognormal)')
+    parser.add_argument('--latency-dist', choices=('fixed', 'uniform', 'lognormal'), default='fixed')
+    parser.add_argument('--spread', type=float, default=0.0, help='uniform: +/- fraction of latency; lognormal: sigma')
+    parser.add_argument('--tokens-per-second', type=float, default=0.0, help='completion speed, 0 = instant')
+    parser.add_argument('--reply-chars', type=int, default=len(REPLY), help='length of every reply')
+    parser.add_argument('--error-429', type=float, default=0.0, help='probability of a 429 rate limit error')
+    parser.add_argument('--error-5xx', type=float, default=0.0, help='probability of a 500 internal error')
+    parser.add_argument('--seed', type=int, help='seed the latency and error draws')
+    args = parser.parse_args()
+    config.update(
+        latency=args.latency, latency_dist=args.latency_dist, spread=args.spread,
+        tokens_per_second=args.tokens_per_second, reply_chars=args.reply_chars,
+        error_429=args.error_429, error_5xx=args.error_5xx,
+    )
+    if args.seed is not None:
+        rng.seed(args.seed)
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
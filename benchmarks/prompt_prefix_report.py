@@ -0,0 +1,112 @@
+"""Prompt token report: request layout before and after the precompiled prompt templates.
+
+    python benchmarks/prompt_prefix_report.py
+
+Replays a typical editing session (same images, tags edited, image added, precision changed)
+and estimates, per request, the prompt tokens sent and how many of them form a prefix identical
+to the previous request - the part the provider's prefix cache can serve. Token counts are
+estimates (text: UTF-8 bytes / 3, images: one token per 28x28 patch); real numbers are in
+the per-request JSON log ("tokens") and in prompt_fusion_tokens_total on /metrics.
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import prompt_templates  # noqa: E402
+
+IMAGE_TOKENS = (512 * 384) // (28 * 28)
+
+
+def legacy_units(images, options_map, precision_level, json_output):
+    # Layout before prompt_templates: one user message, image count inside the first text
+    # part and the tags of each image interleaved right after it
+    level = precision_level if precision_level in prompt_templates.PRECISION_LEVELS else "1"
+    word_count, detail_instruction, min_length_instruction = prompt_templates.PRECISION_LEVELS[level]
+    intro = prompt_templates.INTRO_TEMPLATE.replace(
+        "请分析随后提供的图片", f"请分析以下 {len(images)} 张图片"
+    ).format(
+        format_instruction=(prompt_templates.JSON_FORMAT_INSTRUCTION if json_output
+                            else prompt_templates.NATURAL_FORMAT_INSTRUCTION),
+        detail_instruction=detail_instruction,
+        word_count=word_count,
+        min_length_instruction=min_length_instruction,
+    )
+    units = [('text', intro), ('text', prompt_templates.GLOBAL_CONSTRAINTS)]
+    for idx, image in enumerate(images):
+        units.append(('image', image))
+        units.append(('text', prompt_templates.image_tags_text(idx + 1, options_map.get(str(idx), []))))
+    units.append(('text', prompt_templates.FINAL_INSTRUCTION))
+    return units
+
+
+def current_units(images, options_map, precision_level, json_output):
+    messages = prompt_templates.build_fusion_messages(images, options_map, precision_level, json_output)
+    units = [('text', messages[0]['content'])]
+    for part in messages[1]['content']:
+        if part['type'] == 'image_url':
+            units.append(('image', part['image_url']['url']))
+        else:
+            units.append(('text', part['text']))
+    return units
+
+
+def text_tokens(text):
+    return len(text.encode('utf-8')) // 3
+
+
+def total_tokens(units):
+    return sum(IMAGE_TOKENS if kind == 'image' else text_tokens(value) for kind, value in units)
+
+
+def shared_prefix_tokens(previous, current):
+    shared = 0
+    for (kind_a, a), (kind_b, b) in zip(previous, current):
+        if kind_a == kind_b and a == b:
+            shared += IMAGE_TOKENS if kind_a == 'image' else text_tokens(a)
+            continue
+        if kind_a == kind_b == 'text':
+            common = os.path.commonprefix([a, b])
+            shared += text_tokens(common)
+        break
+    return shared
+
+
+SESSION = [
+    ("upload two images", ['img-a', 'img-b'], {'0': ['构图'], '1': ['风格']}, '2'),
+    ("edit tags", ['img-a', 'img-b'], {'0': ['构图', '光影描述'], '1': ['风格']}, '2'),
+    ("edit tags again", ['img-a', 'img-b'], {'0': ['构图'], '1': ['风格', '画面配色']}, '2'),
+    ("add a third image", ['img-a', 'img-b', 'img-c'], {'0': ['构图'], '1': ['风格'], '2': ['穿搭']}, '2'),
+    ("switch to ultra precision", ['img-a', 'img-b', 'img-c'], {'0': ['构图'], '1': ['风格'], '2': ['穿搭']}, '3'),
+    ("new image set", ['img-x'], {'0': ['风格']}, '3'),
+]
+
+
+def replay(layout):
+    rows, previous = [], None
+    for label, images, options_map, precision in SESSION:
+        units = layout(images, options_map, precision, False)
+        total = total_tokens(units)
+        shared = shared_prefix_tokens(previous, units) if previous else 0
+        rows.append({'step': label, 'prompt_tokens': total, 'reusable_prefix_tokens': shared,
+                     'uncached_tokens': total - shared})
+        previous = units
+    return rows
+
+
+def main():
+    report = {'before': replay(legacy_units), 'after': replay(current_units)}
+    for name, rows in report.items():
+        print(f"== {name} ==")
+        for row in rows:
+            print(f"{row['step']:<28} prompt={row['prompt_tokens']:>5}  reusable prefix={row['reusable_prefix_tokens']:>5}"
+                  f"  uncached={row['uncached_tokens']:>5}")
+        print(f"{'total uncached':<28} {sum(row['uncached_tokens'] for row in rows)}")
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
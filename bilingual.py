@@ -0,0 +1,103 @@
+import asyncio
+import concurrent.futures
+
+import metrics
+from translation_memory import split_segments
+
+# Bilingual generation (form field bilingual=true): the English prompt comes with the Chinese
+# one instead of from a later /translate round trip. While the fusion answer is still
+# streaming, every segment that is complete (the next one has started) is translated in the
+# background, in batches with at most one call in flight, through the translation memory.
+# Segments are "维度名：" lines, or sentences (ending in 。/；) of a natural language prompt,
+# which has no line breaks. When the answer ends only its last segments are left to translate;
+# the English text is then assembled from the memory, which also covers segments the final
+# post-processing changed.
+
+
+class SpeculativeTranslation:
+
+    def __init__(self, memory, translate_fn, pool):
+        self.memory = memory
+        self.translate_fn = translate_fn
+        self.pool = pool
+        self.text = ""
+        self._submitted = 0  # Segments of self.text already in a batch
+        self._batches = []   # Futures, in submission order
+        self._reported = 0   # Batches already returned by ready()
+
+    def feed(self, text):
+        # text: the cleaned Chinese output as it streams
+        self.text += text
+        if self._batches and not self._batches[-1].done():
+            return
+        # The last segment may still grow (rest of the line, or continuation lines)
+        complete = split_segments(self.text, sentences=True)[:-1]
+        if len(complete) > self._submitted:
+            self._submit(complete[self._submitted:])
+            self._submitted = len(complete)
+
+    def _submit(self, segments):
+        self._batches.append(self.pool.submit(
+            metrics.propagate(self.memory.translate), "\n".join(segments), self.translate_fn, True))
+
+    def _flush(self):
+        # End of the answer: the remaining segments go out at once, next to a running batch
+        segments = split_segments(self.text, sentences=True)
+        if len(segments) > self._submitted:
+            self._submit(segments[self._submitted:])
+            self._submitted = len(segments)
+
+    @staticmethod
+    def _result(batch):
+        try:
+            return batch.result()
+        except Exception as e:
+            # The final pass translates these lines again
+            print(f"Warning: Speculative translation failed: {e}")
+            return None
+
+    def ready(self):
+        # English text of the batches finished since the last call, in order
+        texts = []
+        while self._reported < len(self._batches) and self._batches[self._reported].done():
+            text = self._result(self._batches[self._reported])
+            if text:
+                texts.append(text)
+            self._reported += 1
+        return texts
+
+    def finish(self, final_text):
+        # English version of the post-processed prompt; raises if the final pass fails
+        self._flush()
+        concurrent.futures.wait(self._batches)
+        translation = self.memory.translate(final_text, self.translate_fn, sentences=True)
+        self._remember_whole(final_text, translation)
+        return translation
+
+    def _remember_whole(self, final_text, translation):
+        # A prompt translated sentence by sentence is also stored whole, where /translate and
+        # the cached bilingual responses look for it
+        if len(split_segments(final_text, sentences=True)) > 1:
+            self.memory.remember(final_text.strip(), translation)
+
+
+class AsyncSpeculativeTranslation(SpeculativeTranslation):
+    # Same for the ASGI app: translate_fn is a coroutine function and batches are tasks
+
+    def __init__(self, memory, translate_fn):
+        super().__init__(memory, translate_fn, None)
+
+    def _submit(self, segments):
+        self._batches.append(asyncio.ensure_future(
+            self.memory.atranslate("\n".join(segments), self.translate_fn, sentences=True)))
+
+    async def finish(self, final_text):
+        self._flush()
+        if self._batches:
+            await asyncio.wait(self._batches)
+        for batch in self._batches:
+            if not batch.cancelled():
+                batch.exception()  # Retrieved, so failed batches are not logged as lost
+        translation = await self.memory.atranslate(final_text, self.translate_fn, sentences=True)
+        await asyncio.to_thread(self._remember_whole, final_text, translation)
+        return translation
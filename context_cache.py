@@ -0,0 +1,85 @@
+import hashlib
+import threading
+import time
+
+
+class PrefixContextCache:
+    # Explicit Ark context cache (mode="common_prefix") for the static system prompt.
+    # One context per distinct prefix; if the API is unavailable for the model/account the
+    # cache backs off and callers fall back to plain chat completions.
+
+    def __init__(self, ttl=3600, retry_after=600):
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self._contexts = {}  # prefix hash -> (context_id, expires_at)
+        self._lock = threading.Lock()
+        self._disabled_until = 0
+        self.created = 0
+        self.reused = 0
+        self.failures = 0
+
+    @staticmethod
+    def key(prefix_messages):
+        text = "".join(str(message['content']) for message in prefix_messages)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _lookup(self, key):
+        now = time.time()
+        if now < self._disabled_until:
+            return False, None
+        with self._lock:
+            entry = self._contexts.get(key)
+            # Leave a minute of slack so a context never expires mid-request
+            if entry and entry[1] > now + 60:
+                self.reused += 1
+                return False, entry[0]
+        return True, None
+
+    def _store(self, key, context_id):
+        with self._lock:
+            self._contexts[key] = (context_id, time.time() + self.ttl)
+            self.created += 1
+        return context_id
+
+    def _disable(self, e):
+        print(f"Warning: Ark context cache unavailable, using plain requests: {e}")
+        self.failures += 1
+        self._disabled_until = time.time() + self.retry_after
+
+    def invalidate(self, key):
+        with self._lock:
+            self._contexts.pop(key, None)
+
+    def context_id(self, client, model, prefix_messages):
+        key = self.key(prefix_messages)
+        needs_create, context_id = self._lookup(key)
+        if not needs_create:
+            return context_id
+        try:
+            response = client.context.create(model=model, messages=prefix_messages, mode="common_prefix", ttl=self.ttl)
+        except Exception as e:
+            self._disable(e)
+            return None
+        return self._store(key, response.id)
+
+    async def acontext_id(self, client, model, prefix_messages):
+        key = self.key(prefix_messages)
+        needs_create, context_id = self._lookup(key)
+        if not needs_create:
+            return context_id
+        try:
+            response = await client.context.create(model=model, messages=prefix_messages, mode="common_prefix", ttl=self.ttl)
+        except Exception as e:
+            self._disable(e)
+            return None
+        return self._store(key, response.id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'contexts': len(self._contexts),
+                'created': self.created,
+                'reused': self.reused,
+                'failures': self.failures,
+                'disabled': time.time() < self._disabled_until,
+            }
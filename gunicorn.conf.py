@@ -0,0 +1,38 @@
+# gunicorn settings for the Flask app: `gunicorn -c gunicorn.conf.py app:app`.
+# The app is imported once in the master (preload_app), together with the Ark SDK, and the
+# workers are forked from it, so they start without importing anything and share those pages
+# copy-on-write. Each worker then starts its own background work and warms its upstream pool.
+import gc
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '7860')}"
+# One worker by default: admission limits and the breaker, singleflight, /metrics, the
+# near-duplicate index and the image store's accounting live in process memory, and more
+# workers would each keep their own. Scale with GUNICORN_THREADS (or SERVE_MODE=asgi) instead.
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+# Generations stream for minutes; request deadlines (DEADLINE_SCALE) bound them instead
+timeout = 0
+preload_app = os.getenv("PRELOAD_APP", "true").lower() == "true"
+
+# Keep app.py from starting job workers at import: threads started in the master would not
+# exist in the forked workers
+os.environ["DEFER_PROCESS_START"] = "true"
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    # The SDK and Pillow's plugins are otherwise loaded on first use; here once for all workers
+    import app
+    app.preload_modules()
+    # Objects created so far are never collected, so the collector does not touch (and copy)
+    # the shared pages in every worker
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import app
+    app.start_process()
+    app.warm_up(int(os.getenv("ARK_WARMUP_CONNECTIONS", "2")))
@@ -0,0 +1,103 @@
+import base64
+import binascii
+import io
+import math
+
+from PIL import Image
+
+from image_preprocess import JPEG_QUALITY, MAX_SIZE
+
+# Per-image encode settings for one request. Each image is sent at the resolution and JPEG
+# quality its selected aspects need (a palette or a style reads fine from a small image, faces,
+# clothing and text do not), scaled by the precision level; when the images of a request would
+# together exceed the token cap, all of them are scaled down until they fit. Vision models
+# bill one token per PATCH_SIZE x PATCH_SIZE patch, so fewer pixels mean a shorter prompt and
+# an earlier first token.
+
+PATCH_SIZE = 28
+# Images are never budgeted below this longest side
+MIN_SIZE = 224
+
+# aspect -> (longest side, JPEG quality) needed to describe it. Custom tags and images without
+# tags get the full MAX_SIZE / JPEG_QUALITY, since nothing is known about what they ask for.
+ASPECT_SETTINGS = {
+    '画面配色': (256, 75),
+    '构图': (320, 75),
+    '摄像机角度': (320, 75),
+    '风格': (384, 80),
+    '场景/环境': (384, 80),
+    '光影描述': (384, JPEG_QUALITY),
+    '人物动作': (448, JPEG_QUALITY),
+    '人物外貌': (MAX_SIZE, JPEG_QUALITY),
+    '穿搭': (MAX_SIZE, JPEG_QUALITY),
+    '主体物描述': (MAX_SIZE, JPEG_QUALITY),
+    '文字/水印': (MAX_SIZE, JPEG_QUALITY),
+}
+
+# Longer descriptions need more detail to draw from
+PRECISION_SCALE = {'1': 0.75, '2': 1.0, '3': 1.25}
+
+
+def image_tokens(width, height):
+    return math.ceil(width / PATCH_SIZE) * math.ceil(height / PATCH_SIZE)
+
+
+def data_url_tokens(data_url):
+    # Estimated tokens of an encoded image, from its dimensions; 0 if it cannot be read
+    try:
+        data = base64.b64decode(data_url.split(',', 1)[1])
+        with Image.open(io.BytesIO(data)) as img:
+            return image_tokens(*img.size)
+    except (IndexError, binascii.Error, Image.UnidentifiedImageError, OSError):
+        return 0
+
+
+def aspect_ids(selected_aspects):
+    return [item.get('id') if isinstance(item, dict) else item for item in selected_aspects]
+
+
+class ImageBudget:
+
+    def __init__(self, token_cap=0, adaptive=True, max_size=MAX_SIZE, quality=JPEG_QUALITY):
+        self.token_cap = token_cap  # Estimated image tokens per request; 0 disables the cap
+        self.adaptive = adaptive    # False sends every image at max_size / quality, as before
+        self.max_size = max_size
+        self.quality = quality
+
+    def snap(self, size):
+        # Budgeted sizes are whole patches; the full size stays as it is, so it keeps matching
+        # the encodings in the image store and the web UI's pre-sized uploads
+        if size >= self.max_size:
+            return self.max_size
+        return max(MIN_SIZE, size // PATCH_SIZE * PATCH_SIZE)
+
+    def image_settings(self, selected_aspects, precision_level):
+        ids = aspect_ids(selected_aspects)
+        if not self.adaptive or not ids or any(aspect not in ASPECT_SETTINGS for aspect in ids):
+            return self.max_size, self.quality
+        size = max(ASPECT_SETTINGS[aspect][0] for aspect in ids)
+        quality = max(ASPECT_SETTINGS[aspect][1] for aspect in ids)
+        size = round(size * PRECISION_SCALE.get(precision_level, 1.0))
+        return self.snap(size), min(quality, self.quality)
+
+    def plan(self, options_map, count, precision_level):
+        # (max_size, quality) for each of the request's images, in order
+        settings = [self.image_settings(options_map.get(str(idx), []), precision_level) for idx in range(count)]
+        if self.token_cap <= 0:
+            return settings
+        sizes = [size for size, _ in settings]
+        qualities = [quality for _, quality in settings]
+
+        # Planned against square images, the most a given longest side can cost, so the cap
+        # holds whatever the aspect ratios. Images already at MIN_SIZE stay there and the others
+        # shrink further, until the total fits or nothing is left to shrink.
+        tokens = lambda size: image_tokens(size, size)
+        while sum(tokens(size) for size in sizes) > self.token_cap:
+            shrinkable = [idx for idx, size in enumerate(sizes) if size > MIN_SIZE]
+            if not shrinkable:
+                break
+            fixed = sum(tokens(size) for idx, size in enumerate(sizes) if idx not in shrinkable)
+            factor = math.sqrt(max(self.token_cap - fixed, 0) / sum(tokens(sizes[idx]) for idx in shrinkable))
+            for idx in shrinkable:
+                sizes[idx] = self.snap(min(math.floor(sizes[idx] * factor), sizes[idx] - 1))
+        return list(zip(sizes, qualities))
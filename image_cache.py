@@ -0,0 +1,62 @@
+import sys
+import threading
+from collections import OrderedDict
+
+
+class ImageCache:
+    # LRU of finished data URLs keyed by upload hash + target size/quality.
+    # Bounded by the memory held by the cached strings, not by entry count.
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (data_url, size, encode_seconds)
+        self._lock = threading.Lock()
+        self.bytes_held = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.encode_seconds_saved = 0.0
+
+    @staticmethod
+    def key(digest, max_size, quality):
+        return f"{digest}:{max_size}:{quality}"
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.encode_seconds_saved += entry[2]
+            return entry[0]
+
+    def put(self, key, data_url, encode_seconds):
+        size = sys.getsizeof(data_url)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes_held -= old[1]
+            self._entries[key] = (data_url, size, encode_seconds)
+            self.bytes_held += size
+            while self.bytes_held > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.bytes_held -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes_held': self.bytes_held,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'encode_seconds_saved': round(self.encode_seconds_saved, 3),
+            }
@@ -0,0 +1,184 @@
+import base64
+import io
+
+from PIL import Image
+
+from image_budget import aspect_ids
+from image_preprocess import downscale, prepare_image
+
+# Colour and light statistics computed locally from the pixels, for the aspects the model
+# would otherwise have to estimate from the image: a dominant palette (k-means in RGB),
+# saturation, brightness and contrast, shadow / highlight shares and the warm / cool balance.
+# They are added to the image's tag block as short text hints, and an image tagged only with
+# aspects the hints fully cover (画面配色 by default) is not sent to the model at all.
+# NumPy is imported on first use, so importing this module costs the app nothing at start.
+
+# Aspects the hints describe
+FEATURE_ASPECTS = ('画面配色', '光影描述')
+# Images are analysed at this longest side; statistics of a thumbnail match the full image
+FEATURE_SIZE = 64
+PALETTE_COLORS = 5
+KMEANS_ITERATIONS = 10
+# Palette colours covering less of the image are left out of the hint
+MIN_SHARE = 0.03
+# Pixels below this saturation or value count as neutral (neither warm nor cool)
+CHROMA_SATURATION = 0.2
+CHROMA_VALUE = 0.15
+
+# (upper bound of hue in degrees, name)
+HUE_NAMES = [
+    (15, '红'), (40, '橙'), (70, '黄'), (90, '黄绿'), (160, '绿'),
+    (200, '青'), (255, '蓝'), (290, '紫'), (345, '品红'), (360, '红'),
+]
+
+
+def load_feature_image(source):
+    # source: an upload (file object), an encoded data URL (decoded straight at FEATURE_SIZE) or
+    # an image already decoded for encoding (only shrunk)
+    if isinstance(source, Image.Image):
+        return downscale(source, FEATURE_SIZE)
+    if isinstance(source, str):
+        source = io.BytesIO(base64.b64decode(source.split(',', 1)[1]))
+    try:
+        return prepare_image(source, FEATURE_SIZE)
+    finally:
+        source.seek(0)
+
+
+def hsv(rgb):
+    # rgb: (N, 3) floats in 0..1 -> hue in degrees, saturation, value
+    import numpy as np
+    high = rgb.max(axis=1)
+    low = rgb.min(axis=1)
+    chroma = high - low
+    safe = np.where(chroma > 0, chroma, 1)
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    hue = np.select(
+        [high == r, high == g],
+        [((g - b) / safe) % 6, (b - r) / safe + 2],
+        (r - g) / safe + 4,
+    ) * 60
+    hue = np.where(chroma > 0, hue, 0)
+    saturation = np.where(high > 0, chroma / np.where(high > 0, high, 1), 0)
+    return hue, saturation, high
+
+
+def kmeans_palette(pixels, colors=PALETTE_COLORS, iterations=KMEANS_ITERATIONS):
+    # Deterministic k-means: centres start at luminance quantiles. Returns [(rgb, share)]
+    # sorted by share, rgb in 0..255.
+    import numpy as np
+    luma = pixels @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    order = np.argsort(luma)
+    picks = order[np.linspace(0, len(order) - 1, colors).astype(int)]
+    centers = pixels[picks].copy()
+    for _ in range(iterations):
+        # Squared distances up to the per-pixel constant |p|^2, as one matrix product
+        distances = (centers ** 2).sum(axis=1) - 2 * pixels @ centers.T
+        labels = distances.argmin(axis=1)
+        counts = np.bincount(labels, minlength=colors)
+        sums = np.stack([np.bincount(labels, weights=pixels[:, c], minlength=colors) for c in range(3)], axis=1)
+        filled = counts > 0
+        updated = centers.copy()
+        updated[filled] = (sums[filled] / counts[filled, None]).astype(np.float32)
+        if np.allclose(updated, centers, atol=1e-3):
+            break
+        centers = updated
+    counts = np.bincount(labels, minlength=colors)
+    palette = [(tuple(int(round(c * 255)) for c in centers[idx]), float(counts[idx] / len(pixels)))
+               for idx in range(colors) if counts[idx]]
+    return sorted(palette, key=lambda entry: entry[1], reverse=True)
+
+
+def extract_features(img):
+    # img: RGB PIL image (ideally already at FEATURE_SIZE)
+    import numpy as np
+    pixels = np.asarray(img, dtype=np.float32).reshape(-1, 3) / 255
+    hue, saturation, value = hsv(pixels)
+    luma = pixels @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    chromatic = (saturation >= CHROMA_SATURATION) & (value >= CHROMA_VALUE)
+    warm = chromatic & ((hue < 70) | (hue >= 330))
+    cool = chromatic & (hue >= 160) & (hue < 290)
+    # Saturation is noise in near-black pixels
+    lit = value >= CHROMA_VALUE
+    return {
+        'palette': kmeans_palette(pixels),
+        'brightness': float(luma.mean()),
+        'contrast': float(luma.std()),
+        'saturation': float(saturation[lit].mean()) if lit.any() else 0.0,
+        'shadows': float((luma < 0.25).mean()),
+        'highlights': float((luma > 0.75).mean()),
+        'warm': float(warm.mean()),
+        'cool': float(cool.mean()),
+    }
+
+
+def color_name(rgb):
+    import numpy as np
+    hue, saturation, value = (float(x[0]) for x in hsv(np.array([rgb], dtype=np.float32) / 255))
+    if value < 0.18:
+        return '黑'
+    if saturation < 0.12:
+        if value > 0.85:
+            return '白'
+        return '浅灰' if value > 0.6 else ('深灰' if value < 0.35 else '灰')
+    name = next(name for bound, name in HUE_NAMES if hue < bound)
+    if value < 0.45:
+        return '深' + name
+    if saturation < 0.4 and value > 0.75:
+        return '浅' + name
+    return name
+
+
+def level(x, low, high, names=('低', '中等', '高')):
+    return names[0] if x < low else (names[2] if x > high else names[1])
+
+
+def palette_hint(features):
+    colors = "，".join(
+        f"{color_name(rgb)} #{rgb[0]:02X}{rgb[1]:02X}{rgb[2]:02X} {share:.0%}"
+        for rgb, share in features['palette'] if share >= MIN_SHARE
+    )
+    warm, cool = features['warm'], features['cool']
+    if warm + cool < 0.1:
+        balance = '以中性色为主'
+    else:
+        balance = '暖色调为主' if warm > cool * 1.5 else ('冷色调为主' if cool > warm * 1.5 else '冷暖平衡')
+    saturation = features['saturation']
+    return (f"主色 {colors}；平均饱和度 {saturation:.2f}（{level(saturation, 0.25, 0.55)}）；"
+            f"暖色 {warm:.0%}、冷色 {cool:.0%}（{balance}）")
+
+
+def light_hint(features):
+    brightness, contrast = features['brightness'], features['contrast']
+    return (f"平均亮度 {brightness:.2f}（{level(brightness, 0.35, 0.65, ('偏暗', '适中', '明亮'))}），"
+            f"对比度 {contrast:.2f}（{level(contrast, 0.15, 0.28, ('柔和', '中等', '强烈'))}），"
+            f"暗部占 {features['shadows']:.0%}、高光占 {features['highlights']:.0%}")
+
+
+HINTS = {'画面配色': palette_hint, '光影描述': light_hint}
+
+
+class FeatureHints:
+
+    def __init__(self, enabled=True, local_only=('画面配色',)):
+        self.enabled = enabled
+        # Images whose tags all fall in this set are described from the hints alone
+        self.local_only = set(local_only) & set(FEATURE_ASPECTS)
+
+    def wanted(self, selected_aspects):
+        if not self.enabled:
+            return []
+        return [aspect for aspect in aspect_ids(selected_aspects) if aspect in HINTS]
+
+    def skip_image(self, selected_aspects):
+        ids = aspect_ids(selected_aspects)
+        return self.enabled and bool(ids) and all(aspect in self.local_only for aspect in ids)
+
+    def hint(self, source, selected_aspects):
+        # Hint text for one image (upload, data URL or decoded image), or None if none of its
+        # aspects has one
+        aspects = self.wanted(selected_aspects)
+        if not aspects:
+            return None
+        features = extract_features(load_feature_image(source))
+        return "\n".join(f"{aspect}：{HINTS[aspect](features)}" for aspect in aspects)
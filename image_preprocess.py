@@ -0,0 +1,217 @@
+import base64
+import concurrent.futures
+import io
+import os
+import time
+
+from PIL import Image
+
+import metrics
+from image_cache import ImageCache
+from result_cache import sha256_file
+from upload_limits import DecodeBudget, check_upload, decode_bytes, open_image, set_mmap_threshold
+
+MAX_SIZE = 512
+JPEG_QUALITY = 85
+DATA_URL_PREFIX = "data:image/jpeg;base64,"
+
+# Uploads that already are what encode_image would produce (the web UI resizes before upload)
+# are sent as they are: JPEG or WebP, no alpha, no rotation, within max_size, and no larger in
+# bytes than a re-encode would be
+PASSTHROUGH_TYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp'}
+PASSTHROUGH_MODES = ('RGB', 'L')
+PASSTHROUGH_BYTES_PER_PIXEL = 0.5
+
+# Modes Pillow can resample directly; anything else (P, 1, I;16, ...) is converted first
+RESAMPLE_MODES = ('RGB', 'RGBA', 'L', 'LA', 'CMYK')
+
+# EXIF orientation tag -> transpose that restores the upright image (same table as ImageOps.exif_transpose)
+EXIF_ORIENTATION = 0x0112
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# Shared across requests; Pillow releases the GIL while decoding, resampling and encoding,
+# so the work is CPU bound and more threads than cores would only contend
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(8, os.cpu_count() or 1))))
+encode_pool = concurrent.futures.ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+
+# Larger images are rejected from their header; 0 disables the check
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(64_000_000)))
+# Memory all threads of the process may hold in decoded images at once; 0 disables the budget
+DECODE_MEMORY_BYTES = int(os.getenv("DECODE_MEMORY_BYTES", str(512 * 1024 * 1024)))
+decode_budget = DecodeBudget(DECODE_MEMORY_BYTES)
+# Allocations above this size bypass malloc arenas, so large decode buffers go back to the OS
+# when freed instead of staying in every thread's arena (glibc only; 0 keeps the allocator
+# defaults). Drafted JPEGs stay below it and keep the faster arena path.
+DECODE_MMAP_THRESHOLD = int(os.getenv("DECODE_MMAP_THRESHOLD", str(8 * 1024 * 1024)))
+if DECODE_MMAP_THRESHOLD > 0:
+    set_mmap_threshold(DECODE_MMAP_THRESHOLD)
+
+
+def check_uploads(files, max_pixels=MAX_IMAGE_PIXELS):
+    # Raises UploadTooLarge for the first image over the pixel limit, reading only headers
+    for f in files:
+        check_upload(f, max_pixels)
+
+
+def open_for_decode(file_obj, max_size=MAX_SIZE):
+    # Header only: the pixel limit and (JPEG) the DCT scale are settled before decoding
+    img = open_image(file_obj, MAX_IMAGE_PIXELS)
+
+    # JPEG: let the decoder scale by 1/2, 1/4 or 1/8 in the DCT domain while staying >= max_size
+    if img.format == 'JPEG':
+        img.draft('RGB', (max_size, max_size))
+    return img
+
+
+def load_image(img):
+    img.load()
+    # Read after load(): for PNG, getexif() decodes the whole image to find a trailing eXIf chunk
+    orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+
+    if img.mode not in RESAMPLE_MODES:
+        has_alpha = img.mode in ('PA', 'RGBa', 'La') or 'transparency' in img.info
+        img = img.convert('RGBA' if has_alpha else 'RGB')
+
+    # Fully opaque alpha (common for screenshots) is dropped so resampling works on fewer bands
+    if img.mode in ('RGBA', 'LA') and img.getchannel('A').getextrema()[0] == 255:
+        img = img.convert(img.mode[:-1])
+    return img, orientation
+
+
+def downscale(img, max_size=MAX_SIZE):
+    # Returns an RGB image no larger than max_size on either side
+    width, height = img.size
+    if width <= max_size and height <= max_size:
+        return to_rgb(img)
+
+    scale = max_size / max(width, height)
+    target = (max(1, round(width * scale)), max(1, round(height * scale)))
+
+    # Cheap box reduction first, keeping at least 2x the target for the final bicubic pass.
+    # Mode conversion happens in between so it never runs at full resolution and the
+    # bicubic pass works on 3 channels without alpha premultiplication.
+    factor = int(1 / scale) // 2
+    if factor >= 2:
+        img = img.reduce(factor)
+    return to_rgb(img).resize(target, Image.Resampling.BICUBIC)
+
+
+def to_rgb(img):
+    if img.mode == 'RGB':
+        return img
+    if img.mode in ('RGBA', 'LA'):
+        # Flatten transparency onto white instead of letting it turn black
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img.convert('RGBA'), mask=img.getchannel('A'))
+        return background
+    # CMYK (including Adobe inverted JPEGs, handled by the JPEG plugin) and L
+    return img.convert('RGB')
+
+
+def prepare_image(file_obj, max_size=MAX_SIZE):
+    # Decoded, upright, RGB image no larger than max_size on either side
+    img = open_for_decode(file_obj, max_size)
+    # Waits while other threads hold the decode memory budget; released once only the small result is left
+    with decode_budget.reserve(decode_bytes(img)):
+        with metrics.span('image_decode'):
+            img, orientation = load_image(img)
+        with metrics.span('image_resize'):
+            img = downscale(img, max_size)
+            if orientation in ORIENTATION_TRANSPOSE:
+                img = img.transpose(ORIENTATION_TRANSPOSE[orientation])
+    return img
+
+
+def to_data_url(img, quality=JPEG_QUALITY):
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    # getbuffer() exposes the bytes without the extra copy buffer.read() would make
+    return DATA_URL_PREFIX + base64.b64encode(buffer.getbuffer()).decode('ascii')
+
+
+def presized_data_url(file_obj, max_size=MAX_SIZE):
+    # Data URL of the upload's own bytes if it can skip decoding and re-encoding, else None
+    size = file_obj.seek(0, io.SEEK_END)
+    file_obj.seek(0)
+    if size > max_size * max_size * PASSTHROUGH_BYTES_PER_PIXEL:
+        return None
+    try:
+        img = Image.open(file_obj)
+        if (img.format not in PASSTHROUGH_TYPES or img.mode not in PASSTHROUGH_MODES
+                or img.width > max_size or img.height > max_size
+                or getattr(img, 'n_frames', 1) > 1
+                or img.getexif().get(EXIF_ORIENTATION, 1) != 1):
+            return None
+        mime_type = PASSTHROUGH_TYPES[img.format]
+    except (Image.UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        return None
+    finally:
+        file_obj.seek(0)
+    return f"data:{mime_type};base64," + base64.b64encode(file_obj.read()).decode('ascii')
+
+
+def encode_image(file_storage, max_size=MAX_SIZE, quality=JPEG_QUALITY, on_decoded=None):
+    # on_decoded(img) is called with the decoded image when the upload is re-encoded
+    file_storage.seek(0)
+    try:
+        data_url = presized_data_url(file_storage, max_size)
+        if data_url:
+            metrics.image_encodes_total.inc(path='passthrough')
+            return data_url
+        img = prepare_image(file_storage, max_size)
+        if on_decoded is not None:
+            on_decoded(img)
+        with metrics.span('image_encode'):
+            data_url = to_data_url(img, quality)
+        metrics.image_encodes_total.inc(path='reencoded')
+        return data_url
+    finally:
+        file_storage.seek(0)  # Reset pointer
+
+
+def encode_image_cached(file_storage, digest=None, cache=None, max_size=MAX_SIZE, quality=JPEG_QUALITY, on_decoded=None):
+    # Same output as encode_image, reusing earlier work for identical uploads
+    if isinstance(file_storage, str):
+        # Already a data URL (images sent as image_store handles), encoded at MAX_SIZE / JPEG_QUALITY.
+        # A smaller target (see image_budget) re-encodes it like an upload.
+        if max_size >= MAX_SIZE and quality >= JPEG_QUALITY:
+            return file_storage
+        file_storage = io.BytesIO(base64.b64decode(file_storage.split(',', 1)[1]))
+    if cache is None:
+        return encode_image(file_storage, max_size, quality, on_decoded)
+    if digest is None:
+        digest = sha256_file(file_storage)
+
+    key = ImageCache.key(digest, max_size, quality)
+    data_url = cache.get(key)
+    if data_url is None:
+        start_time = time.perf_counter()
+        data_url = encode_image(file_storage, max_size, quality, on_decoded)
+        cache.put(key, data_url, time.perf_counter() - start_time)
+    return data_url
+
+
+def encode_images(files, digests=None, cache=None, max_size=MAX_SIZE, quality=JPEG_QUALITY, plans=None, on_decoded=None):
+    # Encode all images of a request concurrently, preserving order.
+    # plans: (max_size, quality) per image (see image_budget), instead of the same for all.
+    # on_decoded(position, img) sees each image decoded for re-encoding, on its encode thread.
+    digests = digests or [None] * len(files)
+    plans = plans or [(max_size, quality)] * len(files)
+    jobs = list(zip(range(len(files)), files, digests, plans))
+
+    def encode(job):
+        position, file_storage, digest, plan = job
+        decoded = (lambda img: on_decoded(position, img)) if on_decoded else None
+        return encode_image_cached(file_storage, digest, cache, *plan, on_decoded=decoded)
+
+    if len(jobs) == 1 or IMAGE_WORKERS == 1:
+        return [encode(job) for job in jobs]
+    return list(encode_pool.map(metrics.propagate(encode), jobs))
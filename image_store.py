@@ -0,0 +1,214 @@
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+# Upload-once image handles: POST /images stores each upload's encoded data URL on disk under
+# the SHA-256 of the upload, and /generate accepts those hashes (form field image_ids) instead
+# of the files. The disk directory is shared by every worker of the host; a file's mtime is its
+# last use, so expiry is checked from it on every get. Each worker keeps an in-memory LRU index
+# of the directory for the size bound: storing an image past max_bytes evicts from the index's
+# least recently used end (re-checking each candidate's mtime, since another worker may have
+# used it since). The index is re-synced from the directory every sync_interval seconds, which
+# picks up other workers' images, removes expired ones and cleans up temp files left behind by
+# a worker that died mid-write. Evicted or expired handles simply miss, and the client uploads
+# the image again.
+
+HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+# Images are written under this prefix and renamed once complete
+TMP_PREFIX = '.upload-'
+# A temp file older than this belongs to a write that never finished
+TMP_MAX_AGE = 600
+# File systems round mtimes; a newer mtime within this many seconds is the same use
+MTIME_SLACK = 0.002
+
+
+def valid_hash(value):
+    # Handles come from clients and become file names; only plain SHA-256 hex digests are accepted
+    return isinstance(value, str) and bool(HASH_RE.match(value))
+
+
+class ImageStore:
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, ttl=86400, max_size=512, quality=85,
+                 sync_interval=60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sync_interval = sync_interval
+        # Part of the file name, so a changed MAX_SIZE / JPEG_QUALITY never serves old encodings
+        self._suffix = f"-{max_size}-{quality}.txt"
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # digest -> (last use, size), least recently used first
+        self._synced_at = 0.0
+        self.bytes_held = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with self._lock:
+                self._sync()
+        except OSError as e:
+            print(f"Warning: Image store disabled ({directory}): {e}")
+            self.directory = None
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest + self._suffix)
+
+    def _scan(self, now):
+        # (last use, digest, size) of every stored image, this worker's or another's. Stale temp
+        # files are removed on the way.
+        found = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                try:
+                    if entry.name.startswith(TMP_PREFIX):
+                        if entry.stat().st_mtime + TMP_MAX_AGE < now:
+                            os.unlink(entry.path)
+                        continue
+                    digest = entry.name[:-len(self._suffix)]
+                    if not entry.name.endswith(self._suffix) or not valid_hash(digest):
+                        continue
+                    stat = entry.stat()
+                except OSError:
+                    continue  # Removed by another worker meanwhile
+                found.append((stat.st_mtime, digest, stat.st_size))
+        return found
+
+    def _sync(self):
+        # Caller holds the lock. Rebuilds the index from the directory, removing expired files,
+        # then evicts until the directory fits max_bytes.
+        now = time.time()
+        self._index = OrderedDict()
+        self.bytes_held = 0
+        for last_used, digest, size in sorted(self._scan(now)):
+            if last_used + self.ttl < now:
+                self._remove(digest)
+                self.expirations += 1
+            else:
+                self._index[digest] = (last_used, size)
+                self.bytes_held += size
+        self._synced_at = now
+        self._evict()
+
+    def _evict(self):
+        # Caller holds the lock
+        while self.bytes_held > self.max_bytes and self._index:
+            digest, (last_used, size) = next(iter(self._index.items()))
+            try:
+                used = os.stat(self._path(digest)).st_mtime
+            except OSError:
+                used = None  # Already removed by another worker
+            if used is not None and used > last_used + MTIME_SLACK:
+                # Used by another worker since this one last saw it
+                self._index[digest] = (used, size)
+                self._index.move_to_end(digest)
+                continue
+            del self._index[digest]
+            self.bytes_held -= size
+            if used is not None:
+                self._remove(digest)
+                self.evictions += 1
+
+    def _track(self, digest, last_used, size):
+        # Caller holds the lock
+        _, old_size = self._index.pop(digest, (None, 0))
+        self._index[digest] = (last_used, size)
+        self.bytes_held += size - old_size
+
+    def _forget(self, digest):
+        # Caller holds the lock
+        _, size = self._index.pop(digest, (None, 0))
+        self.bytes_held -= size
+
+    def put(self, digest, data_url):
+        if self.directory is None or not valid_hash(digest):
+            return False
+        data = data_url.encode('ascii')
+        if len(data) > self.max_bytes:
+            return False
+        # Written under a temp name and renamed, so concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=TMP_PREFIX, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(digest))
+        except OSError as e:
+            print(f"Warning: Failed to store image {digest}: {e}")
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return False
+        with self._lock:
+            try:
+                self._track(digest, os.stat(self._path(digest)).st_mtime, len(data))
+                if time.time() - self._synced_at >= self.sync_interval:
+                    self._sync()
+                else:
+                    self._evict()
+            except OSError as e:
+                print(f"Warning: Failed to sweep image store: {e}")
+        return True
+
+    def get(self, digest):
+        # Data URL for a handle, or None when it is unknown, expired or evicted
+        if self.directory is None or not valid_hash(digest):
+            return None
+        now = time.time()
+        path = self._path(digest)
+        try:
+            if os.stat(path).st_mtime + self.ttl < now:
+                self._remove(digest)
+                with self._lock:
+                    self._forget(digest)
+                    self.expirations += 1
+                    self.misses += 1
+                return None
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Last use lives in the mtime, so every worker and the next start see the same LRU order
+            os.utime(path, (now, now))
+        except OSError:
+            # Evicted by another worker (or never stored)
+            with self._lock:
+                self._forget(digest)
+                self.misses += 1
+            return None
+        with self._lock:
+            self._track(digest, now, len(data))
+            self.hits += 1
+        return data.decode('ascii')
+
+    def get_many(self, digests):
+        # Returns (data URLs in order, digests that must be uploaded again)
+        data_urls = [self.get(digest) for digest in digests]
+        missing = [digest for digest, data_url in zip(digests, data_urls) if data_url is None]
+        return data_urls, list(dict.fromkeys(missing))
+
+    def _remove(self, digest):
+        try:
+            os.unlink(self._path(digest))
+        except OSError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.directory is not None,
+                'entries': len(self._index),
+                'bytes_held': self.bytes_held,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
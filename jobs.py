@@ -0,0 +1,253 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# Job states: queued -> running -> done | error
+TERMINAL_STATES = ('done', 'error')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _process_token(pid):
+    # Boot id + start time of a process (Linux), or None where /proc is not available. Pids are
+    # reused, after a restart in particular; a pid with the same token is the same process.
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            boot_id = f.read().strip()
+        with open(f'/proc/{pid}/stat') as f:
+            # The command name may contain spaces; fields after it start with the state (field 3)
+            start_ticks = f.read().rsplit(')', 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+    return f"{boot_id}:{start_ticks}"
+
+
+def _owner_alive(pid, token):
+    if not pid or not _pid_alive(pid):
+        return False
+    # Rows claimed without a token (older versions, no /proc) fall back to the pid alone
+    return token is None or _process_token(pid) == token
+
+
+class JobQueue:
+    # Persistent batch queue in SQLite with a bounded pool of worker threads.
+    # run_job(payload) returns a JSON-serializable result or raises; the queue records either.
+    # Jobs claimed by a process that no longer exists are re-queued on start, so a worker
+    # restart does not lose them; claims record the pid and the process's start time, so a
+    # reused pid does not keep them. Several processes may share one database file.
+    # Exceptions listed in retry_on put the job back in the queue; if they carry a retry_after
+    # attribute the worker waits that long (at most 30 s) before claiming again.
+
+    def __init__(self, db_path, run_job, workers=2, retention=7 * 86400, poll_interval=1.0, retry_on=()):
+        self.db_path = db_path
+        self.run_job = run_job
+        self.retry_on = retry_on
+        self.workers = workers
+        self.retention = retention
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Condition()
+        self._threads = []
+        self._started = False
+        self._owner_token = None
+        self.completed = 0
+        self.failed = 0
+        self.requeued = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, batch_id TEXT NOT NULL, status TEXT NOT NULL, "
+                "payload TEXT NOT NULL, result TEXT, error TEXT, owner_pid INTEGER, "
+                "created_at REAL NOT NULL, started_at REAL, finished_at REAL)"
+            )
+            columns = [row['name'] for row in db.execute("PRAGMA table_info(jobs)")]
+            if 'owner_token' not in columns:
+                db.execute("ALTER TABLE jobs ADD COLUMN owner_token TEXT")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch_id, created_at)")
+
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def start(self):
+        # Idempotent; call after fork so every process runs its own workers
+        if self._started or self.workers <= 0:
+            return
+        self._started = True
+        self._owner_token = _process_token(os.getpid())
+        self._recover()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _recover(self):
+        with self._connect() as db:
+            db.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'error') AND finished_at < ?",
+                (time.time() - self.retention,),
+            )
+            rows = db.execute("SELECT id, owner_pid, owner_token FROM jobs WHERE status = 'running'").fetchall()
+            orphaned = [row['id'] for row in rows if not _owner_alive(row['owner_pid'], row['owner_token'])]
+            for job_id in orphaned:
+                db.execute(
+                    "UPDATE jobs SET status = 'queued', owner_pid = NULL, owner_token = NULL, started_at = NULL WHERE id = ?",
+                    (job_id,),
+                )
+        if orphaned:
+            print(f"Requeued {len(orphaned)} interrupted jobs")
+
+    def submit(self, payloads):
+        batch_id = uuid.uuid4().hex
+        now = time.time()
+        job_ids = []
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            for offset, payload in enumerate(payloads):
+                job_id = uuid.uuid4().hex
+                # Offset keeps submission order stable for jobs of the same batch
+                db.execute(
+                    "INSERT INTO jobs (id, batch_id, status, payload, created_at) VALUES (?, ?, 'queued', ?, ?)",
+                    (job_id, batch_id, json.dumps(payload, ensure_ascii=False), now + offset * 1e-6),
+                )
+                job_ids.append(job_id)
+            db.execute("COMMIT")
+        with self._wakeup:
+            self._wakeup.notify_all()
+        return batch_id, job_ids
+
+    def _claim(self):
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT id, payload FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                db.execute(
+                    "UPDATE jobs SET status = 'running', owner_pid = ?, owner_token = ?, started_at = ? WHERE id = ?",
+                    (os.getpid(), self._owner_token, time.time(), row['id']),
+                )
+            db.execute("COMMIT")
+        return row
+
+    def _finish(self, job_id, result=None, error=None):
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?",
+                (
+                    'error' if error is not None else 'done',
+                    json.dumps(result, ensure_ascii=False) if error is None else None,
+                    error,
+                    time.time(),
+                    job_id,
+                ),
+            )
+
+    def _requeue(self, job_id):
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = 'queued', owner_pid = NULL, owner_token = NULL, started_at = NULL WHERE id = ?",
+                (job_id,),
+            )
+
+    def _worker(self):
+        # Nothing may end the thread: a failed claim or status update (database locked, disk
+        # full, ...) is logged and the loop carries on after a pause
+        while True:
+            try:
+                row = self._claim()
+                if row is None:
+                    with self._wakeup:
+                        self._wakeup.wait(self.poll_interval)
+                    continue
+                self._run(row)
+            except Exception as e:
+                print(f"Error in job worker: {e}")
+                time.sleep(self.poll_interval)
+
+    def _run(self, row):
+        try:
+            result = self.run_job(json.loads(row['payload']))
+        except self.retry_on as e:
+            self.requeued += 1
+            self._requeue(row['id'])
+            time.sleep(min(getattr(e, 'retry_after', self.poll_interval), 30))
+        except Exception as e:
+            print(f"Error in job {row['id']}: {e}")
+            self.failed += 1
+            self._finish(row['id'], error=str(e))
+        else:
+            self.completed += 1
+            self._finish(row['id'], result=result)
+
+    @staticmethod
+    def _public(row):
+        return {
+            'id': row['id'],
+            'batch_id': row['batch_id'],
+            'status': row['status'],
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error'],
+            'created_at': row['created_at'],
+            'started_at': row['started_at'],
+            'finished_at': row['finished_at'],
+        }
+
+    def get(self, job_id):
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._public(row) if row else None
+
+    def batch(self, batch_id):
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT * FROM jobs WHERE batch_id = ? ORDER BY created_at", (batch_id,)
+            ).fetchall()
+        return [self._public(row) for row in rows]
+
+    def follow(self, batch_id, poll_interval=0.5):
+        # Yields each job of a batch once it reaches a terminal state, in completion order
+        reported = set()
+        while True:
+            jobs = self.batch(batch_id)
+            if not jobs:
+                return
+            finished = sorted(
+                (job for job in jobs if job['status'] in TERMINAL_STATES and job['id'] not in reported),
+                key=lambda job: job['finished_at'],
+            )
+            for job in finished:
+                reported.add(job['id'])
+                yield job
+            if len(reported) == len(jobs):
+                return
+            time.sleep(poll_interval)
+
+    def stats(self):
+        with self._connect() as db:
+            counts = dict(db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {
+            'workers': self.workers,
+            'queued': counts.get('queued', 0),
+            'running': counts.get('running', 0),
+            'done': counts.get('done', 0),
+            'error': counts.get('error', 0),
+            'completed_by_this_process': self.completed,
+            'failed_by_this_process': self.failed,
+            'requeued_by_this_process': self.requeued,
+        }
@@ -0,0 +1,251 @@
+import json
+import re
+
+# JSON output mode (prompt_templates.JSON_FORMAT_INSTRUCTION) asks for {"prompts": {"<aspect>": "..."}}.
+# JsonFieldStream scans the model output as it arrives and reports each dimension field as soon
+# as its value is closed; finish() then builds the final object, repairing code fences, stray
+# text, trailing commas and truncated output, and check_prompts() validates it against the
+# aspect IDs the user selected.
+
+TRAILING_COMMA_RE = re.compile(r',(\s*[}\]])')
+# Inside a string only quotes and backslashes matter; the scanner jumps straight to them
+STRING_SPECIAL_RE = re.compile(r'["\\]')
+WRAPPER_KEY = 'prompts'
+
+
+def _loads(text):
+    # strict=False accepts raw newlines inside strings, which models often emit
+    return json.loads(text, strict=False)
+
+
+class JsonFieldStream:
+    def __init__(self):
+        self.buffer = ""
+        self.fields = {}
+        self._pos = 0
+        self._root_start = None
+        self._root_end = None
+        self._stack = []          # One entry per open object/array: [kind, key, expecting]
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._container_depth = 1  # Depth of the object holding the dimension fields
+        self._value_start = None   # Buffer index where the current field value started
+        self._value_key = None
+
+    def feed(self, text):
+        # Returns the (key, value) fields completed by this chunk
+        self.buffer += text
+        completed = []
+        buffer = self.buffer
+        pos = self._pos
+        while pos < len(buffer):
+            if self._in_string and not self._escape:
+                match = STRING_SPECIAL_RE.search(buffer, pos)
+                if not match:
+                    break
+                pos = match.start()
+            field = self._step(buffer[pos], pos)
+            if field:
+                completed.append(field)
+            pos += 1
+        self._pos = len(buffer)
+        return completed
+
+    def _step(self, char, pos):
+        if self._root_end is not None:
+            return None
+        if self._root_start is None:
+            # Code fences and any preamble before the first brace are skipped
+            if char == '{':
+                self._root_start = pos
+                self._stack.append(['{', None, 'key'])
+            return None
+
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif char == '\\':
+                self._escape = True
+            elif char == '"':
+                self._in_string = False
+                return self._string_closed(pos)
+            return None
+
+        depth = len(self._stack)
+        top = self._stack[-1]
+        if char == '"':
+            self._in_string = True
+            self._string_start = pos
+            if top[0] == '{' and top[2] == 'value':
+                self._value_opened(pos, depth)
+        elif char in '{[':
+            if top[0] == '{' and top[2] == 'value':
+                if depth == 1 and top[1] == WRAPPER_KEY and char == '{':
+                    self._container_depth = 2
+                else:
+                    self._value_opened(pos, depth)
+            self._stack.append([char, None, 'key' if char == '{' else 'value'])
+        elif char in '}]':
+            field = self._primitive_closed(pos, depth)
+            self._stack.pop()
+            if not self._stack:
+                self._root_end = pos + 1
+                return field
+            parent = self._stack[-1]
+            if parent[0] == '{':
+                parent[2] = 'done'
+            return field or self._value_closed(pos + 1, len(self._stack))
+        elif char == ':':
+            if top[0] == '{':
+                top[2] = 'value'
+        elif char == ',':
+            field = self._primitive_closed(pos, depth)
+            if top[0] == '{':
+                top[1], top[2] = None, 'key'
+            return field
+        elif not char.isspace() and top[0] == '{' and top[2] == 'value':
+            # Number, true/false/null
+            self._value_opened(pos, depth)
+            top[2] = 'primitive'
+        return None
+
+    def _value_opened(self, pos, depth):
+        top = self._stack[-1]
+        if depth == self._container_depth and self._value_start is None and not (depth == 1 and top[1] == WRAPPER_KEY):
+            self._value_start = pos
+            self._value_key = top[1]
+
+    def _string_closed(self, pos):
+        top = self._stack[-1]
+        raw = self.buffer[self._string_start:pos + 1]
+        if top[0] == '{' and top[2] == 'key':
+            top[1] = _loads(raw)
+            return None
+        if top[0] == '{' and top[2] == 'value':
+            top[2] = 'done'
+            return self._value_closed(pos + 1, len(self._stack))
+        return None
+
+    def _primitive_closed(self, pos, depth):
+        top = self._stack[-1]
+        if top[0] == '{' and top[2] == 'primitive':
+            top[2] = 'done'
+            return self._value_closed(pos, depth)
+        return None
+
+    def _value_closed(self, end, depth):
+        if self._value_start is None or depth != self._container_depth:
+            return None
+        raw = self.buffer[self._value_start:end].strip()
+        key, self._value_start, self._value_key = self._value_key, None, None
+        try:
+            value = _loads(raw)
+        except ValueError:
+            return None
+        self.fields[key] = value
+        return key, value
+
+    @property
+    def complete(self):
+        return self._root_end is not None
+
+    def finish(self):
+        # Returns (object or None, repairs applied)
+        repairs = []
+        if self._root_start is None:
+            return None, ['no_json_object']
+        outside = self.buffer[:self._root_start] + (self.buffer[self._root_end:] if self.complete else "")
+        if '```' in outside:
+            repairs.append('stripped_code_fence')
+        elif outside.strip():
+            repairs.append('stripped_text')
+
+        if self.complete:
+            raw = self.buffer[self._root_start:self._root_end]
+            try:
+                return _loads(raw), repairs
+            except ValueError:
+                pass
+            try:
+                return _loads(TRAILING_COMMA_RE.sub(r'\1', raw)), repairs + ['removed_trailing_comma']
+            except ValueError:
+                pass
+            return self._from_fields(), repairs + ['rebuilt_from_fields']
+
+        # Truncated output: keep every completed field, plus the one cut off mid-string
+        fields = dict(self.fields)
+        if self._in_string and self._value_start is not None and self.buffer[self._value_start] == '"':
+            partial = self.buffer[self._value_start:].rstrip('\\')
+            try:
+                fields[self._value_key] = _loads(partial + '"')
+            except ValueError:
+                pass
+        return self._from_fields(fields), repairs + ['closed_truncated_output']
+
+    def _from_fields(self, fields=None):
+        return {WRAPPER_KEY: dict(self.fields if fields is None else fields)}
+
+    def result(self, aspects):
+        # finish() + check_prompts(); returns (result or None, report)
+        obj, repairs = self.finish()
+        if obj is None:
+            return None, {'valid': False, 'repairs': repairs, 'missing': list(aspects), 'unexpected': []}
+        return check_prompts(obj, aspects, repairs)
+
+
+def selected_aspects(options_map):
+    # Aspect IDs selected for any image, in first-seen order
+    aspects = []
+    for items in options_map.values():
+        for item in items:
+            aspect = item.get('id') if isinstance(item, dict) else item
+            if aspect and aspect not in aspects:
+                aspects.append(aspect)
+    return aspects
+
+
+def _as_text(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, list):
+        return "，".join(_as_text(item) for item in value)
+    return json.dumps(value, ensure_ascii=False)
+
+
+def check_prompts(obj, aspects, repairs=()):
+    # Normalizes to {"prompts": {aspect: text}}. Aspects that were not selected are kept and
+    # listed as unexpected; null values count as missing.
+    # Returns (result, report); report lists repairs and missing / unexpected aspects.
+    repairs = list(repairs)
+    prompts = obj.get(WRAPPER_KEY) if isinstance(obj, dict) else None
+    if not isinstance(prompts, dict):
+        # Flat {"构图": "..."} without the wrapper
+        prompts = {key: value for key, value in (obj or {}).items() if key != WRAPPER_KEY}
+        repairs.append('added_prompts_wrapper')
+
+    result = {}
+    unexpected = []
+    for key, value in prompts.items():
+        if value is None:
+            continue
+        if aspects and key not in aspects:
+            unexpected.append(key)
+        if not isinstance(value, str):
+            repairs.append('coerced_to_text')
+        result[key] = _as_text(value)
+    missing = [aspect for aspect in aspects if aspect not in result]
+    report = {
+        'valid': not repairs and not missing and not unexpected,
+        'repairs': sorted(set(repairs), key=repairs.index),
+        'missing': missing,
+        'unexpected': unexpected,
+    }
+    return {WRAPPER_KEY: result}, report
+
+
+def parse_json_prompt(text, aspects):
+    # Whole-text variant for non-streaming responses; returns (result or None, report)
+    stream = JsonFieldStream()
+    stream.feed(text)
+    return stream.result(aspects)
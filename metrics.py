@@ -0,0 +1,427 @@
+import contextvars
+import functools
+import json
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Prometheus text exposition (format 0.0.4) without the client library: counters, histograms and
+# gauges read from callbacks at scrape time. Per-request spans are collected on a Trace held in a
+# context variable and written as one JSON log line when the request (or its stream) finishes.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+REQUEST_ID_HEADER = 'X-Request-ID'
+# Incoming request IDs are reused only when they are short and header/log safe
+REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9._:-]{1,64}$')
+
+# Seconds, from in-memory image work up to thinking-mode generations
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs):
+    pairs = list(pairs)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f'{self.name}{_labels(zip(self.labelnames, key))} {_number(value)}' for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Per-bucket counts (not cumulative), then sum and count
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        lines = []
+        for key, counts in sorted(values.items()):
+            pairs = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(pairs + [("le", _number(bound))])} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(pairs)} {_number(round(counts[-2], 6))}')
+            lines.append(f'{self.name}_count{_labels(pairs)} {counts[-1]}')
+        return lines
+
+
+class CallbackMetric(_Metric):
+    # Values owned by another component (admission, pools, caches), read at scrape time.
+    # read() returns a number, or a dict of label-value tuples to numbers.
+
+    def __init__(self, name, documentation, read, labelnames=(), kind='gauge'):
+        super().__init__(name, documentation, labelnames)
+        self.read = read
+        self.kind = kind
+
+    def samples(self):
+        try:
+            values = self.read()
+        except Exception as e:
+            print(f"Warning: Failed to read metric {self.name}: {e}")
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [
+            f'{self.name}{_labels(zip(self.labelnames, key if isinstance(key, tuple) else (key,)))} {_number(value)}'
+            for key, value in sorted(values.items()) if value is not None
+        ]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name, documentation, read, labelnames=(), kind='gauge'):
+        return self.register(CallbackMetric(name, documentation, read, labelnames, kind))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+requests_total = registry.counter(
+    'prompt_fusion_requests_total', 'HTTP requests by route and status.', ('method', 'route', 'status'))
+request_seconds = registry.histogram(
+    'prompt_fusion_request_duration_seconds', 'HTTP request duration, including streamed bodies.', ('route',))
+stage_seconds = registry.histogram(
+    'prompt_fusion_stage_duration_seconds', 'Time spent per processing stage.', ('stage',))
+upstream_ttfb_seconds = registry.histogram(
+    'prompt_fusion_upstream_ttfb_seconds', 'Ark call time to first byte (first chunk for streams).', ('endpoint',))
+upstream_seconds = registry.histogram(
+    'prompt_fusion_upstream_duration_seconds', 'Ark call duration until the last byte.', ('endpoint', 'outcome'))
+tokens_total = registry.counter(
+    'prompt_fusion_tokens_total', 'Tokens reported in Ark usage.', ('endpoint', 'type'))
+image_bytes_total = registry.counter(
+    'prompt_fusion_image_bytes_sent_total', 'Bytes of image data URLs sent to Ark.', ('endpoint',))
+image_tokens_total = registry.counter(
+    'prompt_fusion_image_tokens_sent_total', 'Estimated prompt tokens of the images sent to Ark (one per 28x28 patch).', ('endpoint',))
+image_encodes_total = registry.counter(
+    'prompt_fusion_image_encodes_total', 'Uploaded images re-encoded or passed through as already sized.', ('path',))
+images_described_locally_total = registry.counter(
+    'prompt_fusion_images_described_locally_total', 'Images not sent to Ark because local features describe all their aspects.')
+near_duplicate_lookups_total = registry.counter(
+    'prompt_fusion_near_duplicate_lookups_total', 'Result cache lookups under the hashes of near-duplicate images, by outcome.', ('outcome',))
+requests_coalesced_total = registry.counter(
+    'prompt_fusion_requests_coalesced_total', 'Requests that waited on an identical in-flight request instead of calling Ark.', ('kind',))
+uploads_rejected_total = registry.counter(
+    'prompt_fusion_uploads_rejected_total', 'Uploads rejected with 413 before decoding.', ('reason',))
+
+
+class Trace:
+    # Everything recorded while serving one request; worker threads append through propagate()
+
+    def __init__(self, request_id, method, path):
+        self.request_id = request_id
+        self.method = method
+        self.path = path
+        self.start = time.perf_counter()
+        self.spans = []
+        self.tokens = {}
+        self.image_bytes = 0
+        self.image_tokens = 0
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def add_span(self, stage, seconds, **attrs):
+        with self._lock:
+            self.spans.append(dict(stage=stage, seconds=round(seconds, 4), **attrs))
+
+    def add_tokens(self, kind, amount):
+        with self._lock:
+            self.tokens[kind] = self.tokens.get(kind, 0) + amount
+
+    def add_image_bytes(self, amount):
+        with self._lock:
+            self.image_bytes += amount
+
+    def add_image_tokens(self, amount):
+        with self._lock:
+            self.image_tokens += amount
+
+
+_current = contextvars.ContextVar('prompt_fusion_trace', default=None)
+
+
+def current_trace():
+    return _current.get()
+
+
+def request_id(incoming=None):
+    if incoming and REQUEST_ID_RE.match(incoming):
+        return incoming
+    return uuid.uuid4().hex
+
+
+def start_trace(method, path, incoming_id=None):
+    trace = Trace(request_id(incoming_id), method, path)
+    _current.set(trace)
+    return trace
+
+
+def clear_trace():
+    # For untraced requests (scrapes) on a thread that served a traced one before
+    _current.set(None)
+
+
+def finish_trace(trace, status, route):
+    # Called once the response body is complete; later calls are ignored
+    with trace._lock:
+        if trace.finished:
+            return
+        trace.finished = True
+    seconds = time.perf_counter() - trace.start
+    requests_total.inc(method=trace.method, route=route, status=status)
+    request_seconds.observe(seconds, route=route)
+    log(
+        'request',
+        request_id=trace.request_id,
+        method=trace.method,
+        path=trace.path,
+        route=route,
+        status=status,
+        seconds=round(seconds, 4),
+        spans=trace.spans,
+        tokens=trace.tokens,
+        image_bytes_sent=trace.image_bytes,
+        image_tokens_sent=trace.image_tokens,
+    )
+    if _current.get() is trace:
+        _current.set(None)
+
+
+def propagate(fn):
+    # Run fn (on a pool thread) with the caller's context, so its spans land on the caller's trace
+    context = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return wrapper
+
+
+def log(event, **fields):
+    # One JSON object per line on stdout
+    record = {'ts': round(time.time(), 3), 'event': event}
+    if 'request_id' not in fields:
+        trace = _current.get()
+        if trace:
+            record['request_id'] = trace.request_id
+    record.update(fields)
+    print(json.dumps(record, ensure_ascii=False, default=str), flush=True)
+
+
+def record_stage(stage, seconds, **attrs):
+    stage_seconds.observe(seconds, stage=stage)
+    trace = _current.get()
+    if trace:
+        trace.add_span(stage, seconds, **attrs)
+
+
+@contextmanager
+def span(stage, **attrs):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start_time, **attrs)
+
+
+def record_upstream(endpoint, ttfb, seconds, outcome='ok'):
+    if ttfb is not None:
+        upstream_ttfb_seconds.observe(ttfb, endpoint=endpoint)
+    upstream_seconds.observe(seconds, endpoint=endpoint, outcome=outcome)
+    trace = _current.get()
+    if trace:
+        trace.add_span('upstream', seconds, endpoint=endpoint, outcome=outcome,
+                       ttfb=round(ttfb, 4) if ttfb is not None else None)
+
+
+def record_usage(endpoint, usage):
+    if not usage:
+        return
+    prompt_details = getattr(usage, 'prompt_tokens_details', None)
+    completion_details = getattr(usage, 'completion_tokens_details', None)
+    counts = {
+        'prompt': getattr(usage, 'prompt_tokens', 0),
+        'completion': getattr(usage, 'completion_tokens', 0),
+        'cached': getattr(prompt_details, 'cached_tokens', 0) if prompt_details else 0,
+        'reasoning': getattr(completion_details, 'reasoning_tokens', 0) if completion_details else 0,
+    }
+    trace = _current.get()
+    for kind, amount in counts.items():
+        if amount:
+            tokens_total.inc(amount, endpoint=endpoint, type=kind)
+            if trace:
+                trace.add_tokens(kind, amount)
+
+
+def record_image_bytes(endpoint, messages):
+    total = 0
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, list):
+            for part in content:
+                if part.get('type') == 'image_url':
+                    total += len(part['image_url']['url'])
+    if total:
+        image_bytes_total.inc(total, endpoint=endpoint)
+        trace = _current.get()
+        if trace:
+            trace.add_image_bytes(total)
+
+
+def record_image_tokens(endpoint, tokens):
+    if tokens:
+        image_tokens_total.inc(tokens, endpoint=endpoint)
+        trace = _current.get()
+        if trace:
+            trace.add_image_tokens(tokens)
+
+
+def image_tokens_sent():
+    # Image tokens recorded so far for the current request
+    trace = _current.get()
+    return trace.image_tokens if trace else 0
+
+
+class TimedStream:
+    # Wraps an upstream chat completion stream: time to first chunk, total time and the usage
+    # chunk (sent last when stream_options.include_usage is set) are recorded when it ends
+
+    def __init__(self, stream, endpoint, start_time):
+        self._stream = stream
+        self._endpoint = endpoint
+        self._start_time = start_time
+        self._ttfb = None
+        self._done = False
+        self._trace = _current.get()
+
+    def _chunk(self, chunk):
+        if self._ttfb is None:
+            self._ttfb = time.perf_counter() - self._start_time
+        usage = getattr(chunk, 'usage', None)
+        if usage:
+            self._record(lambda: record_usage(self._endpoint, usage))
+
+    def _record(self, fn):
+        # Streams are consumed after the view returns; record against the request's trace
+        if self._trace is None or _current.get() is self._trace:
+            return fn()
+        token = _current.set(self._trace)
+        try:
+            return fn()
+        finally:
+            _current.reset(token)
+
+    def _finish(self, outcome):
+        if not self._done:
+            self._done = True
+            seconds = time.perf_counter() - self._start_time
+            self._record(lambda: record_upstream(self._endpoint, self._ttfb, seconds, outcome))
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                self._chunk(chunk)
+                yield chunk
+            self._finish('ok')
+        except Exception:
+            self._finish('error')
+            raise
+        finally:
+            self._finish('closed')
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                self._chunk(chunk)
+                yield chunk
+            self._finish('ok')
+        except Exception:
+            self._finish('error')
+            raise
+        finally:
+            self._finish('closed')
+
+    def close(self):
+        close = getattr(self._stream, 'close', None)
+        if close:
+            close()
+        self._finish('closed')
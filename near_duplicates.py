@@ -0,0 +1,195 @@
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from image_budget import aspect_ids
+from image_features import load_feature_image
+
+# Near-duplicate images: the same reference picture re-saved, recompressed, resized or
+# screenshotted hashes to different bytes, so the result cache (keyed by upload hashes) misses
+# it. Every image gets a perceptual signature: a DCT hash (pHash) and a gradient hash (dHash) of
+# its grayscale thumbnail, plus the mean colours of its quadrants (both hashes are blind to
+# hue, and a palette request must not get another colour's prompt). Signatures go into a
+# BK-tree; an image whose signature is within its allowed distance of an indexed one is treated
+# as that image (its canonical hash), and results are also cached under the canonical hashes.
+#
+# Only coarse aspects tolerate that: a caption or watermark added to a picture, or a changed
+# face, moves the signature less than a recompression does. Images tagged with any aspect not
+# in ASPECT_DISTANCES (or a custom tag) keep their exact upload hash.
+
+HASH_SIZE = 8
+DCT_SIZE = 32
+# Quadrant mean colours match within COLOR_STEP * distance levels per channel
+COLOR_STEP = 4
+# Allowed distance per aspect; an image gets the smallest of its aspects'
+ASPECT_DISTANCES = {
+    '画面配色': 3,
+    '光影描述': 2,
+    '构图': 4,
+    '摄像机角度': 4,
+}
+
+
+@lru_cache(maxsize=1)
+def dct_matrix():
+    # DCT-II basis for pHash, built on first use
+    import numpy as np
+    n = np.arange(DCT_SIZE)
+    return np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * DCT_SIZE))
+
+
+def bits_to_int(bits):
+    import numpy as np
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+
+def phash(gray):
+    import numpy as np
+    basis = dct_matrix()
+    pixels = np.asarray(gray.resize((DCT_SIZE, DCT_SIZE)), dtype=np.float64)
+    low = (basis @ pixels @ basis.T)[:HASH_SIZE, :HASH_SIZE]
+    # The DC term only carries the overall brightness
+    return bits_to_int(low > np.median(low.ravel()[1:]))
+
+
+def dhash(gray):
+    import numpy as np
+    pixels = np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE)), dtype=np.int16)
+    return bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def signature(source):
+    # source: an upload (file object) or a data URL. Returns (phash, dhash, quadrant colours).
+    import numpy as np
+    img = load_feature_image(source)
+    gray = img.convert('L')
+    colors = tuple(int(c) for c in np.asarray(img.resize((2, 2)), dtype=np.uint8).ravel())
+    return phash(gray), dhash(gray), colors
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def distance(a, b):
+    # Max of metrics, so still a metric as the BK-tree needs
+    color = max(abs(x - y) for x, y in zip(a[2], b[2]))
+    return max(hamming(a[0], b[0]), hamming(a[1], b[1]), -(-color // COLOR_STEP))
+
+
+class BKTree:
+
+    def __init__(self):
+        self.root = None  # [signature, digest, {distance: child}]
+
+    def add(self, sig, digest):
+        if self.root is None:
+            self.root = [sig, digest, {}]
+            return
+        node = self.root
+        while True:
+            d = distance(sig, node[0])
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [sig, digest, {}]
+                return
+            node = child
+
+    def nearest(self, sig, max_distance):
+        # (distance, digest) of the closest entry within max_distance, or None
+        best = None
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            d = distance(sig, node[0])
+            if d <= max_distance and (best is None or d < best[0]):
+                best = (d, node[1])
+            for child_distance, child in node[2].items():
+                if d - max_distance <= child_distance <= d + max_distance:
+                    stack.append(child)
+        return best
+
+
+class NearDuplicateIndex:
+    # Per process, in memory. Bounded to max_entries canonical images; when full the oldest
+    # quarter is dropped and the tree rebuilt. max_distance caps the per-aspect distances.
+
+    def __init__(self, max_distance=4, max_entries=4096):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # canonical digest -> signature
+        self._aliases = OrderedDict()  # digest -> (canonical digest, distance to it)
+        self._tree = BKTree()
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+
+    def allowed_distance(self, selected_aspects):
+        # Distance within which an image with these tags may stand in for another; None if
+        # only the exact image will do
+        ids = aspect_ids(selected_aspects)
+        if not ids or any(aspect not in ASPECT_DISTANCES for aspect in ids):
+            return None
+        return min(self.max_distance, min(ASPECT_DISTANCES[aspect] for aspect in ids))
+
+    def canonical(self, images, digests, aspects):
+        # Canonical hash per image: its own for a new look (which is indexed) or for fine-detail
+        # tags, else that of the indexed near-duplicate. None if an image cannot be read.
+        result = []
+        for image, digest, selected_aspects in zip(images, digests, aspects):
+            max_distance = self.allowed_distance(selected_aspects)
+            if max_distance is None:
+                result.append(digest)
+                continue
+            with self._lock:
+                canonical, alias_distance = self._aliases.get(digest, (None, None))
+                if canonical in self._entries and alias_distance <= max_distance:
+                    self._aliases.move_to_end(digest)
+                    self._entries.move_to_end(canonical)
+                    result.append(canonical)
+                    continue
+            try:
+                sig = signature(image)
+            except Exception as e:
+                print(f"Warning: Perceptual hash failed for {digest}: {e}")
+                return None
+            with self._lock:
+                match = self._tree.nearest(sig, max_distance)
+                if match:
+                    alias_distance, canonical = match
+                    self._entries.move_to_end(canonical)
+                else:
+                    alias_distance, canonical = 0, digest
+                    self._add(digest, sig)
+                self._aliases[digest] = (canonical, alias_distance)
+                while len(self._aliases) > self.max_entries * 4:
+                    self._aliases.popitem(last=False)
+            result.append(canonical)
+        return result
+
+    def _add(self, digest, sig):
+        # Caller holds the lock
+        self._entries[digest] = sig
+        self._tree.add(sig, digest)
+        if len(self._entries) > self.max_entries:
+            for _ in range(len(self._entries) - self.max_entries * 3 // 4):
+                self._entries.popitem(last=False)
+            self._tree = BKTree()
+            for kept, kept_sig in self._entries.items():
+                self._tree.add(kept_sig, kept)
+
+    def record(self, hit):
+        with self._lock:
+            self.lookups += 1
+            self.hits += int(hit)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'images': len(self._entries),
+                'max_entries': self.max_entries,
+                'max_distance': self.max_distance,
+                'aspects': {aspect: min(self.max_distance, d) for aspect, d in ASPECT_DISTANCES.items()},
+                'lookups': self.lookups,
+                'hits': self.hits,
+            }
@@ -0,0 +1,257 @@
+# Prompt assembly for direct fusion. Everything that does not depend on the request is built
+# once at import, per precision level and output mode, and sent as an identical leading system
+# message so the provider's prefix/context cache can reuse it. Images follow in upload order and
+# the per-image tag block comes last, so editing tags keeps the image prefix cacheable too
+# (unless the edit changes the size image_budget picks for an image). Local colour and light
+# measurements (image_features) go into the tag block of their image; an image described from
+# them alone is announced by a text line in place of the image.
+
+# Aspect Definitions (Reused)
+ASPECT_PROMPTS = {
+        "风格": "仅提取艺术风格关键词（如：赛博朋克、水墨画、极简主义）。警告：严禁描述画面里的具体事物（如：建筑、街道、人物）！只输出风格流派、笔触、艺术形式！",
+        "场景/环境": "仅提取环境地点、天气、氛围关键词（如：室内、雨天、温馨）。警告：严禁描述前景主体或人物！",
+        "构图": "镜头角度、构图方式（如：俯视、三分法、特写）。注意：仅描述构图形式，严禁描述画面中具体的物体或人物！",
+        "人物外貌": "人物的性别、种族、年龄、发型、五官特征。必须明确描述性别（如男性/女性）和种族（如亚洲人/白人/黑人等）！注意：如果画面没有人物，请输出'无人物'或'None'。",
+        "人物动作": "人物的具体动作、姿态、表情。注意：如果画面没有人物，请输出'无人物'或'None'。严禁描述服装或外貌！严禁描述具体的物体（只能用“物体”、“物品”这类词汇来进行描述！",
+        "穿搭": "服装款式、材质、颜色、配饰。注意：如果画面没有人物，请输出'无人物'或'None'。严禁描述人物的外貌或动作！",
+        "主体物描述": "画面主要物体（非人物）的详细外观。注意：仅描述主体本身，严禁描述背景或环境！",
+        "光影描述": "光线来源、质感、阴影分布。",
+        "画面配色": "主色调、配色方案。允许使用“主体”、“背景”等抽象词汇描述颜色分布（如“主体为绿色”），但严禁提及具体物体名称（如“树是绿色”）！",
+        "摄像机角度": "识别并输出画面的具体拍摄视角（如：平视、俯视、仰视、侧拍、背拍等）。警告：严禁输出“未明确具体视角”！你必须根据画面内容做出判断！严禁描述任何画面内容！",
+        "文字/水印": "识别并转录画面中的所有可见文字、水印、LOGO信息，同时要描述文字在画面中的位置以及字体！。若无文字，则不需要出现相关内容。注意：如果用户没有选择此标签，绝对不要在其他标签（如背景、主体）中提及文字或水印内容！"
+    }
+
+# precision level -> (word_count, detail_instruction, min_length_instruction)
+PRECISION_LEVELS = {
+    "1": ("200", "简明扼要", ""),
+    "2": ("400", "标准详细", ""),
+    # Slightly reduced from 1200 to be more realistic for Flash model but still very high
+    "3": ("1000", "极度详尽，显微镜级别的细节描述", """
+            **【超精细模式强制执行协议】**：
+            1. **拒绝短句**：绝对禁止使用“光线柔和”这种短语！必须扩写为“光线如流动的液态黄金般柔和，在物体表面形成细腻的漫反射...”。
+            2. **细节堆砌**：对于每一个标签，你必须至少写出 3-5 个具体的视觉细节形容词。
+            3. **严禁过度联想**：虽然要求字数多，但必须**严格基于画面中实际存在的元素**进行深入描写！绝对禁止凭空捏造画面中不存在的物体、人物或背景！例如：如果画面只有一只苹果，你可以花1000字描写苹果的纹理、光泽、瑕疵、果梗的细节，但**绝对不能**联想出旁边有一把刀或一个人！
+            """),
+}
+
+JSON_FORMAT_INSTRUCTION = """
+            **【JSON结构化输出模式开启】**
+            1. **必须严格输出合法的JSON格式**：
+               - 根对象必须是一个包含 `prompts` 键的对象。
+               - `prompts` 的值是一个键值对对象，键是标签名，值是描述内容。
+            2. **格式示例**：
+               ```json
+               {
+                 "prompts": {
+                   "构图": "...",
+                   "风格": "...",
+                   "人物动作": "..."
+                 }
+               }
+               ```
+            3. **严禁**：输出Markdown代码块标记（如 ```json ... ```），直接输出纯JSON字符串！
+            4. **严禁**：输出任何非JSON的内容（如开场白、备注）。
+            """
+
+NATURAL_FORMAT_INSTRUCTION = """
+            **【自然语言融合模式开启】**
+            1. **输出格式**：
+               [Chinese]
+               (一段完整的、连贯的自然语言描述，不要带标签名！不要分行！)
+            2. **风格示例**：
+               "一个成年亚洲男性，留着黑色长发且略显凌乱，眉毛浓密...写实摄影风格，高清晰度，细腻的皮肤纹理，柔和的光线..."
+            3. **严禁**：
+               - **严禁出现“标签名：”的前缀**（如不要写“人物外貌：...”）。
+               - **严禁分行列表输出**，请融合成通顺的段落，用逗号或句号连接。
+               - 严禁输出JSON格式。
+            """
+
+INTRO_TEMPLATE = """
+        你是一个专业的AI艺术提示词生成专家。
+        任务：请分析随后提供的图片，结合每张图片的【指定标签】，直接生成一个融合后的、高质量的Stable Diffusion中文提示词。
+        
+        {format_instruction}
+
+        **核心生成逻辑（必须严格遵守）：**
+1. **识别标签**：首先识别每张图片被打上的具体标签（如构图、背景等）。
+2. **生成单图描述**：针对每张图，只生成该图【标签要求描述的内容】。
+   - **特别强调**：对于“构图”、“配色”、“摄像机角度”等抽象标签，**严禁**描述画面中具体的物体、人物或场景内容！必须使用“主体”、“物体”、“前景”、“背景”等抽象代词来代替具体名称。
+   - 例如：如果标签是“配色”，只能说“主体为红色，背景为深色”，绝对不能说“穿着红裙子的女孩站在黑夜里”。
+3. **生成融合提示词**：将上述提取出的、纯净的标签描述内容，融合成一个连贯的画面描述。
+4. **最终核查（Self-Correction）**：在输出前，必须再次检查：
+   - 检查：我描述的背景是来自选了“场景”标签的那张图吗？
+   - 检查：我描述的人物动作是来自选了“动作”标签的那张图吗？
+   - 如果发现描述了未选中标签图片的内容，必须立刻修正！
+5. **风格处理**：
+   - 如果所有图片都没有指定“风格”标签，则由你根据画面内容自动选择最美观的风格。
+   - 举例：如果图片1只选了“构图”，图片2只选了“配色”，那么最终画面应该是“图片1的构图 + 图片2的配色”，风格可以自由发挥或跟随图片2（如果有隐含风格）。
+6. **融合要求**：
+   - 最终输出的提示词是只针对单独一张图的描述，**绝对严禁**出现“图片1”、“图片2”、“图一”、“图二”、“第一张图”等类似的描述！
+   - 所有描述必须自然地融为一体，就像是在描述单独的一幅画。
+   - 错误示范：“图片1的人物穿着...图片2的背景是...”
+   - 正确示范：“人物穿着...背景是...”
+
+**详细要求**：
+- **标签优先与互补**：
+  - 每张图片都有【指定标签】，请**严格且仅**关注这些标签对应的内容！
+  - **白名单机制（White-listing）**：对于每张图，**只能**输出该图【指定标签】对应的描述！如果某张图只选了“摄像机角度”，你的输出里**绝对不能**出现“主体为一位女性”、“身着浅色连衣裙”等内容！只能有一句：“稍低仰拍视角”。
+  - 如果某张图没有选择“风格”标签，说明用户**不希望该图片的风格影响最终结果**。
+  - 如果所有图片都没有指定“风格”标签，则由你根据画面内容自动选择最美观的风格。
+  - **标签绝对权威原则（Universal Tag Authority）**：
+    - 对于任何维度（如构图、人物、背景、配色等），**只有选中了该标签的图片**才拥有定义权！
+    - 如果图片A选了某标签，而图片B没选，那么该维度的描述**必须完全由图片A决定**。图片B在该维度上的特征必须被彻底忽略。
+    - 如果多张图片都选了同一个标签，则对它们的内容进行融合。
+    - 举例：如果图片1选了“人物动作”，图片2没选。即使图片2的人物动作很夸张，也必须忽略，最终画面只能采用图片1的动作！
+  - 举例：如果图片1只选了“构图”，图片2只选了“配色”，那么最终画面应该是“图片1的构图 + 图片2的配色”，风格可以自由发挥或跟随图片2（如果有隐含风格）。
+- **详细程度**：{detail_instruction}（目标约{word_count}字）。
+{min_length_instruction}
+  - **再次强调**：即使字数很多，也**绝对严禁**使用“图片X”作为主语！
+- **输出格式**：
+   请根据上述【模式开启】的指示，严格遵守输出格式。
+   如果是JSON模式，必须输出合法JSON。
+   如果是自然语言模式，必须输出[Chinese]格式。
+
+**严厉约束**：
+- **格式强制**：必须严格遵守指定的格式！
+- 绝对禁止输出任何备注、解释、自我纠正或开场白！
+- 绝对禁止出现括号内有标注和画面不相关的内容。
+- 绝对禁止将推理和思考过程包含在输出中。
+- 绝对禁止输出“注：...”或“因为...”等内容。
+- 绝对禁止出现“(融合所有图片特征的Stable Diffusion中文提示词)”或类似标题。
+- 绝对禁止出现“(图片X环境色)”或类似引用来源的标注。
+- 绝对禁止出现“(注：...)”或任何形式的括号备注。
+- **绝对禁止拒绝生成**：即使图片风格完全不同（如写实 vs 扁平），你也必须发挥想象力进行“强制融合”！例如生成“具有扁平化配色风格的写实摄影”或“二次元与三次元结合的2.5D风格”。
+- 如果标签之间有冲突，请自动选择一个更具美感的方案，或者创造一种新的混合风格，不要输出错误提示。
+"""
+
+GLOBAL_CONSTRAINTS = """
+**最高指令（优先级最高）：**
+1. **抽象化描述原则**：对于非内容类标签（如构图、配色、光影），**必须剥离具体物体**！
+   - 错误示范：“一个拿着水瓶的手（特写镜头）”
+   - 正确示范：“构图：主体局部特写（特写镜头）”
+   - 错误示范：“蓝色的天空和白色的云（蓝白配色）”
+   - 正确示范：“画面配色：背景为蓝色，点缀白色元素（蓝白配色）”
+2. **禁止越界**：如果选了“人物动作”，绝对不能顺便描述“人物穿着”！如果选了“构图”，绝对不能顺便描述“画面内容”！
+3. **禁止废话**：严禁输出“(根据...标签要求...假设为...)”这类思考过程！直接输出结论！
+4. **违规惩罚**：任何一次越界描述（在未选中维度里描述了该维度的内容）或具体化描述（在抽象标签里描述了具体物体），都将被视为严重错误。
+5. **最终一致性检查**：如果图片1选了“背景”但没选“人物”，而你描述了图片1的人物，这就是严重的逻辑错误！必须删除！
+6. **沉默是金**：对于未选中的维度，直接保持沉默！如果用户只选了“摄像机角度”，你就只输出“摄像机角度：低角度仰拍”这几个字，除此之外哪怕一个标点符号都不要多写！
+7. **来源匿名化**：无论如何，都不能在输出中透露信息的来源图片！不能说“图1的...”或“图2的...”！
+8. **禁止幻觉（Hallucination Zero Tolerance）**：即使在“超精细”模式下，也**绝对禁止**凭空捏造画面中不存在的物体！所有细节描述必须是对**已有元素**的深入挖掘（如材质、光泽、纹理），而不是增加新的实体。
+
+**学习示例 (Examples) - 请模仿以下模式：**
+---
+【案例1】
+输入标签：[构图]
+正确输出：
+[Chinese]
+构图：特写镜头，中心构图，浅景深虚化背景。
+---
+【案例2】
+输入标签：[配色] [风格]
+正确输出：
+[Chinese]
+画面配色：主体为暖色调，背景为冷色调，高饱和度，色彩对比强烈。
+风格：赛博朋克风格，数字艺术，高对比度，霓虹光感，未来主义美学，颗粒质感。
+---
+【案例3】
+输入标签：[人物动作]
+正确输出：
+[Chinese]
+人物动作：侧身站立，手持物体，头部微转。
+---
+【案例4】
+输入标签：[风格]
+正确输出：
+[Chinese]
+风格：赛博朋克风格，数字艺术，高对比度，霓虹光感，未来主义美学，颗粒质感。
+(错误示范：“赛博朋克风格，街道上有霓虹灯和飞行汽车” -> 错误！不能出现街道和汽车！)
+
+【案例5】
+输入标签：[人物动作]
+正确输出：
+[Chinese]
+人物动作：侧身站立，手持物体，头部微转，微笑表情。
+(错误示范：“侧身站立，手持透明瓶子，头部微转，微笑表情，” -> 错误！不能出现具体的物体（如透明瓶子）！)
+---
+**严禁**出现如“图中有个穿着白衣服的人（配色）”这样的错误输出！必须是抽象的“画面配色：主体为白色”。
+"""
+
+IMAGE_TAGS_TEMPLATE = "\n[图片 {index} 的参考标签]：\n{aspects}\n\n警告：对于这张图片，你只能提取上述列出的标签内容！绝对禁止描述图片中未被标签选中的其他元素！如果标签列表为空，则忽略这张图片的所有内容。"
+
+FEATURE_HINTS_TEMPLATE = "\n[图片 {index} 的本地测量数据]（由像素统计得出，准确可信；描述对应标签时以此为依据，转化为自然的描述，不要照抄数值和色值代码）：\n{hints}"
+
+SKIPPED_IMAGE_TEXT = "[图片 {index}]（该图的标签可由本地测量数据完整描述，未附图片，请依据下方该图的本地测量数据）"
+
+FINAL_INSTRUCTION = "\n请开始直接生成最终融合后的中文提示词："
+
+
+def _build_static_prefix(precision_level, json_output):
+    word_count, detail_instruction, min_length_instruction = PRECISION_LEVELS[precision_level]
+    intro_text = INTRO_TEMPLATE.format(
+        format_instruction=JSON_FORMAT_INSTRUCTION if json_output else NATURAL_FORMAT_INSTRUCTION,
+        detail_instruction=detail_instruction,
+        word_count=word_count,
+        min_length_instruction=min_length_instruction,
+    )
+    return intro_text + GLOBAL_CONSTRAINTS
+
+
+# (precision_level, json_output) -> static system prompt
+STATIC_PREFIXES = {
+    (level, json_output): _build_static_prefix(level, json_output)
+    for level in PRECISION_LEVELS
+    for json_output in (False, True)
+}
+
+
+def static_prefix(precision_level, json_output):
+    # Unknown precision values fall back to the concise level, as before
+    level = precision_level if precision_level in PRECISION_LEVELS else "1"
+    return STATIC_PREFIXES[(level, bool(json_output))]
+
+
+def aspect_instruction(aspect):
+    if aspect in ASPECT_PROMPTS:
+        return ASPECT_PROMPTS[aspect]
+    # Custom Tag Handling
+    return f"仅提取画面中关于“{aspect}”的视觉信息。警告：严禁描述与“{aspect}”无关的任何内容（如人物、背景、光影）！严禁描述该物体与其他物体的关系（如“被拿着”、“放在桌上”）！只输出{aspect}本身的物理特征（如颜色、形状、材质）！"
+
+
+def normalize_aspects(selected_aspects):
+    # Sort: weight 2 first, then 1. Legacy string lists are turned into dicts.
+    if selected_aspects and isinstance(selected_aspects[0], dict):
+        return sorted(selected_aspects, key=lambda x: x.get('weight', 1), reverse=True)
+    return [{'id': a, 'weight': 1} for a in selected_aspects]
+
+
+def image_tags_text(index, selected_aspects, hints=None):
+    # Removed weight logic as requested by user - all tags are treated equally
+    aspects_desc = [f"{item['id']}: {aspect_instruction(item['id'])}" for item in normalize_aspects(selected_aspects)]
+    aspects_str = "\n".join(aspects_desc) if aspects_desc else "无特定标签约束，请综合分析画面。"
+    text = IMAGE_TAGS_TEMPLATE.format(index=index, aspects=aspects_str)
+    if hints:
+        text += FEATURE_HINTS_TEMPLATE.format(index=index, hints=hints)
+    return text
+
+
+def build_fusion_messages(encoded_images, options_map, precision_level, json_output=False, hints=None):
+    # encoded_images: data URL per image, None for an image described from its hints only;
+    # hints: local feature text per image (or None)
+    hints = hints or [None] * len(encoded_images)
+    content = []
+    for idx, data_url in enumerate(encoded_images):
+        if data_url is None:
+            content.append({"type": "text", "text": SKIPPED_IMAGE_TEXT.format(index=idx + 1)})
+            continue
+        content.append({"type": "text", "text": f"[图片 {idx+1}]"})
+        content.append({"type": "image_url", "image_url": {"url": data_url}})
+
+    tags = "".join(image_tags_text(idx + 1, options_map.get(str(idx), []), hints[idx]) for idx in range(len(encoded_images)))
+    content.append({"type": "text", "text": f"\n本次共 {len(encoded_images)} 张图片。{tags}"})
+    content.append({"type": "text", "text": FINAL_INSTRUCTION})
+
+    return [
+        {"role": "system", "content": static_prefix(precision_level, json_output)},
+        {"role": "user", "content": content},
+    ]
@@ -0,0 +1,157 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+
+from admission import is_limit_error
+
+# Whole-request budget in seconds by precision level; thinking mode multiplies it.
+# Every upstream call of the request (including retries and map-reduce stages) shares the budget.
+PRECISION_BUDGETS = {"1": 60, "2": 90, "3": 180}
+THINKING_FACTOR = 3
+TRANSLATE_BUDGET = 45
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, seconds):
+        super().__init__(f"上游响应超时：超过本次请求 {seconds:.0f} 秒的时限，请稍后重试或降低精细度")
+        self.seconds = seconds
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+
+class DeadlineStream:
+    # Ends a streamed response at the request deadline. The read timeout only bounds the gap
+    # between chunks, so a stream that keeps trickling would otherwise run past it. Sync streams
+    # are checked as each chunk arrives; async ones also stop waiting for a chunk at the deadline.
+
+    def __init__(self, stream, deadline, on_expired=None):
+        self._stream = stream
+        self._deadline = deadline
+        self._on_expired = on_expired
+
+    def _expired(self):
+        if self._on_expired:
+            self._on_expired()
+        return DeadlineExceeded(self._deadline.seconds)
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                if self._deadline.expired:
+                    self.close()
+                    raise self._expired()
+                yield chunk
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            # A read timeout cut to the remaining budget: report it as the deadline it is
+            if not self._deadline.expired:
+                raise
+            raise self._expired() from e
+
+    async def __aiter__(self):
+        chunks = self._stream.__aiter__()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), self._deadline.remaining())
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                await self.aclose()
+                raise self._expired()
+            except Exception as e:
+                if not self._deadline.expired:
+                    raise
+                raise self._expired() from e
+            yield chunk
+
+    def close(self):
+        close = getattr(self._stream, 'close', None)
+        if close:
+            close()
+
+    async def aclose(self):
+        close = getattr(self._stream, 'close', None)
+        if close:
+            result = close()
+            if asyncio.iscoroutine(result):
+                await result
+
+
+def request_deadline(precision, use_thinking, scale=1.0):
+    seconds = PRECISION_BUDGETS.get(str(precision), PRECISION_BUDGETS["2"])
+    if use_thinking:
+        seconds *= THINKING_FACTOR
+    return Deadline(seconds * scale)
+
+
+def translation_deadline(scale=1.0):
+    return Deadline(TRANSLATE_BUDGET * scale)
+
+
+def is_retryable(e):
+    # Connection errors, timeouts, 5xx and plain 429s are transient; quota exhaustion is not.
+    # Imported here: the SDK is loaded lazily (ark_clients.load_sdk) and is loaded by now.
+    from volcenginesdkarkruntime._exceptions import ArkAPIConnectionError, ArkInternalServerError, ArkRateLimitError
+    if is_limit_error(e):
+        return False
+    return isinstance(e, (ArkAPIConnectionError, ArkInternalServerError, ArkRateLimitError))
+
+
+def backoff_delay(attempt, base=0.5, cap=8.0):
+    # Exponential backoff with full jitter, so retrying callers do not line up
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class LatencyTracker:
+    # Recent successful call latencies per endpoint; p95 is the hedging delay
+
+    def __init__(self, window=200, min_samples=20):
+        self.min_samples = min_samples
+        self._window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds):
+        with self._lock:
+            self._samples.setdefault(endpoint, deque(maxlen=self._window)).append(seconds)
+
+    def p95(self, endpoint):
+        with self._lock:
+            samples = sorted(self._samples.get(endpoint, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[int(len(samples) * 0.95) - 1]
+
+    def stats(self):
+        with self._lock:
+            endpoints = list(self._samples)
+        return {endpoint: {'p95': round(self.p95(endpoint) or 0.0, 3), 'samples': len(self._samples[endpoint])}
+                for endpoint in endpoints}
+
+
+class CallCounters:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {'retries': 0, 'hedges': 0, 'hedge_wins': 0, 'wasted_calls': 0, 'deadline_exceeded': 0}
+
+    def add(self, name, amount=1):
+        with self._lock:
+            self.counts[name] += amount
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
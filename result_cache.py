@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def sha256_file(file_obj, chunk_size=64 * 1024):
+    # Hash an upload in chunks so large files are never fully copied into memory
+    digest = hashlib.sha256()
+    file_obj.seek(0)
+    for chunk in iter(lambda: file_obj.read(chunk_size), b""):
+        digest.update(chunk)
+    file_obj.seek(0)  # Reset pointer for the encoder
+    return digest.hexdigest()
+
+
+def normalize_options(options_map, image_count):
+    # Canonical form of options_map: string keys for every image index,
+    # legacy string aspects turned into {'id', 'weight'} dicts, weights as strings.
+    normalized = {}
+    for idx in range(image_count):
+        items = []
+        for item in options_map.get(str(idx), []):
+            if isinstance(item, dict):
+                items.append({'id': item.get('id'), 'weight': str(item.get('weight', 1))})
+            else:
+                items.append({'id': item, 'weight': '1'})
+        normalized[str(idx)] = items
+    return normalized
+
+
+def _fingerprint(payload):
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def request_fingerprint(image_hashes, options_map, precision, use_thinking, json_output, model_id, mode='direct'):
+    payload = {
+        'images': list(image_hashes),
+        'options': normalize_options(options_map, len(image_hashes)),
+        'precision': str(precision),
+        'thinking': bool(use_thinking),
+        'json_output': bool(json_output),
+        'model': model_id,
+    }
+    # Only non-default modes are part of the key, so existing direct fusion entries stay valid
+    if mode != 'direct':
+        payload['mode'] = mode
+    return _fingerprint(payload)
+
+
+def analysis_fingerprint(image_hash, aspects, precision, model_id):
+    # Key of one image's map-reduce analysis: independent of the other images in the request
+    return _fingerprint({
+        'image': image_hash,
+        'aspects': normalize_options({'0': aspects}, 1)['0'],
+        'precision': str(precision),
+        'model': model_id,
+    })
+
+
+class ResultCache:
+    # In-memory LRU with TTL, optionally backed by a SQLite file so entries
+    # survive worker restarts. Values must be JSON serializable.
+    # A connection must not be used across fork (gunicorn preload_app), so a forked
+    # worker opens its own on first use.
+
+    def __init__(self, max_entries=256, ttl=86400, db_path=None, max_disk_entries=10000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.db_path = db_path
+        self._db = None
+        self._pid = os.getpid()
+        if db_path:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+                self._db = self._connect()
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS results ("
+                    "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+                )
+                self._db.execute("DELETE FROM results WHERE expires_at < ?", (time.time(),))
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"Warning: Result cache persistence disabled ({db_path}): {e}")
+                self._db = None
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, check_same_thread=False)
+
+    def _check_fork(self):
+        # Caller holds the lock. The inherited connection is dropped without closing it,
+        # since closing would touch state the parent process still uses.
+        if self._db is not None and self._pid != os.getpid():
+            self._pid = os.getpid()
+            try:
+                self._db = self._connect()
+            except sqlite3.Error as e:
+                print(f"Warning: Result cache persistence disabled after fork ({self.db_path}): {e}")
+                self._db = None
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            self._check_fork()
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at >= now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            if self._db is not None:
+                # A locked or broken database (or an unreadable row) is a miss, like set() failing
+                try:
+                    row = self._db.execute(
+                        "SELECT value, expires_at FROM results WHERE key = ?", (key,)
+                    ).fetchone()
+                    value = json.loads(row[0]) if row is not None and row[1] >= now else None
+                except (sqlite3.Error, ValueError) as e:
+                    print(f"Warning: Failed to read cached result: {e}")
+                    row = value = None
+                if value is not None:
+                    self._remember(key, row[1], value)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return value
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._check_fork()
+            self._remember(key, expires_at, value)
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO results (key, value, expires_at) VALUES (?, ?, ?)",
+                        (key, json.dumps(value, ensure_ascii=False), expires_at),
+                    )
+                    self._writes += 1
+                    if self._writes % 100 == 0:
+                        self._prune_disk()
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    print(f"Warning: Failed to persist cached result: {e}")
+
+    def _remember(self, key, expires_at, value):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _prune_disk(self):
+        self._db.execute("DELETE FROM results WHERE expires_at < ?", (time.time(),))
+        self._db.execute(
+            "DELETE FROM results WHERE key NOT IN "
+            "(SELECT key FROM results ORDER BY expires_at DESC LIMIT ?)",
+            (self.max_disk_entries,),
+        )
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'persistent': self._db is not None,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
@@ -0,0 +1,212 @@
+import asyncio
+import threading
+
+import metrics
+
+# Request coalescing: concurrent requests with the same key (the result-cache fingerprint of a
+# generation, or the text of a translation) share one upstream call instead of each paying for
+# their own. The first caller runs the work; callers arriving while it is in flight wait for it
+# and get the same result or exception. Streams are produced once in the background and every
+# caller, including the first, replays the events from the start, so a client that disconnects
+# does not cut the stream short for the others.
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class StreamFlight:
+    # Events of one threaded stream, buffered for every follower
+
+    def __init__(self):
+        self.events = []
+        self.finished = False
+        self._cond = threading.Condition()
+
+    def publish(self, event):
+        with self._cond:
+            self.events.append(event)
+            self._cond.notify_all()
+
+    def finish(self, event=None):
+        # event: a final message for followers, e.g. the error that kept the stream from starting
+        with self._cond:
+            if event is not None:
+                self.events.append(event)
+            self.finished = True
+            self._cond.notify_all()
+
+    def produce(self, events):
+        try:
+            for event in events:
+                self.publish(event)
+        finally:
+            self.finish()
+
+    def follow(self):
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self.events) and not self.finished:
+                    self._cond.wait()
+                batch = self.events[index:]
+                finished = self.finished
+            index += len(batch)
+            yield from batch
+            if finished and index >= len(self.events):
+                return
+
+
+class AsyncStreamFlight:
+    # Same as StreamFlight for the ASGI app; everything runs on the event loop
+
+    def __init__(self):
+        self.events = []
+        self.finished = False
+        self._changed = asyncio.Event()
+
+    def publish(self, event):
+        self.events.append(event)
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def finish(self, event=None):
+        if event is not None:
+            self.events.append(event)
+        self.finished = True
+        self._changed.set()
+
+    async def produce(self, events):
+        try:
+            async for event in events:
+                self.publish(event)
+        finally:
+            self.finish()
+
+    async def follow(self):
+        index = 0
+        while True:
+            changed = self._changed
+            batch = self.events[index:]
+            index += len(batch)
+            for event in batch:
+                yield event
+            if self.finished and index >= len(self.events):
+                return
+            if index >= len(self.events):
+                await changed.wait()
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self._calls = {}     # (kind, key) -> _Call
+        self._tasks = {}     # (kind, key) -> asyncio.Task
+        self._streams = {}   # (kind, key) -> StreamFlight / AsyncStreamFlight
+        self._producers = set()  # Running AsyncStreamFlight producers, referenced until done
+        self._lock = threading.Lock()
+        self.coalesced = {}
+
+    def _joined(self, kind):
+        # Caller holds the lock (or runs on the event loop)
+        self.coalesced[kind] = self.coalesced.get(kind, 0) + 1
+        metrics.requests_coalesced_total.inc(kind=kind)
+
+    def do(self, kind, key, fn):
+        flight_key = (kind, key)
+        with self._lock:
+            call = self._calls.get(flight_key)
+            leader = call is None
+            if leader:
+                call = self._calls[flight_key] = _Call()
+            else:
+                self._joined(kind)
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[flight_key]
+            call.done.set()
+        return call.result
+
+    async def ado(self, kind, key, fn):
+        # fn returns a coroutine. It runs as its own task, so a cancelled caller (client gone)
+        # does not cancel the call the other callers are waiting for.
+        flight_key = (kind, key)
+        task = self._tasks.get(flight_key)
+        if task is None:
+            task = self._tasks[flight_key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda done: self._task_done(flight_key, done))
+        else:
+            with self._lock:
+                self._joined(kind)
+        return await asyncio.shield(task)
+
+    def _task_done(self, flight_key, task):
+        if self._tasks.get(flight_key) is task:
+            del self._tasks[flight_key]
+        if not task.cancelled():
+            task.exception()  # Retrieved, so an exception nobody waited for is not logged as lost
+
+    def join_stream(self, kind, key, flight_class=StreamFlight):
+        # Returns (flight, leader). The leader opens the upstream stream and then calls
+        # start_stream (or end_stream with an error event); followers only iterate follow().
+        flight_key = (kind, key)
+        with self._lock:
+            flight = self._streams.get(flight_key)
+            if flight is not None:
+                self._joined(kind)
+                return flight, False
+            flight = self._streams[flight_key] = flight_class()
+            return flight, True
+
+    def end_stream(self, kind, key, flight, event=None):
+        # Leader could not start the stream; followers get `event` (an SSE error) and the key is free again
+        self._release(kind, key, flight)
+        flight.finish(event)
+
+    def start_stream(self, kind, key, flight, events):
+        # Produces the events on a background thread; the caller returns flight.follow()
+        def produce():
+            try:
+                flight.produce(events)
+            finally:
+                self._release(kind, key, flight)
+
+        threading.Thread(target=metrics.propagate(produce), name=f"stream-{kind}", daemon=True).start()
+
+    def astart_stream(self, kind, key, flight, events):
+        async def produce():
+            try:
+                await flight.produce(events)
+            finally:
+                self._release(kind, key, flight)
+
+        task = asyncio.ensure_future(produce())
+        self._producers.add(task)
+        task.add_done_callback(self._producers.discard)
+
+    def _release(self, kind, key, flight):
+        with self._lock:
+            if self._streams.get((kind, key)) is flight:
+                del self._streams[(kind, key)]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._calls) + len(self._tasks) + len(self._streams),
+                'coalesced': dict(self.coalesced),
+            }
@@ -0,0 +1,122 @@
+import json
+import re
+
+CHINESE_MARKER = "[Chinese]"
+NOTE_LINE_RE = re.compile(r'^\s*[\(（]注.*[\)）]')
+HEADER_RE = re.compile(r'^\s*[\(（](中文|Chinese|融合.*?)[\)）]\s*', flags=re.IGNORECASE)
+HEADER_PREFIXES = ("中文", "chinese", "融合")
+
+
+def sse_event(event, data):
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+def iter_stream_deltas(stream):
+    # Yields ('reasoning' | 'delta', text) from an Ark chat completion stream
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        reasoning = getattr(delta, 'reasoning_content', None)
+        if reasoning:
+            yield 'reasoning', reasoning
+        if delta.content:
+            yield 'delta', delta.content
+
+
+class StreamCleaner:
+    # Incremental version of the natural-language post-processing in generate():
+    # drops the [Chinese] marker, "(注...)" note lines and "(中文)"-style headers as
+    # tokens arrive. Rules that need the whole text (wrapping parentheses, trailing
+    # notes) are applied by the final post-processing pass.
+
+    def __init__(self):
+        self._line = ""        # Current, not yet released line
+        self._released = 0     # Characters of self._line already emitted
+        self._started = False  # Whether any non-whitespace text was emitted
+
+    def feed(self, text):
+        out = []
+        for piece in re.split(r'(\n)', text):
+            if piece == "\n":
+                out.append(self._finish_line(newline=True))
+            elif piece:
+                self._line += piece
+                out.append(self._release_partial())
+        return "".join(out)
+
+    def finish(self):
+        return self._finish_line(newline=False)
+
+    def _pending_decision(self):
+        # True while the start of the current line could still turn out to be removable
+        stripped = self._line.replace(CHINESE_MARKER, "").lstrip()
+        if not stripped:
+            return True
+        if CHINESE_MARKER.startswith(stripped):
+            return True
+        if stripped[0] in "(（":
+            inner = stripped[1:].lstrip()
+            if not inner or inner.startswith("注"):
+                return True
+            lowered = inner.lower()
+            if any(p.startswith(lowered) or lowered.startswith(p) for p in HEADER_PREFIXES):
+                return not re.search(r'[\)）]', inner)
+        return False
+
+    def _clean(self, line):
+        line = line.replace(CHINESE_MARKER, "")
+        if NOTE_LINE_RE.match(line):
+            line = NOTE_LINE_RE.sub("", line, count=1)
+        if self._released == 0:
+            line = HEADER_RE.sub("", line, count=1)
+        return line
+
+    def _release_partial(self):
+        if self._released == 0 and self._pending_decision():
+            return ""
+        if self._released == 0:
+            self._line = self._clean(self._line)
+            if not self._started:
+                self._line = self._line.lstrip()
+        else:
+            self._line = self._line[:self._released] + self._line[self._released:].replace(CHINESE_MARKER, "")
+        chunk = self._line[self._released:]
+        # Keep back a possible partial "[Chinese]" marker at the end
+        for i in range(1, len(CHINESE_MARKER)):
+            if chunk.endswith(CHINESE_MARKER[:i]):
+                chunk = chunk[:-i]
+                break
+        self._released += len(chunk)
+        if chunk.strip():
+            self._started = True
+        return chunk
+
+    def _finish_line(self, newline):
+        if self._released == 0:
+            line = self._clean(self._line)
+            if not self._started:
+                line = line.lstrip()
+        else:
+            line = self._line.replace(CHINESE_MARKER, "")[self._released:]
+        self._line = ""
+        self._released = 0
+        if line.strip():
+            self._started = True
+        if newline and self._started:
+            return line + "\n"
+        return line
+
+
+async def aiter_stream_deltas(stream):
+    # Async counterpart of iter_stream_deltas for AsyncArk streams
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        reasoning = getattr(delta, 'reasoning_content', None)
+        if reasoning:
+            yield 'reasoning', reasoning
+        if delta.content:
+            yield 'delta', delta.content
@@ -0,0 +1,8 @@
+import os
+import tempfile
+
+# app.py reads its configuration at import; no test talks to the upstream API
+os.environ.setdefault('ARK_API_KEY', 'test')
+os.environ.setdefault('ARK_BASE_URL', 'http://127.0.0.1:9/api/v3')
+os.environ.setdefault('CACHE_DIR', tempfile.mkdtemp(prefix='prompt-fusion-test-'))
+os.environ.setdefault('JOBS_PARALLELISM', '0')
@@ -0,0 +1,54 @@
+import pytest
+
+from admission import AdmissionController, Overloaded
+
+LIMIT_ERROR = Exception("SetLimitExceeded: account quota reached")
+
+
+def tripped(cooldown=0):
+    controller = AdmissionController(max_in_flight=8, breaker_cooldown=cooldown)
+    controller.release(controller.acquire(10), error=LIMIT_ERROR)
+    return controller
+
+
+def test_limit_error_opens_the_breaker():
+    controller = tripped(cooldown=300)
+    with pytest.raises(Overloaded) as e:
+        controller.acquire(10)
+    assert e.value.reason == 'circuit_open'
+
+
+def test_only_the_probe_closes_the_breaker():
+    controller = AdmissionController(max_in_flight=8, breaker_cooldown=0)
+    earlier = controller.acquire(10)  # Admitted before the breaker opened
+    controller.release(controller.acquire(10), error=LIMIT_ERROR)
+
+    probe = controller.acquire(10)
+    assert probe.probe
+    with pytest.raises(Overloaded):
+        controller.acquire(10)  # One probe at a time
+
+    controller.release(earlier)
+    with pytest.raises(Overloaded):
+        controller.acquire(10)  # Still half-open, probe in flight
+
+    controller.release(probe)
+    assert not controller.acquire(10).probe
+
+
+def test_failed_probe_lets_the_next_call_probe():
+    controller = tripped()
+    probe = controller.acquire(10)
+    controller.release(probe, error=Exception("connection reset"))
+    assert controller.acquire(10).probe
+
+
+def test_limit_error_during_the_probe_keeps_the_breaker_open():
+    controller = AdmissionController(max_in_flight=8, breaker_cooldown=0)
+    earlier = controller.acquire(10)
+    controller.release(controller.acquire(10), error=LIMIT_ERROR)
+    probe = controller.acquire(10)
+    controller.breaker_cooldown = 300
+    controller.release(earlier, error=LIMIT_ERROR)
+    controller.release(probe)
+    assert controller.stats()['breaker_open']
@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+import io
+import json
+import threading
+from types import SimpleNamespace
+
+import httpx
+from PIL import Image
+
+import app as flask_app
+import asgi_app
+
+
+def test_mapreduce_fans_out_at_most_mapreduce_workers(monkeypatch):
+    running = []
+    peak = []
+
+    async def fake_analyze(file, aspects, precision, digest, deadline=None):
+        running.append(digest)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(digest)
+        return f"analysis {digest}"
+
+    async def fake_merge(endpoint, **kwargs):
+        return "merged"
+
+    monkeypatch.setattr(asgi_app, 'analyze_image', fake_analyze)
+    monkeypatch.setattr(asgi_app.ark, 'achat_completion', fake_merge)
+    monkeypatch.setattr(flask_app, 'MAPREDUCE_WORKERS', 3)
+    count = 10
+    params = {
+        'images': [None] * count,
+        'image_hashes': [f"asgi-fanout-{idx}" for idx in range(count)],
+        'options_map': {str(idx): ['构图'] for idx in range(count)},
+        'precision': '1',
+        'use_thinking': False,
+        'deadline': None,
+    }
+    response, analyses, timings = asyncio.run(asgi_app.generate_mapreduce(params))
+    assert response == "merged"
+    assert analyses == [f"analysis asgi-fanout-{idx}" for idx in range(count)]
+    assert max(peak) == 3
+
+
+def post_both(path, data=None, image=None, json_body=None):
+    # (Flask response, ASGI response) for the same request
+    client = flask_app.app.test_client()
+    if json_body is not None:
+        flask_response = client.post(path, json=json_body)
+    else:
+        files = {'images': (io.BytesIO(image), 'a.png')} if image else {}
+        flask_response = client.post(path, data=dict(data, **files), content_type='multipart/form-data')
+
+    async def asgi_post():
+        transport = httpx.ASGITransport(app=asgi_app.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            if json_body is not None:
+                return await client.post(path, json=json_body)
+            files = {'images': ('a.png', image, 'image/png')} if image else None
+            return await client.post(path, data=data, files=files)
+
+    return flask_response, asyncio.run(asgi_post())
+
+
+def test_both_apps_validate_generate_forms_alike():
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8)).save(buffer, format='PNG')
+    image = buffer.getvalue()
+    cases = [
+        ({'options': '{}'}, None),
+        ({}, image),
+        ({'options': 'not json'}, image),
+        ({'options': '{}', 'mode': 'unknown'}, image),
+    ]
+    for data, image in cases:
+        flask_response, asgi_response = post_both('/generate', data, image)
+        assert flask_response.status_code == asgi_response.status_code == 400
+        assert flask_response.get_json() == asgi_response.json()
+
+
+def test_both_apps_reject_empty_translations_alike():
+    flask_response, asgi_response = post_both('/translate/stream', json_body={'text': ''})
+    assert flask_response.status_code == asgi_response.status_code == 400
+    assert flask_response.get_json() == asgi_response.json()
+
+
+class ThreadRecordingCache:
+    # Wraps a cache and records the thread of every get / set
+
+    def __init__(self, cache, threads):
+        self.cache = cache
+        self.threads = threads
+
+    def get(self, key):
+        self.threads.append(threading.get_ident())
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.threads.append(threading.get_ident())
+        return self.cache.set(key, value)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+def fake_chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text, reasoning_content=None))])
+
+
+def test_result_cache_is_never_touched_on_the_event_loop(monkeypatch):
+    threads = []
+    monkeypatch.setattr(flask_app, 'result_cache', ThreadRecordingCache(flask_app.result_cache, threads))
+    monkeypatch.setattr(flask_app, 'analysis_cache', ThreadRecordingCache(flask_app.analysis_cache, threads))
+    monkeypatch.setattr(asgi_app.ark, '_async_client', object())
+
+    async def fake_completion(params, stream=False):
+        if not stream:
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="一只猫"))])
+
+        async def chunks():
+            yield fake_chunk("一只")
+            yield fake_chunk("狗")
+        return chunks()
+
+    monkeypatch.setattr(asgi_app, 'create_fusion_completion', fake_completion)
+    images = []
+    for color in ((10, 200, 30), (200, 10, 30), (30, 10, 200)):
+        buffer = io.BytesIO()
+        Image.new('RGB', (8, 8), color).save(buffer, format='PNG')
+        images.append(buffer.getvalue())
+    data = {'options': json.dumps({'0': ['构图']}), 'thinking': 'false'}
+    mapreduce_data = dict(data, mode='mapreduce')
+    mapreduce_params = flask_app.generate_params(
+        flask_app.read_generate_form(mapreduce_data, True)[0], [None], [hashlib.sha256(images[2]).hexdigest()])
+    flask_app.result_cache.cache.set(mapreduce_params['cache_key'], "一只鸟")
+
+    async def requests():
+        transport = httpx.ASGITransport(app=asgi_app.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            post = lambda path, form, image: client.post(path, data=form, files={'images': ('a.png', image, 'image/png')})
+            generated = await post('/generate', data, images[0])
+            cached = await post('/generate', data, images[0])
+            streamed = await post('/generate/stream', data, images[1])
+            mapreduce = await post('/generate', mapreduce_data, images[2])
+            return generated.json(), cached.json(), streamed.text, mapreduce.json()
+
+    generated, cached, streamed, mapreduce = asyncio.run(requests())
+    assert generated['final_prompt'] == "一只猫" and not generated['cached']
+    assert cached['cached']
+    assert 'event: done' in streamed and "一只狗" in streamed
+    assert mapreduce['final_prompt'] == "一只鸟" and mapreduce['cached']
+    assert threads
+    assert threading.get_ident() not in threads
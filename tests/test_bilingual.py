@@ -0,0 +1,74 @@
+import asyncio
+import concurrent.futures
+
+from bilingual import AsyncSpeculativeTranslation, SpeculativeTranslation
+from translation_memory import TranslationMemory
+
+# Natural language mode output: one paragraph, no labels, no line breaks
+SENTENCES = ["一个成年亚洲男性，留着黑色长发。", "写实摄影风格，高清晰度；", "柔和的侧光，背景虚化。"]
+
+
+def fake_translate(text):
+    return "\n".join(f"en({line.strip()})" for line in text.splitlines() if line.strip())
+
+
+def test_natural_text_is_translated_before_the_answer_ends():
+    calls = []
+
+    def translate_fn(text):
+        calls.append(text)
+        return fake_translate(text)
+
+    memory = TranslationMemory('test-model')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+        translation = SpeculativeTranslation(memory, translate_fn, pool)
+        for sentence in SENTENCES:
+            for start in range(0, len(sentence), 4):
+                translation.feed(sentence[start:start + 4])
+            concurrent.futures.wait(translation._batches)
+        assert calls == [SENTENCES[0], SENTENCES[1]]
+        assert translation.ready() == [f"en({SENTENCES[0]})", f"en({SENTENCES[1]})"]
+
+        english = translation.finish("".join(SENTENCES))
+    # Only the last sentence was left for the end of the answer
+    assert calls[2:] == [SENTENCES[2]]
+    assert english == ", ".join(f"en({sentence})" for sentence in SENTENCES)
+    # The whole prompt is remembered too, for /translate
+    assert memory.translate("".join(SENTENCES), translate_fn) == english
+    assert len(calls) == 3
+
+
+def test_async_natural_text_is_translated_before_the_answer_ends():
+    calls = []
+
+    async def translate_fn(text):
+        calls.append(text)
+        return fake_translate(text)
+
+    async def run():
+        translation = AsyncSpeculativeTranslation(TranslationMemory('test-model'), translate_fn)
+        translation.feed(SENTENCES[0])
+        translation.feed(SENTENCES[1][:3])
+        assert len(translation._batches) == 1
+        await asyncio.wait(translation._batches)
+        assert calls == [SENTENCES[0]]
+        translation.feed(SENTENCES[1][3:] + SENTENCES[2])
+        return await translation.finish("".join(SENTENCES))
+
+    english = asyncio.run(run())
+    assert english == ", ".join(f"en({sentence})" for sentence in SENTENCES)
+    assert len(calls) == 3
+
+
+def test_labelled_lines_and_plain_translations_are_unchanged():
+    calls = []
+
+    def translate_fn(text):
+        calls.append(text)
+        return fake_translate(text)
+
+    memory = TranslationMemory('test-model')
+    assert memory.translate("构图：特写。\n配色：暖色。", translate_fn) == "en(构图：特写。)\nen(配色：暖色。)"
+    # Without sentences=True a natural language text stays one segment
+    assert memory.translate("".join(SENTENCES), translate_fn) == f"en({''.join(SENTENCES)})"
+    assert calls[1:] == ["".join(SENTENCES)]
@@ -0,0 +1,93 @@
+import os
+import time
+
+from image_store import TMP_MAX_AGE, TMP_PREFIX, ImageStore
+
+DATA_URL = "data:image/jpeg;base64," + "A" * 1000
+
+
+def digest(n):
+    return f"{n:064x}"
+
+
+def test_expiry_is_checked_for_images_stored_by_another_worker(tmp_path):
+    writer = ImageStore(str(tmp_path), ttl=60)
+    reader = ImageStore(str(tmp_path), ttl=60)
+    writer.put(digest(1), DATA_URL)
+    assert reader.get(digest(1)) == DATA_URL
+
+    path = writer._path(digest(1))
+    old = time.time() - 120
+    os.utime(path, (old, old))
+    assert reader.get(digest(1)) is None
+    assert not os.path.exists(path)
+    assert reader.stats()['expirations'] == 1
+
+
+def test_size_bound_covers_the_whole_directory_once_synced(tmp_path):
+    size = len(DATA_URL)
+    # Synced on every store, so each worker sees the other's images
+    workers = [ImageStore(str(tmp_path), max_bytes=size * 3, sync_interval=0) for _ in range(2)]
+    for n in range(8):
+        workers[n % 2].put(digest(n), DATA_URL)
+        time.sleep(0.01)  # Distinct mtimes, so the eviction order is the storing order
+
+    on_disk = sum(entry.stat().st_size for entry in os.scandir(tmp_path))
+    assert on_disk <= size * 3
+    assert [n for n in range(8) if workers[0].get(digest(n))] == [5, 6, 7]
+
+
+def test_use_keeps_an_image_from_eviction(tmp_path):
+    size = len(DATA_URL)
+    store = ImageStore(str(tmp_path), max_bytes=size * 2)
+    store.put(digest(1), DATA_URL)
+    time.sleep(0.01)
+    store.put(digest(2), DATA_URL)
+    time.sleep(0.01)
+    assert store.get(digest(1)) == DATA_URL
+    time.sleep(0.01)
+    store.put(digest(3), DATA_URL)
+    assert store.get(digest(2)) is None
+    assert store.get(digest(1)) == DATA_URL
+    assert store.stats()['entries'] == 2
+
+
+def test_stores_between_syncs_do_not_scan_the_directory(tmp_path, monkeypatch):
+    size = len(DATA_URL)
+    store = ImageStore(str(tmp_path), max_bytes=size * 3)
+    scans = []
+    real_scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: scans.append(path) or real_scandir(path))
+    for n in range(6):
+        store.put(digest(n), DATA_URL)
+        time.sleep(0.01)
+    assert scans == []
+    assert [n for n in range(6) if os.path.exists(store._path(digest(n)))] == [3, 4, 5]
+    assert store.stats()['entries'] == 3
+    assert store.stats()['evictions'] == 3
+
+
+def test_eviction_skips_images_another_worker_used(tmp_path):
+    size = len(DATA_URL)
+    store = ImageStore(str(tmp_path), max_bytes=size * 2)
+    other = ImageStore(str(tmp_path), max_bytes=size * 2)
+    store.put(digest(1), DATA_URL)
+    time.sleep(0.01)
+    store.put(digest(2), DATA_URL)
+    time.sleep(0.01)
+    assert other.get(digest(1)) == DATA_URL
+    store.put(digest(3), DATA_URL)
+    assert os.path.exists(store._path(digest(1)))
+    assert not os.path.exists(store._path(digest(2)))
+
+
+def test_sync_removes_stale_temp_files(tmp_path):
+    stale = tmp_path / (TMP_PREFIX + 'dead.tmp')
+    fresh = tmp_path / (TMP_PREFIX + 'writing.tmp')
+    stale.write_bytes(b'partial')
+    fresh.write_bytes(b'partial')
+    old = time.time() - TMP_MAX_AGE - 60
+    os.utime(stale, (old, old))
+    ImageStore(str(tmp_path))
+    assert not stale.exists()
+    assert fresh.exists()
@@ -0,0 +1,56 @@
+import os
+import sqlite3
+import time
+
+import jobs
+from jobs import JobQueue
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_claim_by_reused_pid_is_requeued(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.db'), run_job=lambda payload: payload, workers=0)
+    _, (job_id,) = queue.submit([{'n': 1}])
+    with queue._connect() as db:
+        # Claimed by an earlier process that had this (live) pid
+        db.execute("UPDATE jobs SET status = 'running', owner_pid = ?, owner_token = 'earlier-boot:1' WHERE id = ?",
+                   (os.getpid(), job_id))
+    queue._recover()
+    assert queue.get(job_id)['status'] == 'queued'
+
+
+def test_claim_by_live_owner_is_kept(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.db'), run_job=lambda payload: payload, workers=0)
+    _, (job_id,) = queue.submit([{'n': 1}])
+    with queue._connect() as db:
+        db.execute("UPDATE jobs SET status = 'running', owner_pid = ?, owner_token = ? WHERE id = ?",
+                   (os.getpid(), jobs._process_token(os.getpid()), job_id))
+    queue._recover()
+    assert queue.get(job_id)['status'] == 'running'
+
+
+def test_worker_survives_database_errors(tmp_path, monkeypatch):
+    queue = JobQueue(str(tmp_path / 'jobs.db'), run_job=lambda payload: payload, workers=1, poll_interval=0.05)
+    finish = queue._finish
+    failures = []
+
+    def flaky_finish(job_id, **kwargs):
+        if not failures:
+            failures.append(job_id)
+            raise sqlite3.OperationalError("database is locked")
+        return finish(job_id, **kwargs)
+
+    monkeypatch.setattr(queue, '_finish', flaky_finish)
+    queue.start()
+    _, (first,) = queue.submit([{'n': 1}])
+    assert wait_for(lambda: failures)
+    _, (second,) = queue.submit([{'n': 2}])
+    assert wait_for(lambda: queue.get(second)['status'] == 'done')
+    assert queue.get(second)['result'] == {'n': 2}
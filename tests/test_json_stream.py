@@ -0,0 +1,41 @@
+from json_stream import JsonFieldStream, check_prompts, parse_json_prompt
+
+
+def test_unexpected_aspects_are_kept_and_reported():
+    result, report = check_prompts({'prompts': {'构图': '三分法', '风格': '水墨'}}, ['构图'])
+    assert result == {'prompts': {'构图': '三分法', '风格': '水墨'}}
+    assert report['unexpected'] == ['风格']
+    assert not report['valid']
+
+
+def test_null_value_counts_as_missing():
+    result, report = check_prompts({'prompts': {'构图': None, '画面配色': '暖色'}}, ['构图', '画面配色'])
+    assert result == {'prompts': {'画面配色': '暖色'}}
+    assert report['missing'] == ['构图']
+    assert 'coerced_to_text' not in report['repairs']
+    assert not report['valid']
+
+
+def test_parsed_output_keeps_extra_keys_and_drops_nulls():
+    text = '```json\n{"prompts": {"构图": "特写", "光影描述": null, "文字/水印": "无"}}\n```'
+    result, report = parse_json_prompt(text, ['构图', '光影描述'])
+    assert result == {'prompts': {'构图': '特写', '文字/水印': '无'}}
+    assert report['missing'] == ['光影描述']
+    assert report['unexpected'] == ['文字/水印']
+
+
+def test_stream_reports_null_fields_and_result_treats_them_as_missing():
+    stream = JsonFieldStream()
+    fields = []
+    for chunk in ('{"prompts": {"构图": "俯视", ', '"画面配色": nu', 'll}}'):
+        fields.extend(stream.feed(chunk))
+    assert fields == [('构图', '俯视'), ('画面配色', None)]
+    result, report = stream.result(['构图', '画面配色'])
+    assert result == {'prompts': {'构图': '俯视'}}
+    assert report['missing'] == ['画面配色']
+
+
+def test_valid_output_passes():
+    result, report = parse_json_prompt('{"prompts": {"构图": "仰拍"}}', ['构图'])
+    assert result == {'prompts': {'构图': '仰拍'}}
+    assert report == {'valid': True, 'repairs': [], 'missing': [], 'unexpected': []}
@@ -0,0 +1,71 @@
+import io
+import random
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from near_duplicates import NearDuplicateIndex, signature, distance
+
+
+def scene(seed=1):
+    rng = random.Random(seed)
+    img = Image.new('RGB', (800, 600))
+    draw = ImageDraw.Draw(img)
+    for y in range(600):
+        draw.line([(0, y), (800, y)], fill=(40 + y // 4, 80, 200 - y // 4))
+    for _ in range(12):
+        x, y, size = rng.randrange(800), rng.randrange(600), rng.randrange(40, 200)
+        draw.ellipse([x, y, x + size, y + size], fill=tuple(rng.randrange(256) for _ in range(3)))
+    return img.filter(ImageFilter.GaussianBlur(2))
+
+
+def upload(img, quality=90):
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=quality)
+    buffer.seek(0)
+    return buffer
+
+
+def with_caption(img):
+    captioned = img.copy()
+    ImageDraw.Draw(captioned).text((300, 280), "SALE 50% OFF", fill=(255, 255, 255))
+    return captioned
+
+
+def test_overlaid_text_is_a_near_duplicate_by_signature():
+    # Why the text aspect must not be matched perceptually: the caption barely moves the signature
+    base = scene()
+    assert distance(signature(upload(base)), signature(upload(with_caption(base)))) <= 4
+
+
+def test_text_aspect_is_not_merged():
+    index = NearDuplicateIndex()
+    base = scene()
+    tags = [['文字/水印']]
+    assert index.canonical([upload(base)], ['plain'], tags) == ['plain']
+    assert index.canonical([upload(with_caption(base))], ['captioned'], tags) == ['captioned']
+
+
+def test_fine_aspect_next_to_coarse_one_is_not_merged():
+    index = NearDuplicateIndex()
+    base = scene()
+    tags = [['构图', '文字/水印']]
+    index.canonical([upload(base)], ['plain'], tags)
+    assert index.canonical([upload(with_caption(base))], ['captioned'], tags) == ['captioned']
+
+
+def test_coarse_aspects_are_merged():
+    index = NearDuplicateIndex()
+    base = scene()
+    assert index.canonical([upload(base)], ['original'], [['构图']]) == ['original']
+    assert index.canonical([upload(base, quality=60)], ['recompressed'], [['构图']]) == ['original']
+    assert index.canonical([upload(scene(2))], ['other'], [['构图']]) == ['other']
+
+
+def test_alias_from_a_looser_aspect_is_rechecked():
+    index = NearDuplicateIndex()
+    base = scene()
+    brighter = base.point(lambda v: min(255, v + 12))
+    index.canonical([upload(base)], ['original'], [['构图']])
+    assert index.canonical([upload(brighter)], ['brighter'], [['构图']]) == ['original']
+    # 光影描述 allows less than the alias's distance, so the brighter copy stands on its own
+    assert index.canonical([upload(brighter)], ['brighter'], [['光影描述']]) == ['brighter']
@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+import pytest
+
+from resilience import Deadline, DeadlineExceeded, DeadlineStream
+
+
+class TricklingStream:
+    # One chunk every `interval` seconds, well within any read timeout
+
+    def __init__(self, chunks, interval):
+        self.chunks = chunks
+        self.interval = interval
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in range(self.chunks):
+            time.sleep(self.interval)
+            yield chunk
+
+    async def __aiter__(self):
+        for chunk in range(self.chunks):
+            await asyncio.sleep(self.interval)
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+class AsyncClosingStream(TricklingStream):
+    async def close(self):
+        self.closed = True
+
+
+def test_stream_within_deadline_is_passed_through():
+    stream = TricklingStream(5, 0)
+    assert list(DeadlineStream(stream, Deadline(10))) == [0, 1, 2, 3, 4]
+    assert not stream.closed
+
+
+def test_trickling_stream_ends_at_the_deadline():
+    stream = TricklingStream(100, 0.02)
+    expired = []
+    received = []
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        for chunk in DeadlineStream(stream, Deadline(0.1), lambda: expired.append(True)):
+            received.append(chunk)
+    assert time.monotonic() - start < 0.5
+    assert 0 < len(received) < 100
+    assert stream.closed and expired == [True]
+
+
+def test_async_stream_stops_waiting_at_the_deadline():
+    stream = AsyncClosingStream(3, 5)
+
+    async def consume():
+        return [chunk async for chunk in DeadlineStream(stream, Deadline(0.1))]
+
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(consume())
+    assert time.monotonic() - start < 1
+    assert stream.closed
@@ -0,0 +1,58 @@
+import sqlite3
+
+from result_cache import ResultCache
+
+
+def test_disk_hit_survives_a_new_instance(tmp_path):
+    db_path = str(tmp_path / 'results.db')
+    ResultCache(db_path=db_path).set('key', {'prompts': {'构图': '特写'}})
+    assert ResultCache(db_path=db_path).get('key') == {'prompts': {'构图': '特写'}}
+
+
+def test_database_error_on_read_is_a_miss(tmp_path):
+    db_path = str(tmp_path / 'results.db')
+    ResultCache(db_path=db_path).set('key', 'prompt')
+    cache = ResultCache(db_path=db_path)
+    cache._db.execute("DROP TABLE results")
+    assert cache.get('key') is None
+    assert cache.stats()['misses'] == 1
+
+
+def test_locked_database_on_read_is_a_miss(tmp_path, capsys):
+    db_path = str(tmp_path / 'results.db')
+    writer = ResultCache(db_path=db_path)
+    writer.set('key', 'prompt')
+    writer._db.close()
+    cache = ResultCache(db_path=db_path)
+    cache._db.close()
+    # Another connection holds the database. In WAL mode a plain BEGIN EXCLUSIVE still lets
+    # readers in; exclusive locking mode, taken while no other connection is open, does not.
+    locker = sqlite3.connect(db_path, isolation_level=None)
+    locker.execute("PRAGMA locking_mode = EXCLUSIVE")
+    locker.execute("BEGIN EXCLUSIVE")
+    cache._db = sqlite3.connect(db_path, timeout=0.05, check_same_thread=False)
+    try:
+        assert cache.get('key') is None
+    finally:
+        locker.close()
+    assert 'database is locked' in capsys.readouterr().out
+    assert cache.stats()['misses'] == 1
+    assert cache.get('key') == 'prompt'
+
+
+def test_closed_connection_on_read_is_a_miss(tmp_path):
+    db_path = str(tmp_path / 'results.db')
+    ResultCache(db_path=db_path).set('key', 'prompt')
+    cache = ResultCache(db_path=db_path)
+    cache._db.close()  # Any further use raises sqlite3.ProgrammingError (a sqlite3.Error)
+    assert cache.get('key') is None
+    cache.set('other', 'prompt')
+    assert cache.get('other') == 'prompt'
+
+
+def test_unreadable_row_is_a_miss(tmp_path):
+    db_path = str(tmp_path / 'results.db')
+    cache = ResultCache(db_path=db_path)
+    with sqlite3.connect(db_path) as db:
+        db.execute("INSERT INTO results VALUES ('key', 'not json', 1e12)")
+    assert cache.get('key') is None
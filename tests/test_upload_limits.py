@@ -0,0 +1,103 @@
+import io
+import struct
+import threading
+import time
+import zlib
+
+import pytest
+from PIL import Image
+
+import image_preprocess
+from upload_limits import DecodeBudget, UploadTooLarge, decode_bytes
+
+
+def png(size, color=(200, 40, 40, 255)):
+    buffer = io.BytesIO()
+    Image.new('RGBA', size, color).save(buffer, format='PNG', compress_level=1)
+    buffer.seek(0)
+    return buffer
+
+
+def png_header_only(width, height):
+    # A PNG whose header claims width x height; the pixel data is a 1x1 image's, so decoding it fails
+    data = bytearray(png((1, 1)).getvalue())
+    ihdr = struct.pack('>II', width, height) + bytes(data[24:29])
+    data[16:29] = ihdr
+    data[29:33] = struct.pack('>I', zlib.crc32(b'IHDR' + ihdr))
+    return io.BytesIO(bytes(data))
+
+
+def test_pixel_limit_rejects_from_the_header():
+    files = [png((64, 64)), png_header_only(20000, 20000), png((64, 64))]
+    with pytest.raises(UploadTooLarge) as e:
+        image_preprocess.check_uploads(files, max_pixels=64_000_000)
+    assert e.value.reason == 'pixels'
+    assert all(f.tell() == 0 for f in files)
+
+
+def test_generate_answers_413_for_oversized_images():
+    import app
+    client = app.app.test_client()
+    decodes = image_preprocess.decode_budget.stats()['peak']
+    response = client.post('/generate', data={
+        'images': [(png((64, 64)), 'a.png'), (png_header_only(20000, 20000), 'b.png')],
+        'options': '{}',
+    }, content_type='multipart/form-data')
+    assert response.status_code == 413
+    assert response.get_json()['reason'] == 'pixels'
+    assert image_preprocess.decode_budget.stats()['peak'] == decodes
+
+
+def test_generate_answers_413_for_oversized_bodies(monkeypatch):
+    import app
+    monkeypatch.setitem(app.app.config, 'MAX_CONTENT_LENGTH', 256 * 1024)
+    client = app.app.test_client()
+    noise = lambda seed: io.BytesIO(bytes((i * seed) % 251 for i in range(100 * 1024)))
+    response = client.post('/generate', data={
+        'images': [(noise(seed), f'{seed}.png') for seed in (3, 5, 7)],
+        'options': '{}',
+    }, content_type='multipart/form-data')
+    assert response.status_code == 413
+    assert response.get_json()['reason'] == 'body_size'
+
+
+def test_concurrent_large_decodes_stay_within_the_budget(monkeypatch):
+    size = (2000, 1500)
+    per_image = decode_bytes(Image.open(png(size)))
+    budget = DecodeBudget(per_image * 2)
+    monkeypatch.setattr(image_preprocess, 'decode_budget', budget)
+
+    running = []
+    peak_running = []
+    lock = threading.Lock()
+    load_image = image_preprocess.load_image
+
+    def tracked_load(img):
+        with lock:
+            running.append(img)
+            peak_running.append(len(running))
+        try:
+            time.sleep(0.05)  # Hold the decode long enough for the threads to overlap
+            return load_image(img)
+        finally:
+            with lock:
+                running.remove(img)
+
+    monkeypatch.setattr(image_preprocess, 'load_image', tracked_load)
+    files = [png(size, (seed * 40, 80, 120, 255)) for seed in range(6)]
+    results = [None] * len(files)
+
+    def decode(idx):
+        results[idx] = image_preprocess.prepare_image(files[idx])
+
+    threads = [threading.Thread(target=decode, args=(idx,)) for idx in range(len(files))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(img.size == (512, 384) for img in results)
+    assert max(peak_running) == 2
+    assert budget.peak <= budget.max_bytes
+    assert budget.waits > 0
+    assert budget.in_use == 0
@@ -0,0 +1,175 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import re
+import threading
+import unicodedata
+
+from result_cache import ResultCache
+
+# Fusion output lines look like "构图：特写镜头，..." - each such line is cached as its own segment
+DIMENSION_LINE_RE = re.compile(r'^\s*[^\s：:，,。]{1,12}[：:]')
+TRAILING_PUNCTUATION = '。.，,；;、 '
+# Sentence ends in natural language prompts; the split keeps the punctuation with its sentence
+SENTENCE_END_RE = re.compile(r'(?<=[。；！？;!?])')
+
+
+def normalize_text(text):
+    # NFKC folds full-width punctuation/letters; whitespace only matters between latin words/numbers
+    text = unicodedata.normalize('NFKC', text)
+    lines = []
+    for line in text.splitlines():
+        line = re.sub(r'(?<![A-Za-z0-9])\s+|\s+(?![A-Za-z0-9])', '', line)
+        line = re.sub(r'\s+', ' ', line).strip().rstrip(TRAILING_PUNCTUATION)
+        if line:
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+def has_dimension_lines(text):
+    return any(DIMENSION_LINE_RE.match(line.strip()) for line in text.splitlines())
+
+
+def split_segments(text, sentences=False):
+    # Split on "维度名：" lines; continuation lines stay with the preceding dimension.
+    # Text without any dimension lines (natural language mode) is a single segment, or with
+    # sentences=True one segment per sentence.
+    lines = [line.strip() for line in text.strip().splitlines() if line.strip()]
+    if not has_dimension_lines(text):
+        if sentences:
+            return [part.strip() for line in lines for part in SENTENCE_END_RE.split(line) if part.strip()]
+        return [text.strip()] if text.strip() else []
+
+    segments = []
+    for line in lines:
+        if DIMENSION_LINE_RE.match(line) or not segments:
+            segments.append(line)
+        else:
+            segments[-1] = f"{segments[-1]} {line}"
+    return segments
+
+
+def join_translations(text, translations):
+    # English text for the segments of text: one line per dimension line, while the sentences
+    # of a natural language prompt are joined back into one comma-separated paragraph
+    if len(translations) < 2 or has_dimension_lines(text):
+        return "\n".join(translations)
+    return ", ".join(translation.rstrip(TRAILING_PUNCTUATION) for translation in translations)
+
+
+class TranslationMemory:
+    def __init__(self, model_id, max_entries=2048, ttl=30 * 86400, db_path=None, max_workers=4):
+        self.model_id = model_id
+        self.max_workers = max_workers
+        self.store = ResultCache(max_entries=max_entries, ttl=ttl, db_path=db_path)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.full_hits = 0
+        self.segment_lookups = 0
+        self.segment_hits = 0
+        self.upstream_calls = 0
+
+    def _key(self, segment):
+        normalized = normalize_text(segment)
+        return hashlib.sha256(f"{self.model_id}\n{normalized}".encode('utf-8')).hexdigest()
+
+    def lookup(self, segments):
+        # Returns cached translations (None for misses) in segment order
+        found = [self.store.get(self._key(segment)) for segment in segments]
+        with self._lock:
+            self.segment_lookups += len(segments)
+            self.segment_hits += sum(1 for value in found if value is not None)
+        return found
+
+    def remember(self, segment, translation):
+        self.store.set(self._key(segment), translation)
+
+    def record_request(self, upstream_calls):
+        with self._lock:
+            self.requests += 1
+            self.upstream_calls += upstream_calls
+            if upstream_calls == 0:
+                self.full_hits += 1
+
+    def _prepare(self, text, sentences):
+        segments = split_segments(text, sentences)
+        results = self.lookup(segments)
+        missing = [i for i, value in enumerate(results) if value is None]
+        return segments, results, missing
+
+    def _apply_batch(self, results, missing, translated):
+        # One upstream call covers all changed segments, one output line per segment
+        if len(missing) == 1:
+            lines = [translated.strip()]
+        else:
+            lines = [line.strip() for line in translated.splitlines() if line.strip()]
+        if len(lines) != len(missing):
+            return False
+        for i, line in zip(missing, lines):
+            results[i] = line
+        return True
+
+    def translate(self, text, translate_fn, sentences=False):
+        # sentences=True translates natural language text sentence by sentence (see split_segments)
+        segments, results, missing = self._prepare(text, sentences)
+        calls = 0
+
+        if missing:
+            calls += 1
+            batch = "\n".join(segments[i] for i in missing)
+            if not self._apply_batch(results, missing, translate_fn(batch)):
+                # Model merged or split lines - fall back to translating each segment on its own
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                    for i, line in zip(missing, executor.map(translate_fn, [segments[i] for i in missing])):
+                        results[i] = line.strip()
+                calls += len(missing)
+
+            for i in missing:
+                self.remember(segments[i], results[i])
+
+        self.record_request(calls)
+        return join_translations(text, results)
+
+    async def atranslate(self, text, translate_fn, sentences=False):
+        # Same as translate() for the asyncio serving mode; translate_fn is a coroutine function.
+        # The store is SQLite-backed, so lookups and writes run in a thread, off the event loop.
+        segments, results, missing = await asyncio.to_thread(self._prepare, text, sentences)
+        calls = 0
+
+        if missing:
+            calls += 1
+            batch = "\n".join(segments[i] for i in missing)
+            if not self._apply_batch(results, missing, await translate_fn(batch)):
+                lines = await asyncio.gather(*(translate_fn(segments[i]) for i in missing))
+                for i, line in zip(missing, lines):
+                    results[i] = line.strip()
+                calls += len(missing)
+
+            await asyncio.to_thread(lambda: [self.remember(segments[i], results[i]) for i in missing])
+
+        self.record_request(calls)
+        return join_translations(text, results)
+
+    def learn(self, segments, translation):
+        # Store a whole-text translation (e.g. from a streamed call) when it lines up with the segments
+        if len(segments) == 1:
+            self.remember(segments[0], translation.strip())
+        else:
+            lines = [line.strip() for line in translation.splitlines() if line.strip()]
+            if len(lines) == len(segments):
+                for segment, line in zip(segments, lines):
+                    self.remember(segment, line)
+        self.record_request(1)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'full_hits': self.full_hits,
+                'segment_lookups': self.segment_lookups,
+                'segment_hits': self.segment_hits,
+                'hit_ratio': round(self.segment_hits / self.segment_lookups, 4) if self.segment_lookups else 0.0,
+                'upstream_calls': self.upstream_calls,
+                'upstream_calls_saved': self.full_hits,
+                'store': self.store.stats(),
+            }
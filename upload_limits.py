@@ -0,0 +1,118 @@
+import contextlib
+import ctypes
+import ctypes.util
+import threading
+
+from PIL import Image
+
+# Guards that keep large uploads from exhausting worker memory. Request bodies are capped by
+# the web layer (MAX_UPLOAD_BYTES, checked against Content-Length before the body is read) and
+# spooled to temp files; image headers are checked against a pixel limit before anything is
+# decoded; DecodeBudget bounds the memory held by decoded images across all threads.
+
+# Decoded RGBA pixels plus the converted copy made while flattening / resizing
+DECODE_BYTES_PER_PIXEL = 8
+M_MMAP_THRESHOLD = -3
+
+
+class UploadTooLarge(Exception):
+    # Raised before decoding; the HTTP layer turns it into 413
+
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.reason = reason
+
+
+def check_pixels(size, max_pixels):
+    if max_pixels and size[0] * size[1] > max_pixels:
+        raise UploadTooLarge(
+            f"Image is {size[0]}x{size[1]} pixels, larger than the limit of {max_pixels} pixels",
+            'pixels',
+        )
+
+
+def open_image(file_obj, max_pixels):
+    # Image.open only parses the header; raises UploadTooLarge before any pixel data is decoded
+    try:
+        img = Image.open(file_obj)
+    except Image.DecompressionBombError as e:
+        raise UploadTooLarge(str(e), 'pixels')
+    check_pixels(img.size, max_pixels)
+    return img
+
+
+def check_upload(file_obj, max_pixels):
+    # Header check at request parse time. Files Pillow cannot identify are left for the decoder to report.
+    position = file_obj.tell()
+    try:
+        open_image(file_obj, max_pixels)
+    except (Image.UnidentifiedImageError, OSError):
+        pass
+    finally:
+        file_obj.seek(position)
+
+
+def decode_bytes(img):
+    # Upper bound of the memory one image needs while it is decoded and downscaled.
+    # Called after Image.draft(), so JPEGs count at their reduced decode size.
+    return img.width * img.height * DECODE_BYTES_PER_PIXEL
+
+
+def set_mmap_threshold(threshold):
+    # glibc raises its mmap threshold after large frees and then serves decode buffers from
+    # per-thread arenas that keep the memory, so each image thread ends up holding its largest
+    # decode. A fixed threshold keeps those buffers mmap'd and returned to the OS on free.
+    # Returns False where mallopt is unavailable (musl, macOS, Windows).
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        return bool(libc.mallopt(M_MMAP_THRESHOLD, threshold))
+    except (OSError, AttributeError, TypeError):
+        return False
+
+
+class DecodeBudget:
+    # Counting semaphore over bytes, shared by every thread that decodes images. A reservation
+    # larger than the whole budget waits until nothing else is reserved, so one huge image
+    # still decodes, alone. max_bytes <= 0 disables the limit.
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_use = 0
+        self.peak = 0
+        self.waiting = 0
+        self.waits = 0
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def reserve(self, nbytes):
+        if self.max_bytes <= 0:
+            yield
+            return
+        nbytes = min(nbytes, self.max_bytes)
+        with self._cond:
+            if self.in_use + nbytes > self.max_bytes:
+                self.waits += 1
+                self.waiting += 1
+                try:
+                    while self.in_use + nbytes > self.max_bytes:
+                        self._cond.wait()
+                finally:
+                    self.waiting -= 1
+            self.in_use += nbytes
+            self.peak = max(self.peak, self.in_use)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_use -= nbytes
+                self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'max_bytes': self.max_bytes,
+                'in_use': self.in_use,
+                'peak': self.peak,
+                'waiting': self.waiting,
+                'waits': self.waits,
+            }